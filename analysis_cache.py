@@ -0,0 +1,112 @@
+"""
+Caché de resultados del análisis de archivos.
+
+La clave es el sha256 del contenido (calculado por bloques, sin cargar el
+archivo en RAM) junto con el tipo MIME, las instrucciones del usuario y una
+variante (prompt, modelo y ajustes de preprocesamiento), así que volver a
+subir el mismo estudio desde otro dispositivo o tras un reintento no repite
+la llamada a Gemini. Se guarda el resultado estructurado (dict), de modo que
+/analyze_json y /analyze_xml comparten entrada.
+
+Dos niveles: LRU en memoria y, opcionalmente, disco con tope de tamaño y TTL.
+Peticiones simultáneas con la misma clave esperan a un único análisis.
+"""
+import hashlib
+import json
+import os
+import threading
+from concurrent.futures import Future
+
+import caching
+
+FILE_CACHE_ENABLED = os.getenv("FILE_CACHE_ENABLED", "1").lower() in ("1", "true", "yes")
+FILE_CACHE_TTL_SECONDS = int(os.getenv("FILE_CACHE_TTL_SECONDS", "86400"))
+FILE_CACHE_ITEMS = int(os.getenv("FILE_CACHE_ITEMS", "128"))
+FILE_CACHE_DIR = os.getenv("FILE_CACHE_DIR", "")
+FILE_CACHE_MAX_MB = float(os.getenv("FILE_CACHE_MAX_MB", "64"))
+HASH_CHUNK_BYTES = 1024 * 1024
+
+_memory = caching.LRUCache(max_items=FILE_CACHE_ITEMS, ttl=FILE_CACHE_TTL_SECONDS)
+_disk = None
+if FILE_CACHE_ENABLED and FILE_CACHE_DIR:
+    try:
+        _disk = caching.DiskCache(FILE_CACHE_DIR, int(FILE_CACHE_MAX_MB * 1024 * 1024),
+                                  ttl=FILE_CACHE_TTL_SECONDS, suffix=".json")
+    except OSError as e:
+        print("⚠️ Caché de análisis en disco deshabilitada:", e)
+
+_inflight = {}  # {clave: Future} de análisis en curso
+_inflight_lock = threading.Lock()
+
+
+def content_hash(upload):
+    """sha256 del archivo subido leyendo su stream por bloques."""
+    h = hashlib.sha256()
+    stream = upload.stream
+    stream.seek(0)
+    for block in iter(lambda: stream.read(HASH_CHUNK_BYTES), b""):
+        h.update(block)
+    stream.seek(0)
+    return h.hexdigest()
+
+
+def cache_key(upload, mime_type, instructions, variant):
+    return caching.hash_key(content_hash(upload), mime_type, instructions.strip(), variant)
+
+
+def _lookup(key):
+    result = _memory.get(key)
+    if result is None and _disk is not None:
+        raw = _disk.get(key)
+        if raw is not None:
+            result = json.loads(raw)
+            _memory.set(key, result)
+    return result
+
+
+def _store(key, result):
+    _memory.set(key, result)
+    if _disk is not None:
+        _disk.set(key, json.dumps(result, ensure_ascii=False).encode("utf-8"))
+
+
+def cached(key, analyze):
+    """
+    Devuelve (resultado, hit). `analyze()` solo se llama si la clave no está
+    en caché y nadie más la está calculando; el resultado debe ser un dict
+    serializable a JSON. Con la caché desactivada siempre llama a analyze().
+    """
+    if not FILE_CACHE_ENABLED:
+        return analyze(), False
+    result = _lookup(key)
+    if result is not None:
+        return result, True
+
+    with _inflight_lock:
+        future = _inflight.get(key)
+        owner = future is None
+        if owner:
+            future = _inflight[key] = Future()
+    if not owner:
+        return future.result(), True
+
+    try:
+        result = analyze()
+        # Solo se guardan análisis completos, no textos sin estructurar
+        if "raw_model_text" not in result:
+            _store(key, result)
+        future.set_result(result)
+        return result, False
+    except Exception as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _inflight_lock:
+            _inflight.pop(key, None)
+
+
+def stats():
+    data = {"enabled": FILE_CACHE_ENABLED, "memory": _memory.stats(), "in_flight": len(_inflight)}
+    if _disk is not None:
+        data["disk"] = _disk.stats()
+    return data
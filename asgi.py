@@ -0,0 +1,428 @@
+"""
+Punto de entrada ASGI (modo async):
+
+    uvicorn asgi:app --workers 2
+
+Las rutas que pasan casi todo el tiempo esperando a Gemini tienen aquí una
+versión async que usa `generate_content_async`, así que un solo proceso
+puede mantener cientos de consultas en vuelo sin un hilo por petición.
+Whisper, la decodificación de audio y gTTS siguen siendo bloqueantes y se
+ejecutan en un pool de hilos. Cualquier otra ruta la atiende la app Flask
+de server_combined a través de WsgiToAsgi.
+
+`async=1` en la sesión de voz encola el trabajo igual que la ruta Flask
+(sc.enqueue_job) y `defer_summary=1` devuelve `summary_id` igual que ella.
+Los multipart se vuelcan a un SpooledTemporaryFile mientras llegan, así que
+un archivo grande no queda entero en memoria.
+"""
+import asyncio
+import concurrent.futures
+import contextvars
+import json
+import os
+import tempfile
+import time
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+
+from asgiref.wsgi import WsgiToAsgi
+from werkzeug.formparser import parse_form_data
+
+import server_combined as sc
+import combined_reply
+import metrics
+import negotiation
+import response_cache
+import uploads
+import whisper_pool
+import xml_codec
+
+ASGI_BLOCKING_WORKERS = int(os.getenv("ASGI_BLOCKING_WORKERS", "8"))
+# Igual que Werkzeug con las partes multipart: por encima, a disco
+SPOOL_MAX_MEMORY_BYTES = 500 * 1024
+
+_blocking = ThreadPoolExecutor(max_workers=ASGI_BLOCKING_WORKERS, thread_name_prefix="asgi-blocking")
+flask_app = WsgiToAsgi(sc.app)
+# Tareas que siguen tras responder (resúmenes diferidos); referencia para que no las recoja el GC
+_background = set()
+
+
+class BodyTooLarge(Exception):
+    """El cuerpo superó el tope de la ruta (cuerpos chunked sin Content-Length)."""
+
+
+# ===== UTILIDADES =====
+async def run_blocking(fn, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    # Con el contexto actual, para que las etapas se anoten en la traza de la petición
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(_blocking, partial(context.run, fn, *args, **kwargs))
+
+
+async def generate_text_async(prompt):
+    resp = await sc.gemini_model.generate_content_async(prompt)
+    return (resp.text or "").strip()
+
+
+class Request:
+    """Lo mínimo para leer una petición ASGI."""
+
+    def __init__(self, scope, receive):
+        self.scope = scope
+        self._receive = receive
+        self.headers = {k.decode("latin-1").lower(): v.decode("latin-1") for k, v in scope.get("headers", [])}
+        self._body = None
+        self.query = {k: v[-1] for k, v in parse_qs(scope.get("query_string", b"").decode("latin-1")).items()}
+
+    async def body(self):
+        if self._body is None:
+            chunks = []
+            while True:
+                message = await self._receive()
+                chunks.append(message.get("body", b""))
+                if not message.get("more_body"):
+                    break
+            self._body = b"".join(chunks)
+        return self._body
+
+    async def json(self):
+        try:
+            return json.loads(await self.body() or b"{}")
+        except ValueError:
+            return {}
+
+    async def data(self, default=negotiation.JSON):
+        """Cuerpo JSON o XML como dict, igual que negotiation.read_body()."""
+        body = await self.body()
+        if (negotiation.body_format(self.headers.get("content-type"), body[:64]) or default) == negotiation.XML:
+            try:
+                return xml_codec.parse(body)
+            except xml_codec.XMLError:
+                return {}
+        data = await self.json()
+        return data if isinstance(data, dict) else {}
+
+    async def response_format(self, forced=None, default=negotiation.JSON):
+        # En multipart el cuerpo no dice nada del formato: no hace falta leerlo aquí
+        prefix = b"" if self.headers.get("content-type") else (await self.body())[:64]
+        return negotiation.choose(self.headers.get("accept", ""), self.headers.get("content-type", ""),
+                                  prefix, forced, default)
+
+    async def files(self, max_bytes=None):
+        """
+        (form, archivos) de un multipart/form-data, con el parser de Werkzeug.
+        El cuerpo se vuelca por trozos a un SpooledTemporaryFile (a disco por
+        encima de SPOOL_MAX_MEMORY_BYTES); lanza BodyTooLarge pasado `max_bytes`.
+        """
+        with tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_MEMORY_BYTES) as spool:
+            size = 0
+            while True:
+                message = await self._receive()
+                chunk = message.get("body", b"")
+                size += len(chunk)
+                if max_bytes is not None and size > max_bytes:
+                    raise BodyTooLarge()
+                spool.write(chunk)
+                if not message.get("more_body"):
+                    break
+            spool.seek(0)
+            environ = {
+                "REQUEST_METHOD": "POST",
+                "CONTENT_TYPE": self.headers.get("content-type", ""),
+                "CONTENT_LENGTH": str(size),
+                "wsgi.input": spool,
+            }
+            # Werkzeug copia cada parte a su propio archivo: el spool se puede cerrar
+            _, form, files = await run_blocking(parse_form_data, environ)
+        return form, files
+
+
+async def send_body(send, body, content_type, status=200, headers=None):
+    raw_headers = [
+        (b"content-type", content_type.encode()),
+        (b"content-length", str(len(body)).encode()),
+        # Igual que CORS(app) en la app Flask
+        (b"access-control-allow-origin", b"*"),
+    ]
+    for key, value in (headers or {}).items():
+        raw_headers.append((key.lower().encode(), value.encode()))
+    await send({"type": "http.response.start", "status": status, "headers": raw_headers})
+    await send({"type": "http.response.body", "body": body})
+
+
+async def send_json(send, payload, status=200, headers=None):
+    await send_body(send, json.dumps(payload, ensure_ascii=False).encode("utf-8"),
+                    "application/json", status, headers)
+
+
+async def send_xml(send, payload, status=200, headers=None):
+    await send_body(send, xml_codec.dumps(payload).encode("utf-8"), "application/xml", status, headers)
+
+
+async def send_as(send, fmt, payload, status=200, headers=None):
+    headers = {"Vary": "Accept", **(headers or {})}
+    if fmt == negotiation.XML:
+        return await send_xml(send, payload, status, headers)
+    await send_json(send, payload, status, headers)
+
+
+def value(request, form, name):
+    """Campo de form o parámetro de la URL, como request.values en Flask."""
+    return (form.get(name) or request.query.get(name) or "").strip()
+
+
+def flag(request, form, name):
+    return value(request, form, name).lower() in ("1", "true", "yes")
+
+
+def defer_task(awaitable):
+    """
+    pipeline.defer() para una corrutina que sigue corriendo tras responder;
+    devuelve el id que se consulta en /api/ai/voice-session/summary/<id>.
+    """
+    future = concurrent.futures.Future()
+    task = asyncio.ensure_future(awaitable)
+    _background.add(task)
+
+    def done(task):
+        _background.discard(task)
+        if task.cancelled():
+            future.set_exception(asyncio.CancelledError())
+        elif task.exception() is not None:
+            future.set_exception(task.exception())
+        else:
+            future.set_result(task.result())
+
+    task.add_done_callback(done)
+    return sc.pipeline.defer(future)
+
+
+# ===== RUTAS ASYNC =====
+async def ai_doctor(request, send):
+    fmt = await request.response_format(default=negotiation.XML)
+    body = await request.data(default=negotiation.XML)
+    patient = body.get("patient", {})
+    symptoms = body.get("symptoms", "")
+    studies = body.get("studies", [])
+
+    prompt = sc.doctor_prompt(patient, symptoms, studies)
+    fields = {"patient": patient, "symptoms": symptoms, "studies": studies}
+    cache = response_cache.get_cache("doctor")
+    text = cache.lookup(prompt, fields) if cache else None
+    if text is None:
+        try:
+            text = await generate_text_async(prompt)
+            if cache and text:
+                cache.store(prompt, text, fields)
+        except sc.gemini_client.GeminiUnavailable:
+            raise
+        except Exception as e:
+            text = f"(demo) Error con Gemini: {e}"
+    await send_as(send, fmt, {"recommendation": text})
+
+
+async def ai_patient(request, send):
+    fmt = await request.response_format(default=negotiation.XML)
+    body = await request.data(default=negotiation.XML)
+    patient = body.get("patient", {})
+    symptoms = body.get("symptoms", "")
+    studies = body.get("studies", [])
+
+    prompt = sc.patient_prompt(patient, symptoms, studies)
+    fields = {"patient": patient, "symptoms": symptoms, "studies": studies}
+    cache = response_cache.get_cache("patient")
+    text = cache.lookup(prompt, fields) if cache else None
+    if text is None:
+        try:
+            text = await generate_text_async(prompt)
+            if cache and text:
+                cache.store(prompt, text, fields)
+        except sc.gemini_client.GeminiUnavailable:
+            raise
+        except Exception as e:
+            text = f"(demo) Error con Gemini: {e}"
+
+    await send_as(send, fmt, {"message": text})
+
+
+async def summarize_text_async(text):
+    try:
+        return await generate_text_async(sc.summary_prompt(text))
+    except Exception as e:
+        return f"(Error al resumir: {e})"
+
+
+async def reply_with_summary_async(prompt):
+    """Versión async de sc.reply_with_summary."""
+    if combined_reply.COMBINED_REPLY:
+        result = await combined_reply.generate_async(sc.gemini_model, prompt, sc.SUMMARY_INSTRUCTION)
+        if result:
+            return result["response"], result["summary"]
+    answer = await generate_text_async(prompt)
+    return answer, await summarize_text_async(answer)
+
+
+async def ai_interaction(request, send, fmt=None):
+    fmt = await request.response_format(fmt)
+    data = await request.data()
+    session_id = data.get("session_id") or "default"
+    message = (data.get("message") or "").strip()
+    history = data.get("history") or []
+
+    if not message:
+        return await send_as(send, fmt, {"error": "Falta 'message'"}, 400)
+
+    await run_blocking(sc.conversations.append, session_id, "user", message)
+    try:
+        prompt = await run_blocking(sc.build_interaction_prompt, session_id,
+                                    history if isinstance(history, list) else [], message)
+        answer, summary = await reply_with_summary_async(prompt)
+        await run_blocking(sc.conversations.append, session_id, "assistant", answer)
+        sc.context_manager.maybe_fold(session_id)
+        await send_as(send, fmt, {"session_id": session_id, "response": answer, "summary": summary})
+    except sc.gemini_client.GeminiUnavailable:
+        raise
+    except Exception as e:
+        await send_as(send, fmt, {"error": str(e)}, 500)
+
+
+async def timed(timings, name, awaitable):
+    start = time.perf_counter()
+    try:
+        return await awaitable
+    finally:
+        elapsed = time.perf_counter() - start
+        timings[name] = round(elapsed, 3)
+        metrics.record_span(name, elapsed)
+
+
+async def ai_voice_session(request, send, fmt=None):
+    """Misma respuesta que /api/ai/voice-session, con resumen y voz en paralelo."""
+    started = time.perf_counter()
+    timings = {}
+    fmt = await request.response_format(fmt)
+    limit = uploads.limit_for("document")
+    too_large = {"error": f"Archivo demasiado grande (máximo {round(limit / uploads.MB)} MB)"}
+    if int(request.headers.get("content-length") or 0) > limit:
+        return await send_as(send, fmt, too_large, 413)
+    try:
+        try:
+            form, files = await request.files(max_bytes=limit)
+        except BodyTooLarge:
+            return await send_as(send, fmt, too_large, 413)
+        upload = files.get("file")
+        if not upload:
+            return await send_as(send, fmt, {"error": "Falta el archivo ('file')"}, 400)
+
+        if flag(request, form, "async"):
+            saved = await run_blocking(uploads.save_for_later, upload)
+            payload, status = await run_blocking(sc.enqueue_job, "voice-session", sc.run_voice_session_job, saved,
+                                                 callback_url=value(request, form, "callback_url") or None)
+            return await send_as(send, fmt, payload, status)
+
+        # audio: decode + VAD + Whisper; imagen: Gemini. El desglose queda en el pipeline
+        pipe = sc.pipeline.Pipeline()
+        user_text, vad = await timed(timings, "input", run_blocking(sc.voice_input_text, upload, pipe))
+        timings.update(pipe.timings())
+        if not user_text:
+            return await send_as(send, fmt, {"error": "No se pudo transcribir audio"}, 400)
+
+        prompt = sc.voice_prompt(user_text)
+        combined = None
+        if combined_reply.COMBINED_REPLY:
+            combined = await timed(timings, "gemini_reply", combined_reply.generate_async(
+                sc.gemini_model, prompt, sc.VOICE_SUMMARY_INSTRUCTION))
+        if combined:
+            ai_text = combined["response"]
+            summary_task = asyncio.sleep(0, combined["summary"])
+        else:
+            ai_text = await timed(timings, "gemini_reply", generate_text_async(prompt))
+            summary_task = asyncio.wait_for(
+                timed(timings, "summary", generate_text_async(sc.voice_summary_prompt(ai_text))),
+                sc.SUMMARY_TIMEOUT_SECONDS,
+            )
+        # Con defer_summary=1 el resumen sigue en segundo plano y se responde sin él
+        summary_id = defer_task(summary_task) if flag(request, form, "defer_summary") else None
+        tts_task = asyncio.wait_for(
+            timed(timings, "tts", run_blocking(sc.synthesize_to_file, ai_text, "ai_")),
+            sc.TTS_TIMEOUT_SECONDS,
+        )
+        if summary_id:
+            summary = None
+            [audio_name] = await asyncio.gather(tts_task, return_exceptions=True)
+        else:
+            summary, audio_name = await asyncio.gather(summary_task, tts_task, return_exceptions=True)
+        if isinstance(audio_name, BaseException):
+            print("⚠️ No se pudo generar el audio:", audio_name)
+            audio_name = None
+        if isinstance(summary, BaseException):
+            summary = "(sin resumen disponible)"
+
+        timings["total"] = round(time.perf_counter() - started, 3)
+        headers = {"X-Pipeline-Timings": json.dumps(timings)}
+        if vad:
+            headers["X-Audio-Seconds-Saved"] = str(vad["saved_seconds"])
+        payload = {
+            "status": "ok",
+            "input_text": user_text,
+            "ai_response": ai_text,
+            "audio_file": audio_name,
+        }
+        if summary_id:
+            payload["summary_id"] = summary_id
+        else:
+            payload["summary"] = summary
+        await send_as(send, fmt, payload, headers=headers)
+    except whisper_pool.WhisperBusy:
+        await send_as(send, fmt, {"error": sc.WHISPER_BUSY_MESSAGE}, 503)
+    except sc.gemini_client.GeminiUnavailable:
+        raise
+    except Exception as e:
+        await send_as(send, fmt, {"error": str(e)}, 500)
+
+
+ROUTES = {
+    ("POST", "/api/ai/doctor"): ai_doctor,
+    ("POST", "/api/ai/patient"): ai_patient,
+    ("POST", "/api/ai/interaction"): ai_interaction,
+    ("POST", "/api/ai/interaction-xml"): partial(ai_interaction, fmt=negotiation.XML),
+    ("POST", "/api/ai/voice-session"): ai_voice_session,
+    ("POST", "/api/ai/voice-session-xml"): partial(ai_voice_session, fmt=negotiation.XML),
+}
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                _blocking.shutdown(wait=False)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    handler = ROUTES.get((scope.get("method"), scope.get("path"))) if scope["type"] == "http" else None
+    if handler is None:
+        return await flask_app(scope, receive, send)
+
+    trace = metrics.start_trace(scope["path"])
+    status = 500
+
+    async def traced_send(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+            metrics.finish_request(trace, scope["method"], status)
+            if metrics.SERVER_TIMING:
+                message = {**message, "headers": list(message["headers"]) + [
+                    (b"server-timing", trace.server_timing().encode())]}
+        await send(message)
+
+    try:
+        await handler(Request(scope, receive), traced_send)
+    except sc.gemini_client.GeminiUnavailable as e:
+        # Mismo 503 que el errorhandler de la app Flask
+        retry_after = str(sc.gemini_model.breaker.retry_after() or 1)
+        await send_json(traced_send, {"error": str(e)}, 503, headers={"Retry-After": retry_after})
@@ -0,0 +1,137 @@
+"""
+Entrada y salida de audio sin pasar por disco cuando es posible.
+
+- decode_audio_bytes: convierte el audio subido a float32 mono a 16 kHz,
+  el formato que Whisper acepta directamente como arreglo NumPy.
+- synthesize_mp3: genera el MP3 de gTTS en memoria (BytesIO), con caché
+  direccionada por (texto, idioma, tld): LRU en memoria y, si se configura
+  TTS_DISK_CACHE_DIR, un segundo nivel en disco.
+"""
+import io
+import os
+import subprocess
+import wave
+
+import caching
+import scratch_files
+import startup
+
+SAMPLE_RATE = 16000
+
+TTS_CACHE_ITEMS = int(os.getenv("TTS_CACHE_ITEMS", "256"))
+TTS_CACHE_MAX_MB = float(os.getenv("TTS_CACHE_MAX_MB", "32"))
+TTS_DISK_CACHE_DIR = os.getenv("TTS_DISK_CACHE_DIR", "")
+TTS_DISK_CACHE_MAX_MB = float(os.getenv("TTS_DISK_CACHE_MAX_MB", "256"))
+
+_tts_memory = caching.LRUCache(max_items=TTS_CACHE_ITEMS, max_bytes=int(TTS_CACHE_MAX_MB * 1024 * 1024))
+_tts_disk = None
+if TTS_DISK_CACHE_DIR:
+    try:
+        _tts_disk = caching.DiskCache(TTS_DISK_CACHE_DIR, int(TTS_DISK_CACHE_MAX_MB * 1024 * 1024), suffix=".mp3")
+    except OSError as e:
+        print("⚠️ Caché de audio en disco deshabilitada:", e)
+
+# Contenedores que ffmpeg no siempre puede leer desde un pipe
+# (el índice 'moov' suele ir al final del archivo)
+_SEEKABLE_ONLY = (".m4a", ".mp4", ".mov", ".3gp")
+
+
+def _pcm16_to_float(raw):
+    np = startup.lazy_import("numpy")
+    return np.frombuffer(raw, np.int16).flatten().astype(np.float32) / 32768.0
+
+
+def _decode_wav(data):
+    """Camino rápido para WAV PCM de 16 bits; None si no aplica."""
+    if data[:4] != b"RIFF" or data[8:12] != b"WAVE":
+        return None
+    try:
+        with wave.open(io.BytesIO(data)) as wav:
+            if wav.getsampwidth() != 2:
+                return None
+            channels = wav.getnchannels()
+            rate = wav.getframerate()
+            samples = _pcm16_to_float(wav.readframes(wav.getnframes()))
+    except (wave.Error, EOFError):
+        return None
+
+    np = startup.lazy_import("numpy")
+    if channels > 1:
+        samples = samples.reshape(-1, channels).mean(axis=1)
+    if rate != SAMPLE_RATE and len(samples):
+        duration = len(samples) / rate
+        target = np.linspace(0, duration, int(duration * SAMPLE_RATE), endpoint=False)
+        source = np.arange(len(samples)) / rate
+        samples = np.interp(target, source, samples)
+    return samples.astype(np.float32)
+
+
+def _ffmpeg_decode(source, data=None):
+    cmd = [
+        "ffmpeg", "-threads", "0",
+        "-i", source,
+        "-f", "s16le", "-ac", "1", "-acodec", "pcm_s16le", "-ar", str(SAMPLE_RATE),
+        "-",
+    ]
+    if data is None:
+        cmd.insert(1, "-nostdin")
+    try:
+        out = subprocess.run(cmd, input=data, capture_output=True, check=True).stdout
+    except subprocess.CalledProcessError as e:
+        raise RuntimeError(f"No se pudo decodificar el audio: {e.stderr.decode(errors='ignore')[-300:]}") from e
+    return _pcm16_to_float(out)
+
+
+def decode_audio_bytes(data, filename=""):
+    """Decodifica `data` a float32 mono 16 kHz, usando disco solo como último recurso."""
+    samples = _decode_wav(data)
+    if samples is not None:
+        return samples
+
+    suffix = "." + filename.rsplit(".", 1)[-1].lower() if "." in filename else ""
+    if suffix not in _SEEKABLE_ONLY:
+        try:
+            return _ffmpeg_decode("pipe:0", data)
+        except RuntimeError:
+            pass
+
+    with scratch_files.scratch_file(suffix=suffix, prefix="in_") as path:
+        with open(path, "wb") as f:
+            f.write(data)
+        return _ffmpeg_decode(path)
+
+
+def decode_upload(upload):
+    """Atajo para un FileStorage de Flask."""
+    return decode_audio_bytes(upload.read(), upload.filename or "")
+
+
+def synthesize_mp3(text, lang="es", tld="com.mx"):
+    """Devuelve los bytes MP3 de gTTS para `text`, usando la caché si es posible."""
+    key = caching.hash_key(text.strip(), lang, tld)
+    data = _tts_memory.get(key)
+    if data is not None:
+        return data
+
+    if _tts_disk is not None:
+        data = _tts_disk.get(key)
+        if data is not None:
+            _tts_memory.set(key, data)
+            return data
+
+    gtts = startup.lazy_import("gtts")
+    buf = io.BytesIO()
+    gtts.gTTS(text=text, lang=lang, tld=tld).write_to_fp(buf)
+    data = buf.getvalue()
+
+    _tts_memory.set(key, data)
+    if _tts_disk is not None:
+        _tts_disk.set(key, data)
+    return data
+
+
+def tts_cache_stats():
+    return {
+        "memory": _tts_memory.stats(),
+        "disk": _tts_disk.stats() if _tts_disk is not None else None,
+    }
@@ -0,0 +1,130 @@
+"""
+Compara las dos formas de obtener respuesta + resumen de un turno:
+
+- dos llamadas: respuesta y luego resumen de esa respuesta (modo por defecto);
+- una llamada: JSON {"response", "summary"} (COMBINED_REPLY=1).
+
+    python benchmarks/combined_reply_bench.py --turns 10          # Gemini real
+    python benchmarks/combined_reply_bench.py --fake --turns 50   # servidor falso local
+
+Con Gemini real necesita GOOGLE_GEMINI_API_KEY y google-generativeai. Mide
+latencia por turno (p50/p95), llamadas y tokens (usage_metadata), y cuántas
+veces el JSON no fue válido y hubo que volver a dos llamadas.
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import combined_reply  # noqa: E402
+import prompts  # noqa: E402
+
+MODEL_NAME = "gemini-2.5-flash"
+FAKE_PORT = 8097
+
+# Mismo texto que server_combined.SUMMARY_INSTRUCTION
+SUMMARY_INSTRUCTION = "resumen de tu respuesta en 3 líneas máximo, con tono médico y conciso"
+
+
+MESSAGES = [
+    "Tengo dolor de cabeza desde hace tres días y me molesta la luz.",
+    "Me duele el pecho cuando subo escaleras, pero se me quita al descansar.",
+    "Mi hijo tiene fiebre de 38.5 desde ayer y no quiere comer.",
+    "Tengo tos seca por las noches desde hace dos semanas.",
+    "Me salió un sarpullido en los brazos después de ir al campo.",
+]
+
+
+def interaction_prompt(message):
+    return prompts.interaction("(sin historial)", message)
+
+
+class RecordingModel:
+    """Envuelve el GenerativeModel y suma llamadas y tokens de usage_metadata."""
+
+    def __init__(self, model):
+        self.model = model
+        self.reset()
+
+    def reset(self):
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.output_tokens = 0
+
+    def generate_content(self, *args, **kwargs):
+        resp = self.model.generate_content(*args, **kwargs)
+        self.calls += 1
+        usage = getattr(resp, "usage_metadata", None)
+        if usage is not None:
+            self.prompt_tokens += usage.prompt_token_count or 0
+            self.output_tokens += usage.candidates_token_count or 0
+        return resp
+
+
+def two_calls(model, prompt):
+    answer = (model.generate_content(prompt).text or "").strip()
+    summary = (model.generate_content(prompts.summary(answer)).text or "").strip()
+    return answer, summary
+
+
+def one_call(model, prompt):
+    result = combined_reply.generate(model, prompt, SUMMARY_INSTRUCTION)
+    if result is None:
+        return two_calls(model, prompt)
+    return result["response"], result["summary"]
+
+
+def run(name, fn, model, turns):
+    latencies = []
+    model.reset()
+    fallbacks_before = combined_reply.stats()["fallbacks"]
+    for i in range(turns):
+        prompt = interaction_prompt(MESSAGES[i % len(MESSAGES)])
+        start = time.perf_counter()
+        fn(model, prompt)
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    return {
+        "mode": name,
+        "p50": latencies[len(latencies) // 2],
+        "p95": latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+        "mean": statistics.mean(latencies),
+        "calls": model.calls / turns,
+        "prompt_tokens": model.prompt_tokens / turns,
+        "output_tokens": model.output_tokens / turns,
+        "fallbacks": combined_reply.stats()["fallbacks"] - fallbacks_before,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--turns", type=int, default=10)
+    parser.add_argument("--fake", action="store_true", help="usar benchmarks/fake_gemini.py en vez de Gemini")
+    parser.add_argument("--fake-latency-ms", type=float, default=800)
+    args = parser.parse_args()
+
+    import google.generativeai as genai
+
+    if args.fake:
+        import fake_gemini
+        fake_gemini.serve(fake_gemini.FakeGemini(latency_ms=args.fake_latency_ms), port=FAKE_PORT)
+        genai.configure(api_key="fake", transport="rest",
+                        client_options={"api_endpoint": f"http://127.0.0.1:{FAKE_PORT}"})
+    else:
+        genai.configure(api_key=os.environ["GOOGLE_GEMINI_API_KEY"])
+    model = RecordingModel(genai.GenerativeModel(MODEL_NAME))
+
+    print(f"{'modo':<12} {'p50 s':>7} {'p95 s':>7} {'media s':>8} {'llamadas':>9} "
+          f"{'tok. entrada':>13} {'tok. salida':>12} {'fallbacks':>10}")
+    for name, fn in (("dos", two_calls), ("una", one_call)):
+        r = run(name, fn, model, args.turns)
+        print(f"{r['mode']:<12} {r['p50']:7.2f} {r['p95']:7.2f} {r['mean']:8.2f} {r['calls']:9.1f} "
+              f"{r['prompt_tokens']:13.0f} {r['output_tokens']:12.0f} {r['fallbacks']:10d}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,285 @@
+"""
+Servidor local que imita la API REST de Gemini (generateContent y
+streamGenerateContent), para probar gemini_client sin red ni cuota:
+
+    python benchmarks/fake_gemini.py --port 8089 --latency-ms 300 --error-rate 0.2
+    GEMINI_API_ENDPOINT=http://127.0.0.1:8089 python server_combined.py
+
+Si la petición pide response_mime_type=application/json (modo de una sola
+llamada de combined_reply), el texto es un JSON {"response", "summary"}.
+
+Se pueden simular errores transitorios (--error-rate, con 429 y 503 al
+azar), colas lentas (--slow-rate / --slow-ms) y una caída total (--down).
+GET /stats devuelve cuántas peticiones llegaron y cuántas fallaron.
+
+No implementa la File API: los archivos grandes del analizador siguen
+necesitando Gemini real.
+
+FakeModel es el mismo comportamiento sin HTTP, como sustituto en proceso de
+GenerativeModel (lo usa benchmarks/load_test.py cuando no hay SDK).
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+_PATH = re.compile(r"^/v1(?:beta)?/models/(?P<model>[^:/]+):(?P<method>generateContent|streamGenerateContent)")
+_ERRORS = [(429, "RESOURCE_EXHAUSTED", "Quota exceeded (fake)"), (503, "UNAVAILABLE", "Overloaded (fake)")]
+
+
+class FakeGemini:
+    """Comportamiento configurable del servidor falso."""
+
+    def __init__(self, latency_ms=200, jitter_ms=50, error_rate=0.0, slow_rate=0.0, slow_ms=5000,
+                 down=False, text="Respuesta simulada de Gemini. Toma líquidos y descansa. "
+                                  "¿Desde cuándo tienes los síntomas?", chunks=4):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.slow_rate = slow_rate
+        self.slow_ms = slow_ms
+        self.down = down
+        self.text = text
+        self.chunks = chunks
+        self.counts = {"requests": 0, "errors": 0, "slow": 0}
+        self._lock = threading.Lock()
+        self._serial = itertools.count(1)
+
+    def next_text(self, json_mode=False):
+        # Texto distinto en cada llamada para no acertar siempre en las cachés (p.ej. TTS)
+        text = f"{self.text} Caso {next(self._serial)}."
+        if json_mode:
+            return json.dumps({"response": text, "summary": "Resumen simulado."}, ensure_ascii=False)
+        return text
+
+    def _count(self, name):
+        with self._lock:
+            self.counts[name] += 1
+
+    def delay(self):
+        if random.random() < self.slow_rate:
+            self._count("slow")
+            return self.slow_ms / 1000
+        return max(0.0, random.gauss(self.latency_ms, self.jitter_ms)) / 1000
+
+    def error(self):
+        """(código, status, mensaje) si esta petición debe fallar, o None."""
+        if self.down or random.random() < self.error_rate:
+            self._count("errors")
+            return random.choice(_ERRORS)
+        return None
+
+    def response(self, text, prompt_chars):
+        prompt_tokens = max(1, prompt_chars // 4)
+        output_tokens = max(1, len(text) // 4)
+        return {
+            "candidates": [{
+                "content": {"role": "model", "parts": [{"text": text}]},
+                "finishReason": "STOP",
+                "index": 0,
+            }],
+            "usageMetadata": {
+                "promptTokenCount": prompt_tokens,
+                "candidatesTokenCount": output_tokens,
+                "totalTokenCount": prompt_tokens + output_tokens,
+            },
+        }
+
+
+def _prompt_chars(body):
+    total = 0
+    for content in body.get("contents", []):
+        for part in content.get("parts", []):
+            total += len(part.get("text", ""))
+    return total
+
+
+def _wants_json(body):
+    config = body.get("generationConfig") or body.get("generation_config") or {}
+    return (config.get("responseMimeType") or config.get("response_mime_type")) == "application/json"
+
+
+def _split(text, chunks):
+    words = text.split(" ")
+    size = max(1, len(words) // chunks)
+    return [" ".join(words[i:i + size]) + " " for i in range(0, len(words), size)]
+
+
+def make_handler(fake):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *_):
+            pass
+
+        def _send(self, status, payload):
+            body = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json; charset=UTF-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == "/stats":
+                return self._send(200, fake.counts)
+            self._send(404, {"error": {"code": 404, "message": "Not found", "status": "NOT_FOUND"}})
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+            match = _PATH.match(self.path)
+            if not match:
+                return self._send(404, {"error": {"code": 404, "message": "Not found", "status": "NOT_FOUND"}})
+            fake._count("requests")
+            time.sleep(fake.delay())
+            error = fake.error()
+            if error:
+                code, status, message = error
+                return self._send(code, {"error": {"code": code, "message": message, "status": status}})
+
+            prompt_chars = _prompt_chars(body)
+            if match.group("method") == "generateContent":
+                return self._send(200, fake.response(fake.next_text(_wants_json(body)), prompt_chars))
+
+            # streamGenerateContent: arreglo JSON enviado por trozos
+            pieces = _split(fake.next_text(), fake.chunks)
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json; charset=UTF-8")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for i, piece in enumerate(pieces):
+                data = ("[" if i == 0 else ",") + json.dumps(fake.response(piece, prompt_chars))
+                if i == len(pieces) - 1:
+                    data += "]"
+                raw = data.encode("utf-8")
+                self.wfile.write(f"{len(raw):x}\r\n".encode() + raw + b"\r\n")
+                self.wfile.flush()
+                time.sleep(fake.latency_ms / 1000 / fake.chunks)
+            self.wfile.write(b"0\r\n\r\n")
+
+    return Handler
+
+
+# ===== SUSTITUTO EN PROCESO =====
+class FakeAPIError(Exception):
+    """Como google.api_core.exceptions: el código HTTP en `code`."""
+
+    def __init__(self, code, message):
+        super().__init__(f"{code} {message}")
+        self.code = code
+
+
+class _Usage:
+    def __init__(self, prompt_tokens, output_tokens):
+        self.prompt_token_count = prompt_tokens
+        self.candidates_token_count = output_tokens
+        self.total_token_count = prompt_tokens + output_tokens
+
+
+class _Response:
+    def __init__(self, fake, text, prompt_chars):
+        data = fake.response(text, prompt_chars)["usageMetadata"]
+        self.text = text
+        self.usage_metadata = _Usage(data["promptTokenCount"], data["candidatesTokenCount"])
+
+
+def _contents_chars(contents):
+    items = contents if isinstance(contents, list) else [contents]
+    return sum(len(item) for item in items if isinstance(item, str))
+
+
+def _is_json_mode(generation_config):
+    return (generation_config or {}).get("response_mime_type") == "application/json"
+
+
+class FakeModel:
+    """Sustituto de genai.GenerativeModel con el comportamiento de `fake`."""
+
+    def __init__(self, fake=None):
+        self.fake = fake or FakeGemini()
+
+    def _before_call(self):
+        self.fake._count("requests")
+        return self.fake.delay()
+
+    def _raise_if_error(self):
+        error = self.fake.error()
+        if error:
+            raise FakeAPIError(error[0], error[2])
+
+    def _json_mode(self, contents, generation_config):
+        # Las partes de archivo (análisis/OCR) piden JSON en el prompt
+        return _is_json_mode(generation_config) or isinstance(contents, list)
+
+    def generate_content(self, contents, stream=False, generation_config=None, **_):
+        time.sleep(self._before_call())
+        self._raise_if_error()
+        prompt_chars = _contents_chars(contents)
+        if not stream:
+            return _Response(self.fake, self.fake.next_text(self._json_mode(contents, generation_config)), prompt_chars)
+        return self._stream(self.fake.next_text(), prompt_chars)
+
+    def _stream(self, text, prompt_chars):
+        for piece in _split(text, self.fake.chunks):
+            yield _Response(self.fake, piece, prompt_chars)
+            time.sleep(self.fake.latency_ms / 1000 / self.fake.chunks)
+
+    async def generate_content_async(self, contents, generation_config=None, **_):
+        await asyncio.sleep(self._before_call())
+        self._raise_if_error()
+        text = self.fake.next_text(self._json_mode(contents, generation_config))
+        return _Response(self.fake, text, _contents_chars(contents))
+
+    def sdk(self):
+        return _FakeSDK()
+
+
+class _FakeSDK:
+    """Lo que uploads.gemini_part usa del módulo genai; solo sirve para archivos inline."""
+
+    def upload_file(self, **_):
+        raise RuntimeError("FakeModel no implementa la File API (usa archivos de menos de GEMINI_INLINE_MAX_MB)")
+
+    get_file = delete_file = upload_file
+
+
+def serve(fake=None, host="127.0.0.1", port=8089):
+    """Arranca el servidor en un hilo y lo devuelve (server.shutdown() para pararlo)."""
+    fake = fake or FakeGemini()
+    server = ThreadingHTTPServer((host, port), make_handler(fake))
+    server.daemon_threads = True
+    server.fake = fake
+    threading.Thread(target=server.serve_forever, name="fake-gemini", daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--latency-ms", type=float, default=200)
+    parser.add_argument("--jitter-ms", type=float, default=50)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--slow-rate", type=float, default=0.0)
+    parser.add_argument("--slow-ms", type=float, default=5000)
+    parser.add_argument("--down", action="store_true")
+    args = parser.parse_args()
+
+    fake = FakeGemini(latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, error_rate=args.error_rate,
+                      slow_rate=args.slow_rate, slow_ms=args.slow_ms, down=args.down)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(fake))
+    server.daemon_threads = True
+    print(f"Gemini falso en http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,451 @@
+"""
+Prueba de carga sin red: levanta la app Flask de server_combined en un hilo
+con Gemini, Whisper y gTTS simulados, recorre las rutas /api/ai/* con la
+concurrencia pedida y escribe un JSON comparable entre commits.
+
+    python benchmarks/load_test.py --concurrency 8 --requests 100 --output bench.json
+    python benchmarks/load_test.py --routes doctor,voice_session --compare bench.json
+
+Backends:
+  --gemini stub   FakeModel en proceso (por defecto; no necesita el SDK)
+  --gemini http   SDK real contra benchmarks/fake_gemini.py (transporte REST)
+  --whisper stub  módulo `whisper` falso con latencia proporcional al audio
+  --whisper tiny  Whisper real con el modelo tiny (requiere torch)
+  TTS             módulo `gtts` falso con latencia fija (la caché de TTS sigue activa)
+
+Por ruta mide req/s, latencia p50/p95/p99 (y tiempo al primer byte en las
+rutas en streaming), tasa de errores y crecimiento de RSS del proceso. Con
+--compare falla (código 1) si alguna ruta empeora su p95 o sus req/s más de
+--max-regression respecto al JSON anterior.
+
+Requiere las dependencias del servidor (Flask, numpy, Pillow, requests).
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+import wave
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fake_gemini  # noqa: E402
+
+FAKE_GEMINI_PORT = 8096
+SAMPLE_RATE = 16000
+
+
+# ===== BACKENDS SIMULADOS =====
+def install_fake_whisper(seconds_per_audio_second):
+    """Módulo `whisper` falso: load_model() devuelve un modelo que tarda según la duración del audio."""
+    class FakeWhisperModel:
+        def parameters(self):
+            return []
+
+        def transcribe(self, audio, **_):
+            time.sleep(len(audio) / SAMPLE_RATE * seconds_per_audio_second)
+            return {"text": " Me duele la cabeza desde hace tres días."}
+
+    module = types.ModuleType("whisper")
+    module.load_model = lambda size: FakeWhisperModel()
+    sys.modules["whisper"] = module
+
+
+def install_fake_gtts(latency_ms):
+    """Módulo `gtts` falso: MP3 de relleno proporcional al texto."""
+    class gTTS:
+        def __init__(self, text, lang="es", tld="com"):
+            self.text = text
+
+        def write_to_fp(self, fp):
+            time.sleep(latency_ms / 1000)
+            fp.write(b"ID3" + b"\x00" * (len(self.text) * 64))
+
+    module = types.ModuleType("gtts")
+    module.gTTS = gTTS
+    sys.modules["gtts"] = module
+
+
+def configure_environment(args):
+    """Variables que deben estar antes de importar server_combined."""
+    scratch = tempfile.mkdtemp(prefix="iamed_load_")
+    os.environ.setdefault("GOOGLE_GEMINI_API_KEY", "fake")
+    os.environ["WARMUP_MODE"] = "off"
+    os.environ.setdefault("SCRATCH_DIR", scratch)
+    os.environ.setdefault("JOBS_DB_PATH", os.path.join(scratch, "jobs.sqlite3"))
+    os.environ.setdefault("SESSION_DB_PATH", os.path.join(scratch, "sessions.sqlite3"))
+    if args.whisper == "stub":
+        # Los procesos hijos del pool no verían el módulo falso
+        os.environ["WHISPER_POOL_WORKERS"] = "0"
+        install_fake_whisper(args.whisper_rtf)
+    else:
+        os.environ["WHISPER_MODEL"] = args.whisper
+    install_fake_gtts(args.tts_latency_ms)
+
+    fake = fake_gemini.FakeGemini(latency_ms=args.gemini_latency_ms, jitter_ms=args.gemini_latency_ms / 5,
+                                  error_rate=args.gemini_error_rate)
+    if args.gemini == "http":
+        fake_gemini.serve(fake, port=FAKE_GEMINI_PORT)
+        os.environ["GEMINI_API_ENDPOINT"] = f"http://127.0.0.1:{FAKE_GEMINI_PORT}"
+    return fake
+
+
+def start_app(fake, gemini_backend):
+    import server_combined as sc
+    from werkzeug.serving import make_server
+
+    if gemini_backend == "stub":
+        # El cliente resiliente se mantiene; solo cambia el modelo de debajo
+        sc.gemini_model.model = fake_gemini.FakeModel(fake)
+    server = make_server("127.0.0.1", 0, sc.app, threaded=True)
+    threading.Thread(target=server.serve_forever, name="load-test-app", daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+# ===== DATOS DE PRUEBA =====
+def wav_bytes(seconds=3.0):
+    """Tono modulado (pasa el VAD como voz) en WAV PCM 16 bits, 16 kHz."""
+    import math
+    frames = bytearray()
+    for i in range(int(seconds * SAMPLE_RATE)):
+        envelope = 0.5 + 0.5 * math.sin(2 * math.pi * 3 * i / SAMPLE_RATE)
+        value = int(8000 * envelope * math.sin(2 * math.pi * 220 * i / SAMPLE_RATE))
+        frames += struct.pack("<h", value)
+    buf = io.BytesIO()
+    with wave.open(buf, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(SAMPLE_RATE)
+        wav.writeframes(bytes(frames))
+    return buf.getvalue()
+
+
+def png_bytes(width=64, height=64):
+    """PNG RGB mínimo generado sin Pillow."""
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF)
+    # Cada fila empieza con el byte de filtro 0 y sigue con píxeles RGB (degradado)
+    rows = b"".join(
+        b"\x00" + b"".join(bytes((x * 4 % 256, y * 4 % 256, 128)) for x in range(width))
+        for y in range(height)
+    )
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(rows)) + chunk(b"IEND", b""))
+
+
+PATIENT = {"name": "Ana", "age": "34", "sex": "F"}
+
+
+def symptoms(i):
+    # Distinto en cada petición para no medir solo aciertos de caché
+    return f"Dolor de cabeza y fiebre desde hace {i % 7 + 1} días (caso {i})"
+
+
+def patient_xml(i):
+    return (f"<request><patient><name>Ana</name><age>34</age><sex>F</sex></patient>"
+            f"<symptoms>{symptoms(i)}</symptoms><studies><study>Biometría</study></studies></request>")
+
+
+# ===== ESCENARIOS =====
+# Cada escenario hace una operación completa y devuelve (status, segundos al primer byte o None)
+def _post(session, url, stream=False, **kwargs):
+    start = time.perf_counter()
+    resp = session.post(url, stream=stream, timeout=120, **kwargs)
+    ttfb = None
+    if stream:
+        for _ in resp.iter_content(chunk_size=None):
+            if ttfb is None:
+                ttfb = time.perf_counter() - start
+    else:
+        resp.content
+    return resp.status_code, ttfb
+
+
+def doctor(s, base, i, data):
+    return _post(s, f"{base}/api/ai/doctor", data=patient_xml(i), headers={"Content-Type": "application/xml"})
+
+
+def patient(s, base, i, data):
+    return _post(s, f"{base}/api/ai/patient", json={"patient": PATIENT, "symptoms": symptoms(i), "studies": []})
+
+
+def patient_stream(s, base, i, data):
+    return _post(s, f"{base}/api/ai/patient/stream", stream=True,
+                 json={"patient": PATIENT, "symptoms": symptoms(i), "studies": []})
+
+
+def interaction(s, base, i, data):
+    return _post(s, f"{base}/api/ai/interaction",
+                 json={"session_id": f"load-{i % 16}", "message": symptoms(i)})
+
+
+def interaction_xml(s, base, i, data):
+    body = f"<request><session_id>load-{i % 16}</session_id><message>{symptoms(i)}</message></request>"
+    return _post(s, f"{base}/api/ai/interaction-xml", data=body, headers={"Content-Type": "application/xml"})
+
+
+def interaction_stream(s, base, i, data):
+    return _post(s, f"{base}/api/ai/interaction/stream", stream=True,
+                 json={"session_id": f"load-{i % 16}", "message": symptoms(i)})
+
+
+def conclusion(s, base, i, data):
+    return _post(s, f"{base}/api/ai/conclusion", json={"session_id": f"load-{i % 16}"})
+
+
+def file_analyze_json(s, base, i, data):
+    return _post(s, f"{base}/api/ai/file/analyze_json", files={"file": ("lab.png", data["png"], "image/png")},
+                 data={"instructions": f"Resume (caso {i})"})
+
+
+def file_analyze_xml(s, base, i, data):
+    return _post(s, f"{base}/api/ai/file/analyze_xml", files={"file": ("lab.png", data["png"], "image/png")},
+                 data={"instructions": f"Resume (caso {i})"})
+
+
+def text_to_speech(s, base, i, data):
+    return _post(s, f"{base}/api/ai/text-to-speech", json={"text": symptoms(i)})
+
+
+def text_to_speech_stream(s, base, i, data):
+    return _post(s, f"{base}/api/ai/text-to-speech/stream", stream=True,
+                 json={"text": f"{symptoms(i)}. Toma líquidos. Descansa."})
+
+
+def speech_to_text(s, base, i, data):
+    return _post(s, f"{base}/api/ai/speech-to-text", files={"file": ("voz.wav", data["wav"], "audio/wav")})
+
+
+def dictation(s, base, i, data):
+    """Dictado completo: abrir, dos segmentos y cierre."""
+    resp = s.post(f"{base}/api/ai/speech-to-text/stream", json={}, timeout=120)
+    if resp.status_code != 200:
+        return resp.status_code, None
+    dictation_id = resp.json()["dictation_id"]
+    status = resp.status_code
+    for seq in range(3):
+        status, _ = _post(s, f"{base}/api/ai/speech-to-text/stream/{dictation_id}",
+                          files={"file": ("seg.wav", data["wav"], "audio/wav")},
+                          data={"seq": str(seq), "final": "1" if seq == 2 else "0"})
+        if status >= 400:
+            break
+    return status, None
+
+
+def voice_session(s, base, i, data):
+    return _post(s, f"{base}/api/ai/voice-session", files={"file": ("voz.wav", data["wav"], "audio/wav")})
+
+
+def voice_session_xml(s, base, i, data):
+    return _post(s, f"{base}/api/ai/voice-session-xml", files={"file": ("voz.wav", data["wav"], "audio/wav")})
+
+
+def voice_session_stream(s, base, i, data):
+    return _post(s, f"{base}/api/ai/voice-session/stream", stream=True,
+                 files={"file": ("voz.wav", data["wav"], "audio/wav")})
+
+
+def voice_session_audio_stream(s, base, i, data):
+    return _post(s, f"{base}/api/ai/voice-session/audio-stream", stream=True,
+                 files={"file": ("voz.wav", data["wav"], "audio/wav")})
+
+
+# En este orden: conclusion necesita el historial que deja interaction
+SCENARIOS = {f.__name__: f for f in (
+    doctor, patient, patient_stream, interaction, interaction_xml, interaction_stream, conclusion,
+    file_analyze_json, file_analyze_xml, text_to_speech, text_to_speech_stream, speech_to_text,
+    dictation, voice_session, voice_session_xml, voice_session_stream, voice_session_audio_stream,
+)}
+
+
+# ===== MEDICIÓN =====
+def rss_mb():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except Exception:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def percentiles(values):
+    if not values:
+        return {}
+    values = sorted(values)
+    pick = lambda q: values[min(len(values) - 1, int(len(values) * q))]  # noqa: E731
+    return {
+        "p50": round(pick(0.5) * 1000, 2),
+        "p95": round(pick(0.95) * 1000, 2),
+        "p99": round(pick(0.99) * 1000, 2),
+        "mean": round(sum(values) / len(values) * 1000, 2),
+    }
+
+
+def run_scenario(name, fn, base, data, requests_count, concurrency):
+    import requests
+
+    local = threading.local()
+    latencies, ttfbs, errors = [], [], []
+    lock = threading.Lock()
+
+    def one(i):
+        session = getattr(local, "session", None)
+        if session is None:
+            session = local.session = requests.Session()
+        start = time.perf_counter()
+        try:
+            status, ttfb = fn(session, base, i, data)
+            error = f"HTTP {status}" if status >= 400 else None
+        except Exception as e:
+            ttfb, error = None, f"{e.__class__.__name__}: {e}"
+        elapsed = time.perf_counter() - start
+        with lock:
+            latencies.append(elapsed)
+            if ttfb is not None:
+                ttfbs.append(ttfb)
+            if error:
+                errors.append(error)
+
+    rss_before = rss_mb()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one, range(requests_count)))
+    wall = time.perf_counter() - started
+
+    result = {
+        "requests": requests_count,
+        "errors": len(errors),
+        "error_rate": round(len(errors) / requests_count, 4),
+        "rps": round(requests_count / wall, 2),
+        "latency_ms": percentiles(latencies),
+        "rss_delta_mb": round(rss_mb() - rss_before, 1),
+    }
+    if ttfbs:
+        result["ttfb_ms"] = percentiles(ttfbs)
+    if errors:
+        result["sample_errors"] = sorted(set(errors))[:3]
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def compare(current, baseline, max_regression):
+    """Imprime la comparación y devuelve las rutas que empeoraron más de max_regression."""
+    regressions = []
+    print(f"\n{'ruta':<28} {'p95 antes':>10} {'p95 ahora':>10} {'req/s antes':>12} {'req/s ahora':>12}")
+    for name, now in current["routes"].items():
+        before = baseline.get("routes", {}).get(name)
+        if not before or not before.get("latency_ms") or not now.get("latency_ms"):
+            continue
+        p95_old, p95_new = before["latency_ms"]["p95"], now["latency_ms"]["p95"]
+        rps_old, rps_new = before["rps"], now["rps"]
+        flag = ""
+        if p95_new > p95_old * (1 + max_regression) or rps_new < rps_old * (1 - max_regression) \
+                or now["error_rate"] > before["error_rate"] + 0.01:
+            regressions.append(name)
+            flag = "  ⚠️"
+        print(f"{name:<28} {p95_old:10.1f} {p95_new:10.1f} {rps_old:12.1f} {rps_new:12.1f}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--requests", type=int, default=40, help="peticiones por ruta")
+    parser.add_argument("--routes", default="", help="escenarios separados por coma (por defecto, todos)")
+    parser.add_argument("--gemini", choices=("stub", "http"), default="stub")
+    parser.add_argument("--gemini-latency-ms", type=float, default=300)
+    parser.add_argument("--gemini-error-rate", type=float, default=0.0)
+    parser.add_argument("--whisper", default="stub", help="stub o un tamaño de modelo real (tiny)")
+    parser.add_argument("--whisper-rtf", type=float, default=0.05,
+                        help="segundos de transcripción simulada por segundo de audio")
+    parser.add_argument("--tts-latency-ms", type=float, default=150)
+    parser.add_argument("--audio-seconds", type=float, default=3.0)
+    parser.add_argument("--output", help="archivo JSON de resultados")
+    parser.add_argument("--compare", help="JSON de una corrida anterior")
+    parser.add_argument("--max-regression", type=float, default=0.25)
+    args = parser.parse_args()
+
+    names = [n.strip() for n in args.routes.split(",") if n.strip()] or list(SCENARIOS)
+    unknown = [n for n in names if n not in SCENARIOS]
+    if unknown:
+        parser.error(f"escenarios desconocidos: {', '.join(unknown)} (disponibles: {', '.join(SCENARIOS)})")
+
+    fake = configure_environment(args)
+    rss_start = rss_mb()
+    server, base = start_app(fake, args.gemini)
+    data = {"wav": wav_bytes(args.audio_seconds), "png": png_bytes()}
+    rss_ready = rss_mb()
+
+    results = {}
+    print(f"{'ruta':<28} {'req/s':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'errores':>8} {'RSS +MB':>8}")
+    for name in names:
+        r = run_scenario(name, SCENARIOS[name], base, data, args.requests, args.concurrency)
+        results[name] = r
+        lat = r["latency_ms"]
+        print(f"{name:<28} {r['rps']:8.1f} {lat['p50']:9.1f} {lat['p95']:9.1f} {lat['p99']:9.1f} "
+              f"{r['error_rate']:8.1%} {r['rss_delta_mb']:8.1f}")
+        for error in r.get("sample_errors", []):
+            print(f"    {error}")
+    server.shutdown()
+
+    rss_end = rss_mb()
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "concurrency": args.concurrency,
+            "requests_per_route": args.requests,
+            "backends": {
+                "gemini": args.gemini, "gemini_latency_ms": args.gemini_latency_ms,
+                "gemini_error_rate": args.gemini_error_rate,
+                "whisper": args.whisper, "whisper_rtf": args.whisper_rtf,
+                "tts_latency_ms": args.tts_latency_ms, "audio_seconds": args.audio_seconds,
+            },
+        },
+        "routes": results,
+        "rss_mb": {
+            "start": round(rss_start, 1),
+            "after_startup": round(rss_ready, 1),
+            "end": round(rss_end, 1),
+            "growth_under_load": round(rss_end - rss_ready, 1),
+        },
+        "fake_gemini": dict(fake.counts),
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"\nResultados en {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get("meta", {}).get("backends") != report["meta"]["backends"]:
+            print("⚠️ La corrida anterior usó otros backends; la comparación es orientativa")
+        regressions = compare(report, baseline, args.max_regression)
+        if regressions:
+            print(f"\nEmpeoraron más de {args.max_regression:.0%}: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""
+Micro-benchmark de xml_codec frente a las funciones XML anteriores
+(ElementTree: árbol completo + tostring).
+
+    python benchmarks/xml_codec_bench.py [--items 2000] [--repeat 20]
+
+Genera una respuesta de analizador grande (tablas de laboratorio anidadas)
+y una petición de paciente, y mide parseo y serialización. No necesita
+Flask ni credenciales.
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+import xml.etree.ElementTree as ET
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import xml_codec  # noqa: E402
+
+
+# ===== IMPLEMENTACIONES ANTERIORES (copiadas de server_combined) =====
+def legacy_parse_xml_body(raw):
+    try:
+        root = ET.fromstring(raw.decode("utf-8"))
+        data = {}
+        for child in root:
+            if child.tag == "patient":
+                data["patient"] = {}
+                for patient_child in child:
+                    data["patient"][patient_child.tag] = patient_child.text
+            elif child.tag == "studies":
+                data["studies"] = [study.text for study in child.findall("study")]
+            else:
+                data[child.tag] = child.text
+        return data
+    except Exception:
+        return {}
+
+
+def legacy_build_xml(data):
+    root = ET.Element("response")
+
+    def build_xml(parent, obj, item_tag="item"):
+        if isinstance(obj, dict):
+            for k, v in obj.items():
+                child = ET.SubElement(parent, str(k))
+                build_xml(child, v, item_tag=item_tag)
+        elif isinstance(obj, list):
+            for it in obj:
+                child = ET.SubElement(parent, item_tag)
+                build_xml(child, it, item_tag=item_tag)
+        else:
+            parent.text = "" if obj is None else str(obj)
+    build_xml(root, data)
+    return ET.tostring(root, encoding="unicode")
+
+
+# ===== DATOS =====
+def analyzer_payload(items):
+    return {
+        "filename": "laboratorio.pdf",
+        "mime_type": "application/pdf",
+        "resumen": "Biometría hemática y química sanguínea. " * 20,
+        "tablas": [
+            {
+                "analito": f"Analito {i}",
+                "valor": round(i * 1.37, 2),
+                "unidad": "mg/dL",
+                "rango": {"min": 10, "max": 100},
+                "nota": "Dentro de rango" if i % 3 else "Fuera de rango <revisar>",
+            }
+            for i in range(items)
+        ],
+        "hallazgos": [f"Hallazgo {i}: valor & tendencia" for i in range(items // 10)],
+    }
+
+
+def patient_request(studies):
+    body = "".join(f"<study>Estudio {i}</study>" for i in range(studies))
+    return (
+        "<request><patient><name>Ana</name><age>34</age><sex>F</sex></patient>"
+        "<symptoms>Dolor de cabeza y fiebre desde hace tres días</symptoms>"
+        f"<studies>{body}</studies></request>"
+    ).encode("utf-8")
+
+
+# ===== MEDICIÓN =====
+def measure(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return statistics.median(times) * 1000, peak / 1024
+
+
+def report(name, legacy, new):
+    (t_old, m_old), (t_new, m_new) = legacy, new
+    print(f"{name:<28} {t_old:9.2f} ms {m_old:9.0f} KB   {t_new:9.2f} ms {m_new:9.0f} KB   x{t_old / t_new:5.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--items", type=int, default=2000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    payload = analyzer_payload(args.items)
+    xml_payload = legacy_build_xml(payload).encode("utf-8")
+    request_body = patient_request(args.items // 10)
+
+    print(f"backend={xml_codec.XML_BACKEND}  analizador={len(xml_payload) / 1024:.0f} KB  "
+          f"petición={len(request_body) / 1024:.1f} KB")
+    print(f"{'':<28} {'anterior':>22}   {'xml_codec':>22}")
+
+    report("serializar analizador",
+           measure(lambda: legacy_build_xml(payload), args.repeat),
+           measure(lambda: xml_codec.dumps(payload), args.repeat))
+    report("serializar (streaming)",
+           measure(lambda: legacy_build_xml(payload), args.repeat),
+           measure(lambda: sum(len(c) for c in xml_codec.iter_serialize(payload)), args.repeat))
+    report("parsear petición paciente",
+           measure(lambda: legacy_parse_xml_body(request_body), args.repeat),
+           measure(lambda: xml_codec.parse(request_body), args.repeat))
+    # El código anterior solo construía el árbol (sin dict) para estos tamaños
+    report("parsear analizador (ET)",
+           measure(lambda: ET.fromstring(xml_payload), args.repeat),
+           measure(lambda: xml_codec.parse(xml_payload, max_bytes=len(xml_payload)), args.repeat))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+Respuesta y resumen clínico en una sola llamada a Gemini.
+
+Por defecto cada turno hace dos llamadas seguidas: la respuesta y luego el
+resumen de esa respuesta. Con COMBINED_REPLY=1 se pide un único JSON
+{"response": ..., "summary": ...} (response_mime_type=application/json),
+se valida contra SCHEMA y, si no se puede leer, la ruta vuelve al camino de
+dos llamadas. benchmarks/combined_reply_bench.py compara ambos modos.
+
+No se usa en los endpoints /stream: ahí el texto se envía token a token y un
+JSON a medio generar no se puede mostrar.
+"""
+import json
+import os
+import threading
+
+COMBINED_REPLY = os.getenv("COMBINED_REPLY", "0") == "1"
+
+SCHEMA = {
+    "type": "object",
+    "properties": {
+        "response": {"type": "string"},
+        "summary": {"type": "string"},
+    },
+    "required": ["response", "summary"],
+}
+GENERATION_CONFIG = {"response_mime_type": "application/json"}
+
+_stats = {"combined": 0, "fallbacks": 0}
+_stats_lock = threading.Lock()
+
+
+def _count(name):
+    with _stats_lock:
+        _stats[name] += 1
+
+
+def build_prompt(prompt, summary_instruction):
+    """Añade al prompt de la respuesta las instrucciones del resumen y del formato JSON."""
+    return f"""{prompt}
+
+Devuelve SOLO un objeto JSON con esta forma, sin texto adicional:
+{{"response": "<tu respuesta al paciente, tal como la escribirías>",
+ "summary": "<{summary_instruction}>"}}
+"""
+
+
+def parse(text):
+    """{"response", "summary"} validado contra SCHEMA; lanza ValueError si no cumple."""
+    cleaned = (text or "").strip()
+    if cleaned.startswith("```"):
+        cleaned = cleaned.strip("`").removeprefix("json").strip()
+    data = json.loads(cleaned)
+    if not isinstance(data, dict):
+        raise ValueError("La respuesta no es un objeto JSON")
+    for key in SCHEMA["required"]:
+        value = data.get(key)
+        if not isinstance(value, str) or not value.strip():
+            raise ValueError(f"Falta '{key}' en la respuesta")
+    return {key: data[key].strip() for key in SCHEMA["properties"]}
+
+
+def _parsed_or_none(resp):
+    try:
+        result = parse(resp.text)
+    except ValueError as e:
+        # json.JSONDecodeError también es ValueError; resp.text lo lanza si no hay texto
+        print("⚠️ Respuesta combinada inválida, se usan dos llamadas:", e)
+        _count("fallbacks")
+        return None
+    _count("combined")
+    return result
+
+
+def generate(model, prompt, summary_instruction):
+    """
+    Una llamada que devuelve {"response", "summary"}, o None si Gemini no
+    devolvió un JSON válido (el llamador hace entonces las dos llamadas).
+    Los errores de la llamada en sí se propagan igual que en generate_text.
+    """
+    resp = model.generate_content(build_prompt(prompt, summary_instruction), generation_config=GENERATION_CONFIG)
+    return _parsed_or_none(resp)
+
+
+async def generate_async(model, prompt, summary_instruction):
+    resp = await model.generate_content_async(build_prompt(prompt, summary_instruction),
+                                              generation_config=GENERATION_CONFIG)
+    return _parsed_or_none(resp)
+
+
+def stats():
+    with _stats_lock:
+        return {"enabled": COMBINED_REPLY, **_stats}
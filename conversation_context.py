@@ -0,0 +1,116 @@
+"""
+Contexto de conversación con tamaño acotado.
+
+Los últimos CONTEXT_KEEP_MESSAGES mensajes van literales en el prompt; los
+anteriores se van integrando en un resumen acumulado que se actualiza en
+segundo plano. Así el prompt de cada turno no crece con la duración de la
+sesión y la conclusión final parte del resumen en vez de releer todo.
+"""
+import os
+import threading
+
+import pipeline
+
+CONTEXT_KEEP_MESSAGES = int(os.getenv("CONTEXT_KEEP_MESSAGES", "8"))
+# Se resume por bloques para no llamar al modelo en cada turno
+CONTEXT_FOLD_MIN_MESSAGES = int(os.getenv("CONTEXT_FOLD_MIN_MESSAGES", "4"))
+
+FOLD_PROMPT = """
+Eres un médico que mantiene una nota clínica acumulada de una consulta en curso.
+Actualiza la nota integrando los mensajes nuevos. Conserva motivo de consulta,
+síntomas, datos relevantes del paciente y lo que ya se le indicó. Máximo 10 líneas.
+
+Nota actual:
+{summary}
+
+Mensajes nuevos:
+{messages}
+"""
+
+
+def format_messages(messages):
+    return "\n".join(f"{m['role']}: {m['content']}" for m in messages)
+
+
+class ConversationContext:
+
+    def __init__(self, store, summarize, keep_last=CONTEXT_KEEP_MESSAGES,
+                 fold_min=CONTEXT_FOLD_MIN_MESSAGES):
+        """`summarize(prompt) -> str` es la llamada al modelo."""
+        self.store = store
+        self.summarize = summarize
+        self.keep_last = keep_last
+        self.fold_min = fold_min
+        self._folding = set()
+        self._lock = threading.Lock()
+
+    def _window(self, session_id):
+        """
+        (resumen, índice_del_primer_pendiente, mensajes_pendientes, perdidos):
+        los mensajes aún guardados que el resumen todavía no cubre, y cuántos
+        sin resumir recortó el almacén (solo pasa al llegar a su tope duro).
+        """
+        summary, folded = self.store.get_summary(session_id)
+        history = self.store.history(session_id)
+        first_index = self.store.count(session_id) - len(history)
+        skip = max(0, folded - first_index)
+        return summary, first_index + skip, history[skip:], max(0, first_index - folded)
+
+    def build(self, session_id, exclude_last=0):
+        """
+        Texto de contexto: resumen acumulado + mensajes recientes literales.
+        `exclude_last` omite los últimos mensajes (p.ej. el que se está respondiendo).
+        """
+        summary, _, pending, _ = self._window(session_id)
+        if exclude_last:
+            pending = pending[:-exclude_last]
+        recent = pending[-self.keep_last:] if self.keep_last else []
+        # Los anteriores a `recent` aún no están en el resumen (el plegado en
+        # segundo plano no ha terminado), así que también van literales
+        older = pending[:len(pending) - len(recent)]
+        parts = []
+        if summary:
+            parts.append(f"Resumen de la conversación previa:\n{summary}")
+        if older:
+            parts.append(format_messages(older))
+        if recent:
+            parts.append(format_messages(recent))
+        return "\n".join(parts)
+
+    def full_summary(self, session_id):
+        """Resumen acumulado + todo lo no resumido, para la conclusión final."""
+        return self.build(session_id)
+
+    def maybe_fold(self, session_id):
+        """Lanza en segundo plano el plegado si hay suficientes mensajes antiguos."""
+        _, _, pending, _ = self._window(session_id)
+        to_fold = pending[:-self.keep_last] if self.keep_last else pending
+        if len(to_fold) < self.fold_min:
+            return None
+        with self._lock:
+            if session_id in self._folding:
+                return None
+            self._folding.add(session_id)
+        return pipeline.submit_background(self._fold, session_id)
+
+    def _fold(self, session_id):
+        try:
+            summary, start, pending, lost = self._window(session_id)
+            to_fold = pending[:-self.keep_last] if self.keep_last else pending
+            if not to_fold:
+                return
+            messages = format_messages(to_fold)
+            if lost:
+                # El resumen los dará por cubiertos: que al menos conste el hueco
+                messages = f"({lost} mensajes anteriores se descartaron sin resumir)\n{messages}"
+            new_summary = self.summarize(FOLD_PROMPT.format(
+                summary=summary or "(vacía)",
+                messages=messages,
+            ))
+            if new_summary:
+                self.store.set_summary(session_id, new_summary, start + len(to_fold))
+        except Exception as e:
+            print("⚠️ No se pudo actualizar el resumen de la sesión:", e)
+        finally:
+            with self._lock:
+                self._folding.discard(session_id)
@@ -0,0 +1,164 @@
+"""
+Dictado en vivo: transcripción por segmentos.
+
+El cliente abre un dictado y sube el audio en segmentos mientras el paciente
+sigue hablando (p.ej. un MediaRecorder que se reinicia cada pocos segundos).
+Cada segmento se transcribe en cuanto llega, así la transcripción se solapa
+con el habla y al terminar solo falta el último trozo.
+
+- El texto ya transcrito (su final) va como `initial_prompt` de Whisper para
+  mantener la continuidad de vocabulario, mayúsculas y puntuación.
+- El final de cada segmento se corta en la pausa más marcada y se antepone
+  al siguiente, para no partir palabras a la mitad.
+- Los segmentos de un mismo dictado se procesan en orden (`seq`); uno que
+  llega antes de tiempo espera al anterior.
+
+Un segmento solo se da por procesado si su transcripción salió bien: tras un
+503 (WhisperBusy) el cliente reintenta con el mismo `seq` y no se pierde audio.
+
+Los dictados viven en memoria del proceso y expiran tras DICTATION_TTL_SECONDS
+sin actividad. El audio pendiente (`_carry`) y el orden de los segmentos no se
+comparten entre procesos, así que todos los segmentos de un dictado deben
+llegar al mismo worker: un solo worker de gunicorn (con hilos) o sesiones
+pegajosas en el balanceador. En Vercel cada invocación puede caer en una
+instancia distinta y el dictado responde 404; ahí usar /api/ai/speech-to-text.
+"""
+import os
+import threading
+import time
+import uuid
+
+import metrics
+import startup
+import voice_activity
+import whisper_pool
+
+DICTATION_TTL_SECONDS = int(os.getenv("DICTATION_TTL_SECONDS", "600"))
+# Whisper solo usa ~224 tokens de contexto previo; el final del texto basta
+DICTATION_PROMPT_CHARS = int(os.getenv("DICTATION_PROMPT_CHARS", "400"))
+DICTATION_CARRY_SECONDS = float(os.getenv("DICTATION_CARRY_SECONDS", "1.0"))
+DICTATION_ORDER_TIMEOUT_SECONDS = float(os.getenv("DICTATION_ORDER_TIMEOUT_SECONDS", "30"))
+
+
+class DictationError(Exception):
+    """Segmento repetido o que no llegó en orden a tiempo."""
+
+
+class Dictation:
+
+    def __init__(self, language="es"):
+        self.id = uuid.uuid4().hex
+        self.language = language
+        self.parts = []
+        self.next_seq = 0
+        self.closed = False
+        self.last_used = time.time()
+        self.audio_seconds = 0.0
+        self._carry = None
+        self._cond = threading.Condition()
+
+    @property
+    def transcript(self):
+        return " ".join(self.parts)
+
+    def _options(self):
+        options = {"language": self.language}
+        prompt = self.transcript[-DICTATION_PROMPT_CHARS:]
+        if prompt:
+            options["initial_prompt"] = prompt
+        return options
+
+    def add(self, samples=None, seq=None, final=False):
+        """
+        Transcribe un segmento (float32 mono 16 kHz, o None para solo cerrar)
+        y devuelve el parcial. Puede lanzar DictationError o WhisperBusy.
+        """
+        np = startup.lazy_import("numpy")
+        with self._cond:
+            if seq is None:
+                seq = self.next_seq
+            if not self._cond.wait_for(lambda: self.next_seq >= seq or self.closed,
+                                       timeout=DICTATION_ORDER_TIMEOUT_SECONDS):
+                raise DictationError(f"Falta el segmento {self.next_seq}")
+            if self.closed or seq < self.next_seq:
+                raise DictationError(f"Segmento {seq} repetido o dictado cerrado")
+
+            self.last_used = time.time()
+            parts = [a for a in (self._carry, samples) if a is not None and len(a)]
+            audio = np.concatenate(parts) if parts else np.zeros(0, dtype=np.float32)
+            carry = None
+            if not final:
+                audio, carry = voice_activity.split_at_pause(audio, DICTATION_CARRY_SECONDS)
+
+            with metrics.span("vad"):
+                prepared = voice_activity.prepare(audio)
+            text = ""
+            if not prepared.is_empty:
+                with metrics.span("whisper"):
+                    texts = whisper_pool.transcribe_many(prepared.chunks, **self._options())
+                text = " ".join(t.strip() for t in texts).strip()
+
+            # Solo ahora se confirma el segmento: si algo de arriba lanzó, el
+            # reintento con el mismo `seq` encuentra el estado sin tocar
+            if text:
+                self.parts.append(text)
+            if samples is not None:
+                self.audio_seconds += len(samples) / voice_activity.SAMPLE_RATE
+            self._carry = carry
+            self.next_seq = seq + 1
+            self.closed = final
+            self._cond.notify_all()
+
+            return {
+                "dictation_id": self.id,
+                "seq": seq,
+                "text": text,
+                "transcript": self.transcript,
+                "final": final,
+                "audio_seconds": round(self.audio_seconds, 2),
+                "vad": prepared.info(),
+            }
+
+
+_dictations = {}  # {id: Dictation}
+_lock = threading.Lock()
+
+
+def _sweep(now):
+    for key in [k for k, d in _dictations.items() if now - d.last_used > DICTATION_TTL_SECONDS]:
+        del _dictations[key]
+
+
+def start(language="es"):
+    """Abre un dictado y lo devuelve."""
+    dictation = Dictation(language)
+    with _lock:
+        _sweep(time.time())
+        _dictations[dictation.id] = dictation
+    return dictation
+
+
+def get(dictation_id):
+    """El dictado `dictation_id`, o None si no existe o ya expiró."""
+    with _lock:
+        _sweep(time.time())
+        return _dictations.get(dictation_id)
+
+
+def finish(dictation_id, samples=None, seq=None):
+    """
+    Transcribe el último segmento (si lo hay), cierra el dictado y lo olvida.
+    Si falla, el dictado sigue abierto para que el cliente reintente.
+    """
+    dictation = get(dictation_id)
+    if dictation is None:
+        return None
+    result = dictation.add(samples, seq=seq, final=True)
+    with _lock:
+        _dictations.pop(dictation_id, None)
+    return result
+
+
+def stats():
+    with _lock:
+        return {"active": len(_dictations)}
@@ -0,0 +1,511 @@
+"""
+Capa de resiliencia para las llamadas a Gemini.
+
+GeminiClient envuelve el modelo (LazyGeminiModel) con la misma interfaz
+(generate_content / generate_content_async), así que las rutas no cambian:
+
+- Plazo por llamada (GEMINI_TIMEOUT_SECONDS) y plazo total incluyendo
+  reintentos (GEMINI_DEADLINE_SECONDS), por debajo del límite de Vercel.
+- Reintentos con backoff exponencial y jitter completo solo para errores
+  transitorios (429, 500, 503, 504, timeouts y errores de conexión).
+- Semáforo global (GEMINI_MAX_CONCURRENCY) compartido por hilos y corrutinas:
+  si no hay hueco antes del plazo se lanza GeminiUnavailable.
+- Hedging opcional (GEMINI_HEDGE=1): si la llamada tarda más que el p95
+  reciente, se lanza una segunda idéntica y gana la primera que responda.
+- Circuit breaker: tras GEMINI_BREAKER_FAILURES fallos transitorios seguidos
+  se deja de llamar durante GEMINI_BREAKER_COOLDOWN_SECONDS y se falla al
+  instante (GeminiUnavailable → 503); pasado ese tiempo una llamada de prueba
+  decide si se cierra. Si la prueba termina sin veredicto (cancelada, sin
+  hueco en el semáforo) se libera, y si no responde en
+  GEMINI_BREAKER_PROBE_SECONDS se permite otra.
+
+En streaming solo se reintenta hasta recibir el primer fragmento; lo ya
+enviado al cliente no se puede repetir.
+
+Cada llamada queda como span "gemini_call" (o "gemini_first_chunk" en streaming)
+y sus tokens de usage_metadata se suman en metrics.
+
+Con GEMINI_API_ENDPOINT (p.ej. http://127.0.0.1:8089) el SDK usa transporte
+REST contra ese servidor; ver benchmarks/fake_gemini.py para pruebas locales.
+"""
+import asyncio
+import math
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import metrics
+
+GEMINI_API_ENDPOINT = os.getenv("GEMINI_API_ENDPOINT", "")
+GEMINI_TIMEOUT_SECONDS = float(os.getenv("GEMINI_TIMEOUT_SECONDS", "20"))
+GEMINI_STREAM_TIMEOUT_SECONDS = float(os.getenv("GEMINI_STREAM_TIMEOUT_SECONDS", "60"))
+GEMINI_DEADLINE_SECONDS = float(os.getenv("GEMINI_DEADLINE_SECONDS", "25"))
+GEMINI_MAX_RETRIES = int(os.getenv("GEMINI_MAX_RETRIES", "3"))
+GEMINI_BACKOFF_BASE_SECONDS = float(os.getenv("GEMINI_BACKOFF_BASE_SECONDS", "0.5"))
+GEMINI_BACKOFF_MAX_SECONDS = float(os.getenv("GEMINI_BACKOFF_MAX_SECONDS", "8"))
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "16"))
+GEMINI_HEDGE = os.getenv("GEMINI_HEDGE", "0") == "1"
+GEMINI_HEDGE_MIN_SECONDS = float(os.getenv("GEMINI_HEDGE_MIN_SECONDS", "2"))
+GEMINI_BREAKER_FAILURES = int(os.getenv("GEMINI_BREAKER_FAILURES", "5"))
+GEMINI_BREAKER_COOLDOWN_SECONDS = float(os.getenv("GEMINI_BREAKER_COOLDOWN_SECONDS", "30"))
+GEMINI_BREAKER_PROBE_SECONDS = float(os.getenv("GEMINI_BREAKER_PROBE_SECONDS", "60"))
+
+RETRYABLE_CODES = {429, 500, 502, 503, 504}
+# Latencias recientes para el p95 del hedging y /health
+LATENCY_WINDOW = 200
+HEDGE_MIN_SAMPLES = 20
+ASYNC_SLOT_POLL_SECONDS = 0.02
+
+
+class GeminiUnavailable(Exception):
+    """Gemini no está disponible (circuito abierto o sin hueco antes del plazo)."""
+
+
+def is_retryable(exc):
+    """Errores transitorios: códigos HTTP de google.api_core, timeouts y conexión."""
+    # OSError cubre TimeoutError/ConnectionError y los errores de red de requests (REST)
+    if isinstance(exc, (OSError, asyncio.TimeoutError)):
+        return True
+    code = getattr(exc, "code", None)
+    # google.api_core expone el código HTTP como int; grpc.RpcError como método
+    if callable(code):
+        try:
+            code = {"RESOURCE_EXHAUSTED": 429, "INTERNAL": 500, "UNAVAILABLE": 503,
+                    "DEADLINE_EXCEEDED": 504}.get(code().name)
+        except Exception:
+            code = None
+    return code in RETRYABLE_CODES
+
+
+def backoff_delay(attempt):
+    """Jitter completo: uniforme entre 0 y base * 2^intento (con tope)."""
+    return random.uniform(0, min(GEMINI_BACKOFF_MAX_SECONDS, GEMINI_BACKOFF_BASE_SECONDS * 2 ** attempt))
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class Slots:
+    """Semáforo contable usable desde hilos (acquire) y corrutinas (acquire_async)."""
+
+    def __init__(self, size):
+        self.size = size
+        self.in_use = 0
+        self._cond = threading.Condition()
+
+    def try_acquire(self):
+        with self._cond:
+            if self.in_use >= self.size:
+                return False
+            self.in_use += 1
+            return True
+
+    def acquire(self, timeout):
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self.in_use >= self.size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self._cond.wait(remaining):
+                    if self.in_use >= self.size:
+                        return False
+            self.in_use += 1
+            return True
+
+    async def acquire_async(self, timeout):
+        deadline = time.monotonic() + timeout
+        while not self.try_acquire():
+            if time.monotonic() >= deadline:
+                return False
+            await asyncio.sleep(ASYNC_SLOT_POLL_SECONDS)
+        return True
+
+    def release(self):
+        with self._cond:
+            self.in_use -= 1
+            self._cond.notify()
+
+
+PROBE = "probe"
+
+
+class CircuitBreaker:
+    """closed → open tras N fallos seguidos → half_open tras el cooldown (una prueba)."""
+
+    def __init__(self, failures=GEMINI_BREAKER_FAILURES, cooldown=GEMINI_BREAKER_COOLDOWN_SECONDS,
+                 probe_timeout=GEMINI_BREAKER_PROBE_SECONDS):
+        self.failures = failures
+        self.cooldown = cooldown
+        self.probe_timeout = probe_timeout
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.opened = 0
+        self._opened_at = 0.0
+        self._probe_started = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """
+        True si la llamada puede pasar; PROBE si es la llamada de prueba de
+        half_open, que debe terminar con success(), failure() o abandon().
+        """
+        with self._lock:
+            if self.state == "closed":
+                return True
+            now = time.monotonic()
+            if self.state == "open" and now - self._opened_at >= self.cooldown:
+                self.state = "half_open"
+            # Una prueba que no respondió a tiempo (colgada, o perdida sin
+            # abandon()) no deja el circuito en half_open para siempre
+            if self.state == "half_open" and (self._probe_started is None
+                                              or now - self._probe_started >= self.probe_timeout):
+                self._probe_started = now
+                return PROBE
+            return False
+
+    def abandon(self):
+        """La prueba terminó sin veredicto (cancelada, sin hueco): otra llamada puede probar."""
+        with self._lock:
+            if self.state == "half_open":
+                self._probe_started = None
+
+    def success(self):
+        with self._lock:
+            self.state = "closed"
+            self.consecutive_failures = 0
+            self._probe_started = None
+
+    def failure(self):
+        with self._lock:
+            self.consecutive_failures += 1
+            self._probe_started = None
+            if self.state == "half_open" or self.consecutive_failures >= self.failures:
+                if self.state != "open":
+                    self.opened += 1
+                self.state = "open"
+                self._opened_at = time.monotonic()
+
+    def retry_after(self):
+        with self._lock:
+            if self.state == "closed":
+                return 0
+            if self.state == "half_open":
+                return 1
+            return max(1, math.ceil(self.cooldown - (time.monotonic() - self._opened_at)))
+
+
+class GeminiClient:
+    """Modelo de Gemini con plazos, reintentos, límite de concurrencia, hedging y circuit breaker."""
+
+    def __init__(self, model, concurrency=GEMINI_MAX_CONCURRENCY, hedge=GEMINI_HEDGE,
+                 breaker=None, timeout=GEMINI_TIMEOUT_SECONDS, deadline=GEMINI_DEADLINE_SECONDS,
+                 max_retries=GEMINI_MAX_RETRIES):
+        self.model = model
+        self.hedge = hedge
+        self.timeout = timeout
+        self.deadline = deadline
+        self.max_retries = max_retries
+        self.slots = Slots(concurrency)
+        self.breaker = breaker or CircuitBreaker()
+        # Hilos para las llamadas con hedging (la original y la de respaldo)
+        self._executor = ThreadPoolExecutor(max_workers=concurrency * 2, thread_name_prefix="gemini")
+        self._latencies = deque(maxlen=LATENCY_WINDOW)
+        self._stats_lock = threading.Lock()
+        self.counters = {"calls": 0, "retries": 0, "failures": 0, "rejected": 0,
+                         "hedged": 0, "hedge_wins": 0}
+
+    def __getattr__(self, attr):
+        # sdk(), model_name, etc. del modelo envuelto
+        return getattr(self.model, attr)
+
+    # ----- utilidades -----
+    def _count(self, name):
+        with self._stats_lock:
+            self.counters[name] += 1
+
+    def _record_latency(self, seconds):
+        with self._stats_lock:
+            self._latencies.append(seconds)
+
+    def hedge_delay(self):
+        """p95 reciente (con mínimo), o None si no hay muestras suficientes o el hedging está apagado."""
+        if not self.hedge:
+            return None
+        with self._stats_lock:
+            latencies = list(self._latencies)
+        if len(latencies) < HEDGE_MIN_SAMPLES:
+            return None
+        return max(GEMINI_HEDGE_MIN_SECONDS, percentile(latencies, 0.95))
+
+    def _check_breaker(self):
+        """Lanza GeminiUnavailable si el circuito no deja pasar; True si esta llamada es la prueba."""
+        allowed = self.breaker.allow()
+        if not allowed:
+            self._count("rejected")
+            raise GeminiUnavailable(
+                f"Gemini no disponible temporalmente, reintenta en {self.breaker.retry_after()} s")
+        return allowed == PROBE
+
+    def _no_slot(self):
+        self._count("rejected")
+        return GeminiUnavailable("Demasiadas llamadas a Gemini en curso")
+
+    def _options(self, kwargs, timeout):
+        options = dict(kwargs.pop("request_options", None) or {})
+        options["timeout"] = timeout
+        # Los reintentos los hace este cliente, no el SDK
+        options.setdefault("retry", None)
+        kwargs["request_options"] = options
+        return kwargs
+
+    def _attempts(self, started):
+        """Genera (intento, timeout) mientras quede plazo."""
+        for attempt in range(self.max_retries + 1):
+            remaining = self.deadline - (time.monotonic() - started)
+            if remaining <= 0:
+                return
+            yield attempt, min(self.timeout, remaining)
+
+    def _failed(self, exc, attempt, started):
+        """Registra el fallo; devuelve la espera antes del siguiente intento o None si no se reintenta."""
+        retryable = is_retryable(exc)
+        # Un error del cliente (400, seguridad...) no dice nada de la salud de
+        # Gemini: no toca el circuito. Si era la prueba de half_open, el
+        # llamador la abandona al propagar la excepción.
+        if retryable:
+            self.breaker.failure()
+        delay = backoff_delay(attempt)
+        if (not retryable or attempt >= self.max_retries or self.breaker.state == "open"
+                or time.monotonic() - started + delay >= self.deadline):
+            self._count("failures")
+            return None
+        self._count("retries")
+        return delay
+
+    # ----- llamadas síncronas -----
+    def _call(self, contents, timeout, kwargs):
+        start = time.monotonic()
+        response = self.model.generate_content(contents, **self._options(dict(kwargs), timeout))
+        self._record_latency(time.monotonic() - start)
+        return response
+
+    def _call_hedged(self, contents, timeout, kwargs):
+        """Llamada con respaldo: si la primera tarda más que el p95, se lanza otra.
+
+        Recibe el cupo ya tomado por _generate y lo libera cuando termina la
+        llamada principal, aunque gane el respaldo y esta siga en curso.
+        """
+        delay = self.hedge_delay()
+        if delay is None or delay >= timeout:
+            try:
+                return self._call(contents, timeout, kwargs)
+            finally:
+                self.slots.release()
+        try:
+            first = self._executor.submit(self._call, contents, timeout, kwargs)
+        except BaseException:
+            self.slots.release()
+            raise
+        first.add_done_callback(lambda _: self.slots.release())
+        done, _ = wait([first], timeout=delay)
+        if done or not self.slots.try_acquire():
+            return first.result()
+        self._count("hedged")
+        second = self._executor.submit(self._call, contents, timeout - delay, kwargs)
+        second.add_done_callback(lambda _: self.slots.release())
+        pending = {first, second}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is second:
+                        self._count("hedge_wins")
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    def generate_content(self, contents, stream=False, **kwargs):
+        if stream:
+            return self._stream(contents, kwargs)
+        with metrics.span("gemini_call"):
+            response = self._generate(contents, kwargs)
+        metrics.record_tokens(getattr(response, "usage_metadata", None))
+        return response
+
+    def _generate(self, contents, kwargs):
+        self._count("calls")
+        started = time.monotonic()
+        for attempt, timeout in self._attempts(started):
+            probe = self._check_breaker()
+            try:
+                if not self.slots.acquire(self.deadline - (time.monotonic() - started)):
+                    raise self._no_slot()
+                try:
+                    # _call_hedged libera el cupo al terminar la llamada principal
+                    response = self._call_hedged(contents, timeout, kwargs)
+                except Exception as e:
+                    delay = self._failed(e, attempt, started)
+                    if delay is None:
+                        raise
+                else:
+                    self.breaker.success()
+                    return response
+            except BaseException:
+                if probe:
+                    self.breaker.abandon()
+                raise
+            time.sleep(delay)
+        raise GeminiUnavailable("Plazo de Gemini agotado")
+
+    def _stream(self, contents, kwargs):
+        """Itera los fragmentos; reintenta solo hasta obtener el primero."""
+        self._count("calls")
+        started = time.monotonic()
+        for attempt, _ in self._attempts(started):
+            probe = self._check_breaker()
+            try:
+                first, chunks, delay = self._open_stream(contents, kwargs, attempt, started)
+            except BaseException:
+                if probe:
+                    self.breaker.abandon()
+                raise
+            if delay is not None:
+                time.sleep(delay)
+                continue
+            self.breaker.success()
+            self._record_latency(time.monotonic() - started)
+            metrics.record_span("gemini_first_chunk", time.monotonic() - started)
+            return self._drain(first, chunks, metrics.current_trace())
+        raise GeminiUnavailable("Plazo de Gemini agotado")
+
+    def _open_stream(self, contents, kwargs, attempt, started):
+        """(primer fragmento, iterador, None), o (None, None, espera) si hay que reintentar."""
+        if not self.slots.acquire(self.deadline - (time.monotonic() - started)):
+            raise self._no_slot()
+        try:
+            options = self._options(dict(kwargs), GEMINI_STREAM_TIMEOUT_SECONDS)
+            chunks = iter(self.model.generate_content(contents, stream=True, **options))
+            return next(chunks, None), chunks, None
+        except Exception as e:
+            self.slots.release()
+            delay = self._failed(e, attempt, started)
+            if delay is None:
+                raise
+            return None, None, delay
+        except BaseException:
+            self.slots.release()
+            raise
+
+    def _drain(self, first, chunks, trace):
+        last = first
+        try:
+            if first is not None:
+                yield first
+            for last in chunks:
+                yield last
+        finally:
+            self.slots.release()
+            # usage_metadata completo llega en el último fragmento
+            metrics.record_tokens(getattr(last, "usage_metadata", None), trace)
+
+    # ----- llamadas async (asgi.py) -----
+    async def _call_async(self, contents, timeout, kwargs):
+        start = time.monotonic()
+        response = await asyncio.wait_for(
+            self.model.generate_content_async(contents, **self._options(dict(kwargs), timeout)), timeout)
+        self._record_latency(time.monotonic() - start)
+        return response
+
+    async def _call_hedged_async(self, contents, timeout, kwargs):
+        """Como _call_hedged: libera el cupo principal cuando termina la primera llamada."""
+        delay = self.hedge_delay()
+        if delay is None or delay >= timeout:
+            try:
+                return await self._call_async(contents, timeout, kwargs)
+            finally:
+                self.slots.release()
+        first = asyncio.ensure_future(self._call_async(contents, timeout, kwargs))
+        first.add_done_callback(lambda _: self.slots.release())
+        done, _ = await asyncio.wait({first}, timeout=delay)
+        if done or not self.slots.try_acquire():
+            return await first
+        self._count("hedged")
+        second = asyncio.ensure_future(self._call_async(contents, timeout - delay, kwargs))
+        second.add_done_callback(lambda _: self.slots.release())
+        pending = {first, second}
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is second:
+                            self._count("hedge_wins")
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def generate_content_async(self, contents, **kwargs):
+        with metrics.span("gemini_call"):
+            response = await self._generate_async(contents, kwargs)
+        metrics.record_tokens(getattr(response, "usage_metadata", None))
+        return response
+
+    async def _generate_async(self, contents, kwargs):
+        self._count("calls")
+        started = time.monotonic()
+        for attempt, timeout in self._attempts(started):
+            probe = self._check_breaker()
+            try:
+                if not await self.slots.acquire_async(self.deadline - (time.monotonic() - started)):
+                    raise self._no_slot()
+                try:
+                    # _call_hedged_async libera el cupo al terminar la llamada principal
+                    response = await self._call_hedged_async(contents, timeout, kwargs)
+                except Exception as e:
+                    delay = self._failed(e, attempt, started)
+                    if delay is None:
+                        raise
+                else:
+                    self.breaker.success()
+                    return response
+            except BaseException:
+                # CancelledError (p.ej. asyncio.wait_for del llamador) no es Exception
+                if probe:
+                    self.breaker.abandon()
+                raise
+            await asyncio.sleep(delay)
+        raise GeminiUnavailable("Plazo de Gemini agotado")
+
+    def stats(self):
+        with self._stats_lock:
+            data = dict(self.counters)
+            latencies = list(self._latencies)
+        data.update({
+            "in_flight": self.slots.in_use,
+            "max_concurrency": self.slots.size,
+            "breaker": self.breaker.state,
+            "breaker_opened": self.breaker.opened,
+            "hedge": self.hedge,
+        })
+        if latencies:
+            data["latency_p50"] = round(percentile(latencies, 0.5), 3)
+            data["latency_p95"] = round(percentile(latencies, 0.95), 3)
+        return data
+
+
+def configure(genai, api_key):
+    """genai.configure con el endpoint de pruebas si GEMINI_API_ENDPOINT está definido."""
+    if GEMINI_API_ENDPOINT:
+        genai.configure(api_key=api_key, transport="rest",
+                        client_options={"api_endpoint": GEMINI_API_ENDPOINT})
+    else:
+        genai.configure(api_key=api_key)
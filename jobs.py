@@ -0,0 +1,244 @@
+"""
+Cola de trabajos para análisis largos.
+
+Las rutas que pueden acercarse al maxDuration de Vercel (análisis de
+archivos, sesión de voz completa) aceptan `async=1`: se guarda el trabajo,
+se responde 202 con su id y un pool acotado (JOBS_WORKERS) lo ejecuta. El
+cliente consulta /api/jobs/<id> o recibe el resultado por POST en
+`callback_url`.
+
+El estado vive en SQLite (WAL, una conexión por hilo, como session_store)
+para que cualquier worker de gunicorn pueda responder la consulta. La base
+va por defecto en scratch_files.DATA_DIR, que no se sirve ni se barre. Los
+trabajos terminados se borran tras JOBS_RETENTION_SECONDS.
+
+`callback_url` solo puede apuntar a hosts públicos (o a los de
+JOBS_CALLBACK_HOSTS si se define), para que el servidor no haga POST a su red
+interna (169.254.169.254, localhost...).
+
+Nota: los trabajos corren en hilos del propio proceso, así que requieren un
+servidor de larga duración (gunicorn/uvicorn); en una función serverless el
+proceso puede congelarse en cuanto se envía la respuesta.
+"""
+import ipaddress
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+import scratch_files
+import startup
+
+# Vacío = DATA_DIR/jobs.sqlite3
+JOBS_DB_PATH = os.getenv("JOBS_DB_PATH", "")
+JOBS_WORKERS = int(os.getenv("JOBS_WORKERS", "2"))
+JOBS_QUEUE_MAX = int(os.getenv("JOBS_QUEUE_MAX", "20"))
+JOBS_RETENTION_SECONDS = int(os.getenv("JOBS_RETENTION_SECONDS", "86400"))
+# Un trabajo sin terminar tras este tiempo se da por perdido (p.ej. el worker murió)
+JOBS_STALE_SECONDS = int(os.getenv("JOBS_STALE_SECONDS", "900"))
+# Hosts permitidos para callback_url, separados por comas; vacío = cualquier host público
+JOBS_CALLBACK_HOSTS = {h.strip().lower() for h in os.getenv("JOBS_CALLBACK_HOSTS", "").split(",") if h.strip()}
+CALLBACK_TIMEOUT_SECONDS = 10
+CALLBACK_ATTEMPTS = 3
+
+
+class JobsBusy(Exception):
+    """Demasiados trabajos en espera en este proceso."""
+
+
+class JobStore:
+    """Estado de los trabajos en SQLite."""
+
+    def __init__(self, path=JOBS_DB_PATH):
+        self.path = path or scratch_files.data_path("jobs.sqlite3")
+        self._local = threading.local()
+        with self._conn() as conn:
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    kind TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    result TEXT,
+                    error TEXT,
+                    callback_url TEXT,
+                    created_at REAL NOT NULL,
+                    started_at REAL,
+                    finished_at REAL
+                );
+                CREATE INDEX IF NOT EXISTS idx_jobs_finished ON jobs(finished_at);
+            """)
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def create(self, kind, callback_url=None):
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._conn() as conn:
+            conn.execute("DELETE FROM jobs WHERE finished_at < ?", (now - JOBS_RETENTION_SECONDS,))
+            conn.execute("INSERT INTO jobs (id, kind, status, callback_url, created_at) VALUES (?, ?, 'queued', ?, ?)",
+                         (job_id, kind, callback_url, now))
+        return job_id
+
+    def mark_running(self, job_id):
+        with self._conn() as conn:
+            conn.execute("UPDATE jobs SET status = 'running', started_at = ? WHERE id = ?", (time.time(), job_id))
+
+    def finish(self, job_id, result=None, error=None):
+        with self._conn() as conn:
+            conn.execute("UPDATE jobs SET status = ?, result = ?, error = ?, finished_at = ? WHERE id = ?", (
+                "error" if error is not None else "done",
+                json.dumps(result, ensure_ascii=False) if result is not None else None,
+                error, time.time(), job_id,
+            ))
+
+    def get(self, job_id):
+        """El trabajo como dict, o None si no existe o ya se purgó."""
+        row = self._conn().execute(
+            "SELECT id, kind, status, result, error, callback_url, created_at, started_at, finished_at "
+            "FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = {
+            "job_id": row[0], "kind": row[1], "status": row[2],
+            "created_at": row[6], "started_at": row[7], "finished_at": row[8],
+        }
+        if row[3] is not None:
+            job["result"] = json.loads(row[3])
+        if row[4] is not None:
+            job["error"] = row[4]
+        if job["status"] in ("queued", "running") and time.time() - row[6] > JOBS_STALE_SECONDS:
+            job["status"] = "error"
+            job["error"] = "Trabajo interrumpido"
+        return job
+
+    def callback_url(self, job_id):
+        row = self._conn().execute("SELECT callback_url FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return row[0] if row else None
+
+    def counts(self):
+        rows = self._conn().execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        return dict(rows)
+
+
+class JobQueue:
+    """Pool acotado que ejecuta los trabajos y guarda su resultado en el JobStore."""
+
+    def __init__(self, store=None, workers=JOBS_WORKERS, max_pending=JOBS_QUEUE_MAX):
+        self._store = store
+        self._store_lock = threading.Lock()
+        self.workers = workers
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="jobs")
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    @property
+    def store(self):
+        # La base se crea con el primer trabajo, no al importar el módulo
+        if self._store is None:
+            with self._store_lock:
+                if self._store is None:
+                    self._store = JobStore()
+        return self._store
+
+    def submit(self, kind, fn, *args, callback_url=None, **kwargs):
+        """
+        Encola fn(*args, **kwargs), que debe devolver un dict serializable a
+        JSON. Devuelve el id del trabajo; lanza JobsBusy si la cola está llena.
+        """
+        with self._lock:
+            if self._pending >= self.max_pending:
+                raise JobsBusy("Demasiados trabajos en espera")
+            self._pending += 1
+        try:
+            job_id = self.store.create(kind, callback_url)
+            self._executor.submit(self._run, job_id, fn, args, kwargs)
+        except Exception:
+            with self._lock:
+                self._pending -= 1
+            raise
+        return job_id
+
+    def _run(self, job_id, fn, args, kwargs):
+        try:
+            self.store.mark_running(job_id)
+            try:
+                self.store.finish(job_id, result=fn(*args, **kwargs))
+            except Exception as e:
+                self.store.finish(job_id, error=str(e) or e.__class__.__name__)
+        except Exception as e:
+            print("⚠️ No se pudo guardar el estado del trabajo:", job_id, e)
+        finally:
+            with self._lock:
+                self._pending -= 1
+        self._notify(job_id)
+
+    def _notify(self, job_id):
+        url = self.store.callback_url(job_id)
+        if not url:
+            return
+        # Se vuelve a resolver: el DNS pudo cambiar desde que se aceptó
+        if not valid_callback_url(url):
+            print(f"⚠️ Callback del trabajo {job_id} descartado: el host ya no es público")
+            return
+        requests = startup.lazy_import("requests")
+        payload = self.store.get(job_id)
+        for attempt in range(CALLBACK_ATTEMPTS):
+            try:
+                resp = requests.post(url, json=payload, timeout=CALLBACK_TIMEOUT_SECONDS, allow_redirects=False)
+                if resp.status_code < 500:
+                    return
+            except Exception as e:
+                print(f"⚠️ Callback del trabajo {job_id} falló (intento {attempt + 1}):", e)
+            time.sleep(2 ** attempt)
+
+    def get(self, job_id):
+        return self.store.get(job_id)
+
+    def stats(self):
+        with self._lock:
+            pending = self._pending
+        data = {"workers": self.workers, "pending": pending, "max_pending": self.max_pending}
+        if self._store is not None:
+            data["by_status"] = self._store.counts()
+        return data
+
+
+def valid_callback_url(url):
+    """
+    Vacío, o http(s) a un host de JOBS_CALLBACK_HOSTS o, si no hay lista, a
+    uno cuyas direcciones sean todas públicas (sin privadas, loopback ni
+    link-local). Resuelve el nombre: bloquea hasta que responde el DNS.
+    """
+    if not url:
+        return True
+    try:
+        parsed = urlsplit(url)
+        port = parsed.port or (443 if parsed.scheme == "https" else 80)
+    except ValueError:
+        return False
+    host = (parsed.hostname or "").lower()
+    if parsed.scheme not in ("http", "https") or not host:
+        return False
+    if JOBS_CALLBACK_HOSTS:
+        return host in JOBS_CALLBACK_HOSTS
+    try:
+        infos = socket.getaddrinfo(host, port, proto=socket.IPPROTO_TCP)
+    except (OSError, UnicodeError):
+        return False
+    return bool(infos) and all(ipaddress.ip_address(info[4][0].split("%")[0]).is_global for info in infos)
+
+
+queue = JobQueue()
@@ -0,0 +1,207 @@
+"""
+Trazas y métricas ligeras, sin dependencias.
+
+- Cada petición abre una traza (before_request en server_combined, o el
+  envoltorio de asgi.py). Las etapas del Pipeline y las llamadas a Gemini se
+  registran como spans en la traza y en un resumen por etapa; al terminar la
+  petición se registra su latencia por ruta.
+- /metrics lo expone en formato de texto de Prometheus: resúmenes con
+  cuantiles p50/p95/p99 sobre una ventana deslizante (METRICS_WINDOW
+  observaciones) más _sum y _count acumulados, y contadores de peticiones y
+  de tokens de Gemini (usage_metadata).
+- Con SERVER_TIMING=1 cada respuesta lleva un encabezado Server-Timing con
+  los spans de la petición (se ve en la pestaña Red de las devtools).
+
+En las respuestas en streaming (SSE, MP3 por frases) la latencia de la ruta
+es la del primer byte; las etapas que siguen generando después se registran
+igualmente en su resumen por etapa.
+"""
+import contextvars
+import os
+import re
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+METRICS_WINDOW = int(os.getenv("METRICS_WINDOW", "1024"))
+SERVER_TIMING = os.getenv("SERVER_TIMING", "0") == "1"
+QUANTILES = (0.5, 0.95, 0.99)
+PREFIX = "iamed_"
+
+_STAGE_SUFFIX = re.compile(r"_\d+$")
+_TIMING_NAME = re.compile(r"[^A-Za-z0-9_.-]")
+
+
+# ===== REGISTRO =====
+class Summary:
+    """Cuantiles sobre las últimas `window` observaciones, y suma/cuenta totales."""
+
+    def __init__(self, window=METRICS_WINDOW):
+        self._values = deque(maxlen=window)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self._values.append(value)
+            self.sum += value
+            self.count += 1
+
+    def snapshot(self):
+        with self._lock:
+            values = sorted(self._values)
+            total, count = self.sum, self.count
+        quantiles = {q: values[min(len(values) - 1, int(len(values) * q))] for q in QUANTILES} if values else {}
+        return quantiles, total, count
+
+
+class Registry:
+    def __init__(self):
+        self._summaries = {}   # {(nombre, etiquetas): Summary}
+        self._counters = {}    # {(nombre, etiquetas): valor}
+        self._help = {}
+        self._lock = threading.Lock()
+
+    def describe(self, name, kind, text):
+        self._help[name] = (kind, text)
+
+    def observe(self, name, labels, value):
+        key = (name, tuple(sorted(labels.items())))
+        summary = self._summaries.get(key)
+        if summary is None:
+            with self._lock:
+                summary = self._summaries.setdefault(key, Summary())
+        summary.observe(value)
+
+    def inc(self, name, labels, amount=1):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def render(self):
+        """Texto para /metrics (formato de exposición de Prometheus 0.0.4)."""
+        with self._lock:
+            summaries = sorted(self._summaries.items())
+            counters = sorted(self._counters.items())
+        lines = []
+        seen = set()
+
+        def header(name):
+            if name not in seen and name in self._help:
+                kind, text = self._help[name]
+                lines.append(f"# HELP {PREFIX}{name} {text}")
+                lines.append(f"# TYPE {PREFIX}{name} {kind}")
+                seen.add(name)
+
+        for (name, labels), summary in summaries:
+            header(name)
+            quantiles, total, count = summary.snapshot()
+            for q, value in quantiles.items():
+                lines.append(f"{PREFIX}{name}{_labels(labels, quantile=q)} {value:.6f}")
+            lines.append(f"{PREFIX}{name}_sum{_labels(labels)} {total:.6f}")
+            lines.append(f"{PREFIX}{name}_count{_labels(labels)} {count}")
+        for (name, labels), value in counters:
+            header(name)
+            lines.append(f"{PREFIX}{name}{_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(labels, **extra):
+    items = list(labels) + list(extra.items())
+    if not items:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in items) + "}"
+
+
+registry = Registry()
+registry.describe("request_duration_seconds", "summary", "Latencia por ruta (hasta el primer byte en streaming)")
+registry.describe("requests_total", "counter", "Peticiones por ruta, método y código")
+registry.describe("stage_duration_seconds", "summary", "Duración de cada etapa (Whisper, OCR, Gemini, resumen, TTS...)")
+registry.describe("gemini_tokens_total", "counter", "Tokens de Gemini según usage_metadata")
+
+
+# ===== TRAZAS =====
+class Trace:
+    """Spans de una petición: [(nombre, segundos)]."""
+
+    def __init__(self, route):
+        self.route = route
+        self.started = time.perf_counter()
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def add(self, name, seconds):
+        with self._lock:
+            self.spans.append((name, seconds))
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def server_timing(self):
+        """Valor del encabezado Server-Timing (ms)."""
+        with self._lock:
+            spans = list(self.spans)
+        parts = [f"{_TIMING_NAME.sub('_', name)};dur={seconds * 1000:.1f}" for name, seconds in spans]
+        parts.append(f"total;dur={self.elapsed() * 1000:.1f}")
+        return ", ".join(parts)
+
+
+_trace = contextvars.ContextVar("trace", default=None)
+
+
+def start_trace(route):
+    trace = Trace(route)
+    _trace.set(trace)
+    return trace
+
+
+def current_trace():
+    return _trace.get()
+
+
+def finish_request(trace, method, status):
+    labels = {"route": trace.route, "method": method}
+    registry.observe("request_duration_seconds", labels, trace.elapsed())
+    registry.inc("requests_total", {**labels, "status": str(status)})
+
+
+def record_span(name, seconds, trace=None):
+    """
+    Registra una etapa ya medida. `trace` permite asociarla a la petición
+    desde otro hilo (p.ej. las etapas del Pipeline que corren en su pool).
+    """
+    registry.observe("stage_duration_seconds", {"stage": _STAGE_SUFFIX.sub("", name)}, seconds)
+    trace = trace or current_trace()
+    if trace is not None:
+        trace.add(name, seconds)
+
+
+@contextmanager
+def span(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_span(name, time.perf_counter() - start)
+
+
+def record_tokens(usage, trace=None):
+    """Suma prompt/candidates de un usage_metadata de Gemini (si viene)."""
+    if usage is None:
+        return
+    trace = trace or current_trace()
+    route = trace.route if trace is not None else "background"
+    for kind, attr in (("prompt", "prompt_token_count"), ("output", "candidates_token_count")):
+        count = getattr(usage, attr, 0) or 0
+        if count:
+            registry.inc("gemini_tokens_total", {"route": route, "type": kind}, count)
+
+
+def render():
+    return registry.render()
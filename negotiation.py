@@ -0,0 +1,114 @@
+"""
+Negociación de formato JSON/XML para las rutas que sirven a ambos clientes.
+
+Cada funcionalidad tiene un solo handler; los alias *-xml solo fuerzan el
+formato. El formato de la respuesta se decide, en este orden, por:
+  1. el alias de la ruta (defaults={"fmt": "xml"});
+  2. el encabezado Accept (application/json frente a application/xml o
+     text/xml, respetando q; los comodines no cuentan);
+  3. el formato del cuerpo recibido (Content-Type, o el primer carácter
+     del cuerpo si falta);
+  4. el formato por defecto de la ruta.
+
+Las funciones choose()/body_format() no dependen de Flask (las usa asgi.py);
+el resto trabaja sobre la petición Flask actual.
+"""
+from flask import Response, jsonify, request
+
+import xml_codec
+
+JSON = "json"
+XML = "xml"
+MIME_TYPES = {JSON: "application/json", XML: "application/xml"}
+_ACCEPT_TYPES = {
+    "application/json": JSON,
+    "application/xml": XML,
+    "text/xml": XML,
+}
+
+
+def body_format(content_type, body_prefix=b""):
+    """json | xml según Content-Type o, si no lo dice, el inicio del cuerpo; None si no hay pista."""
+    mime = (content_type or "").split(";", 1)[0].strip().lower()
+    if mime.endswith("json"):
+        return JSON
+    if mime.endswith("xml"):
+        return XML
+    start = body_prefix.lstrip()[:1]
+    if start == b"<":
+        return XML
+    if start in (b"{", b"["):
+        return JSON
+    return None
+
+
+def accept_format(accept):
+    """Formato preferido en Accept, o None si solo hay comodines o no aparece ninguno."""
+    best, best_q = None, 0.0
+    for item in (accept or "").split(","):
+        mime, _, params = item.strip().partition(";")
+        fmt = _ACCEPT_TYPES.get(mime.strip().lower())
+        if fmt is None:
+            continue
+        q = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if q > best_q:
+            best, best_q = fmt, q
+    return best
+
+
+def choose(accept="", content_type="", body_prefix=b"", forced=None, default=JSON):
+    return forced or accept_format(accept) or body_format(content_type, body_prefix) or default
+
+
+# ===== FLASK =====
+def _body_prefix():
+    if request.mimetype or not request.content_length:
+        return b""
+    # Sin Content-Type: hay que mirar el cuerpo (queda en caché para read_body)
+    return request.get_data()[:64]
+
+
+def request_format(default=JSON):
+    return body_format(request.mimetype, _body_prefix()) or default
+
+
+def response_format(forced=None, default=JSON):
+    forced = forced or (request.view_args or {}).get("fmt")
+    return choose(request.headers.get("Accept", ""), request.mimetype, _body_prefix(), forced, default)
+
+
+def read_body(default=JSON):
+    """Cuerpo JSON o XML como dict (vacío si no se puede leer)."""
+    if request_format(default) == XML:
+        # Si el cuerpo ya se leyó para detectar el formato, el stream está vacío
+        source = request.get_data() if request.content_length and not request.mimetype else request.stream
+        try:
+            return xml_codec.parse(source)
+        except xml_codec.XMLError:
+            return {}
+    data = request.get_json(force=True, silent=True)
+    return data if isinstance(data, dict) else {}
+
+
+def render(data, status=200, fmt=None, headers=None, stream=False):
+    """
+    Response en el formato negociado (o `fmt`). Con stream=True el XML se
+    genera por trozos (respuestas grandes como las del analizador).
+    """
+    fmt = fmt or response_format()
+    if fmt == XML:
+        body = xml_codec.iter_serialize(data) if stream else xml_codec.dumps(data)
+        response = Response(body, status=status, mimetype=MIME_TYPES[XML], headers=headers)
+    else:
+        response = jsonify(data)
+        response.status_code = status
+        response.headers.extend(headers or {})
+    response.vary.add("Accept")
+    return response
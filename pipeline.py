@@ -0,0 +1,198 @@
+"""
+Ejecutor de etapas para los flujos de voz.
+
+Las etapas independientes (p.ej. resumen clínico y síntesis de voz, que solo
+dependen del texto de la IA) se lanzan en un pool de hilos acotado. Cada etapa
+tiene su propio timeout y queda medida para poder ver a dónde se va el tiempo;
+la medida se registra también como span de la petición (metrics.py), incluso
+para las etapas que corren en el pool.
+"""
+import contextvars
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+import metrics
+import scratch_files
+
+PIPELINE_WORKERS = int(os.getenv("PIPELINE_WORKERS", "8"))
+DEFERRED_TTL_SECONDS = int(os.getenv("DEFERRED_TTL_SECONDS", "300"))
+# Un resultado que sigue pendiente tras esto se da por perdido (worker muerto o congelado)
+DEFERRED_STALE_SECONDS = int(os.getenv("DEFERRED_STALE_SECONDS", "60"))
+# Vacío = DATA_DIR/deferred.sqlite3
+DEFERRED_DB_PATH = os.getenv("DEFERRED_DB_PATH", "")
+
+_executor = ThreadPoolExecutor(max_workers=PIPELINE_WORKERS, thread_name_prefix="pipeline")
+
+
+class StageTimeout(Exception):
+    """Una etapa no terminó dentro de su timeout."""
+
+
+class Pipeline:
+    """Agrupa las etapas de una petición y sus tiempos."""
+
+    def __init__(self):
+        self._started = time.perf_counter()
+        self._futures = {}
+        self._timeouts = {}
+        self._timings = {}
+        self._lock = threading.Lock()
+
+    def _timed(self, name, fn, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self._timings[name] = round(elapsed, 3)
+            metrics.record_span(name, elapsed)
+
+    def run(self, name, fn, *args, **kwargs):
+        """Ejecuta una etapa en el hilo actual."""
+        return self._timed(name, fn, *args, **kwargs)
+
+    def submit(self, name, fn, *args, timeout=None, **kwargs):
+        """Lanza una etapa en el pool; se recoge luego con result(name)."""
+        # Con el contexto actual, para que la etapa vea la traza de la petición
+        context = contextvars.copy_context()
+        self._futures[name] = _executor.submit(context.run, self._timed, name, fn, *args, **kwargs)
+        self._timeouts[name] = timeout
+        return self._futures[name]
+
+    def result(self, name, default=StageTimeout):
+        """
+        Espera la etapa `name`. Si excede su timeout o falla, devuelve `default`
+        (o propaga la excepción si no se dio uno).
+        """
+        future = self._futures[name]
+        try:
+            return future.result(timeout=self._timeouts.get(name))
+        except FutureTimeout:
+            with self._lock:
+                self._timings.setdefault(name, f"timeout>{self._timeouts.get(name)}s")
+            if default is StageTimeout:
+                raise StageTimeout(name)
+            return default
+        except Exception:
+            if default is StageTimeout:
+                raise
+            return default
+
+    def future(self, name):
+        return self._futures[name]
+
+    def timings(self):
+        with self._lock:
+            data = dict(self._timings)
+        data["total"] = round(time.perf_counter() - self._started, 3)
+        return data
+
+
+def submit_background(fn, *args, **kwargs):
+    """Tarea suelta en el mismo pool (p.ej. trabajo que no bloquea la respuesta)."""
+    return _executor.submit(fn, *args, **kwargs)
+
+
+# ===== RESULTADOS DIFERIDOS =====
+# Para responder sin esperar una etapa lenta (p.ej. el resumen) y que el
+# cliente lo recoja después con un id. El resultado se guarda en SQLite (como
+# jobs), así que la consulta puede llegar a cualquier worker de gunicorn. La
+# etapa sigue corriendo en el proceso que respondió: en una función serverless
+# que se congela al enviar la respuesta puede no terminar nunca, y pasado
+# DEFERRED_STALE_SECONDS se informa como error en vez de quedar pendiente.
+class DeferredStore:
+
+    def __init__(self, path=DEFERRED_DB_PATH):
+        self.path = path or scratch_files.data_path("deferred.sqlite3")
+        self._local = threading.local()
+        with self._conn() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS deferred (
+                    id TEXT PRIMARY KEY,
+                    status TEXT NOT NULL,
+                    value TEXT,
+                    created_at REAL NOT NULL
+                )""")
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def create(self):
+        deferred_id = uuid.uuid4().hex
+        now = time.time()
+        with self._conn() as conn:
+            conn.execute("DELETE FROM deferred WHERE created_at < ?", (now - DEFERRED_TTL_SECONDS,))
+            conn.execute("INSERT INTO deferred (id, status, created_at) VALUES (?, 'pending', ?)",
+                         (deferred_id, now))
+        return deferred_id
+
+    def finish(self, deferred_id, status, value):
+        with self._conn() as conn:
+            conn.execute("UPDATE deferred SET status = ?, value = ? WHERE id = ?",
+                         (status, json.dumps(value, ensure_ascii=False), deferred_id))
+
+    def fetch(self, deferred_id):
+        row = self._conn().execute("SELECT status, value, created_at FROM deferred WHERE id = ?",
+                                   (deferred_id,)).fetchone()
+        if row is None or time.time() - row[2] > DEFERRED_TTL_SECONDS:
+            return "missing", None
+        status, value, created_at = row
+        if status == "pending":
+            if time.time() - created_at > DEFERRED_STALE_SECONDS:
+                return "error", "Resultado interrumpido"
+            return "pending", None
+        # No se borra al leer: si la respuesta se pierde, el cliente puede
+        # volver a pedirlo. La purga de create() lo elimina tras el TTL.
+        return status, json.loads(value)
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def deferred_store():
+    # La base se crea con el primer resultado diferido, no al importar el módulo
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = DeferredStore()
+    return _store
+
+
+def defer(future):
+    """Registra un future y devuelve el id con el que se consultará."""
+    store = deferred_store()
+    deferred_id = store.create()
+
+    def save(future):
+        try:
+            store.finish(deferred_id, "done", future.result())
+        except Exception as e:
+            try:
+                store.finish(deferred_id, "error", str(e) or e.__class__.__name__)
+            except Exception as err:
+                print("⚠️ No se pudo guardar el resultado diferido:", deferred_id, err)
+
+    future.add_done_callback(save)
+    return deferred_id
+
+
+def fetch_deferred(deferred_id):
+    """
+    Devuelve ("pending", None), ("done", valor), ("error", mensaje) o
+    ("missing", None) si el id no existe o ya expiró.
+    """
+    return deferred_store().fetch(deferred_id)
@@ -0,0 +1,327 @@
+"""
+Plantillas de prompt precompiladas y ajuste a un presupuesto de tokens.
+
+Cada plantilla se parte una sola vez al importar en trozos fijos y campos
+(string.Formatter.parse), y sus tokens fijos quedan calculados; al construir
+el prompt solo se serializan los datos y se concatenan los trozos.
+
+Los datos del paciente y los estudios se serializan compactos
+("clave: valor; ...", sin campos vacíos) en vez del repr de dict/list. Si
+los campos no caben en el presupuesto de la plantilla
+(PROMPT_BUDGET_<NOMBRE>, en tokens estimados a PROMPT_CHARS_PER_TOKEN
+caracteres por token) se recortan en el orden declarado en `shrink`:
+
+- items: se quitan elementos enteros del final ("(+N más)");
+- head: se conserva el principio (mensajes, textos a resumir);
+- middle: se conservan principio y final (historial: el resumen acumulado
+  va arriba y los turnos recientes abajo).
+
+Cada prompt construido se registra en /metrics (tokens estimados por
+plantilla y recortes por campo) y en /health; los recortes se avisan por
+consola y con PROMPT_LOG=1 también cada prompt con su presupuesto usado.
+"""
+import math
+import os
+import string
+import threading
+
+import metrics
+
+PROMPT_CHARS_PER_TOKEN = float(os.getenv("PROMPT_CHARS_PER_TOKEN", "4"))
+# Nunca se recorta un campo por debajo de esto (aunque se pase del presupuesto)
+PROMPT_MIN_FIELD_TOKENS = int(os.getenv("PROMPT_MIN_FIELD_TOKENS", "64"))
+PROMPT_LOG = os.getenv("PROMPT_LOG", "0") == "1"
+
+ITEM_SEPARATOR = "; "
+EMPTY = "(sin datos)"
+
+_FORMATTER = string.Formatter()
+
+metrics.registry.describe("prompt_tokens", "summary", "Tokens estimados de cada prompt por plantilla")
+metrics.registry.describe("prompt_truncations_total", "counter", "Campos recortados para caber en el presupuesto")
+
+
+def estimate_tokens(text):
+    return math.ceil(len(text or "") / PROMPT_CHARS_PER_TOKEN)
+
+
+def _chars(tokens):
+    return int(tokens * PROMPT_CHARS_PER_TOKEN)
+
+
+# ===== SERIALIZACIÓN COMPACTA =====
+def _is_empty(value):
+    return value is None or (isinstance(value, (str, list, tuple, dict)) and not value)
+
+
+def compact_value(value):
+    """Texto de una línea para un valor anidado: dict → "k=v, ...", lista → "a, b"."""
+    if isinstance(value, dict):
+        return ", ".join(f"{k}={compact_value(v)}" for k, v in value.items() if not _is_empty(v))
+    if isinstance(value, (list, tuple)):
+        return ", ".join(compact_value(v) for v in value if not _is_empty(v))
+    return " ".join(str(value).split())
+
+
+def compact_items(data):
+    """
+    "clave: valor; clave: valor" para un dict (p.ej. los datos del paciente),
+    "a; b; c" para una lista (estudios) y el texto tal cual para un str.
+    """
+    if isinstance(data, dict):
+        items = [f"{k}: {compact_value(v)}" for k, v in data.items() if not _is_empty(v)]
+    elif isinstance(data, (list, tuple)):
+        items = [compact_value(v) for v in data if not _is_empty(v)]
+    else:
+        return compact_value(data) if not _is_empty(data) else EMPTY
+    return ITEM_SEPARATOR.join(items) or EMPTY
+
+
+# ===== RECORTE =====
+def _cut_head(text, tokens):
+    cut = text[:_chars(tokens)]
+    space = cut.rfind(" ")
+    if space > len(cut) // 2:
+        cut = cut[:space]
+    return cut.rstrip() + " […]"
+
+
+def _cut_middle(text, tokens):
+    chars = _chars(tokens)
+    head, tail = text[:chars // 3], text[len(text) - (chars - chars // 3):]
+    # Cortes en fin de línea si los hay, para no dejar mensajes a medias
+    if "\n" in head:
+        head = head[:head.rfind("\n")]
+    if "\n" in tail:
+        tail = tail[tail.find("\n") + 1:]
+    return f"{head}\n[…]\n{tail}"
+
+
+def _cut_items(text, tokens):
+    items = text.split(ITEM_SEPARATOR)
+    kept, used = [], 0
+    for item in items:
+        used += estimate_tokens(item + ITEM_SEPARATOR)
+        if used > tokens:
+            break
+        kept.append(item)
+    if not kept:
+        return _cut_head(items[0], tokens) + f" (+{len(items) - 1} más)"
+    return ITEM_SEPARATOR.join(kept) + f" (+{len(items) - len(kept)} más)"
+
+
+_CUTS = {"head": _cut_head, "middle": _cut_middle, "items": _cut_items}
+
+
+def truncate(text, tokens, mode):
+    """`text` recortado a unos `tokens` estimados (más el marcador de recorte)."""
+    if estimate_tokens(text) <= tokens:
+        return text
+    return _CUTS[mode](text, tokens)
+
+
+# ===== PLANTILLAS =====
+class PromptTemplate:
+
+    def __init__(self, name, text, budget, shrink=()):
+        """
+        `shrink`: [(campo, modo)] en el orden en que se recortan si no cabe;
+        los campos que no aparecen nunca se recortan.
+        """
+        self.name = name
+        self.text = text
+        self.budget = int(os.getenv(f"PROMPT_BUDGET_{name.upper()}", str(budget)))
+        self.shrink = tuple(shrink)
+        self._parts = [(literal, field) for literal, field, _, _ in _FORMATTER.parse(text)]
+        self.fields = tuple(field for _, field in self._parts if field)
+        self.fixed_tokens = estimate_tokens("".join(literal for literal, _ in self._parts))
+
+    def fit(self, values):
+        """(valores que caben en el presupuesto, campos recortados)."""
+        sizes = {field: estimate_tokens(values[field]) for field in self.fields}
+        excess = self.fixed_tokens + sum(sizes.values()) - self.budget
+        truncated = []
+        for field, mode in self.shrink:
+            if excess <= 0:
+                break
+            keep = max(PROMPT_MIN_FIELD_TOKENS, sizes[field] - excess)
+            if keep >= sizes[field]:
+                continue
+            values[field] = truncate(values[field], keep, mode)
+            excess -= sizes[field] - estimate_tokens(values[field])
+            truncated.append(field)
+        return values, truncated
+
+    def render(self, values):
+        return "".join(literal + (values[field] if field else "") for literal, field in self._parts)
+
+    def build(self, **values):
+        """Prompt con los campos (ya en texto) ajustados al presupuesto."""
+        values, truncated = self.fit({field: str(values[field]) for field in self.fields})
+        prompt = self.render(values)
+        _record(self, estimate_tokens(prompt), truncated)
+        return prompt
+
+
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+def _record(template, tokens, truncated):
+    metrics.registry.observe("prompt_tokens", {"prompt": template.name}, tokens)
+    for field in truncated:
+        metrics.registry.inc("prompt_truncations_total", {"prompt": template.name, "field": field})
+    with _stats_lock:
+        entry = _stats.setdefault(template.name, {"budget": template.budget, "builds": 0,
+                                                  "truncated": 0, "max_tokens": 0})
+        entry["builds"] += 1
+        entry["truncated"] += bool(truncated)
+        entry["max_tokens"] = max(entry["max_tokens"], tokens)
+    if truncated:
+        print(f"✂️ Prompt {template.name} recortado ({', '.join(truncated)}): ~{tokens}/{template.budget} tokens")
+    elif PROMPT_LOG:
+        print(f"🧮 Prompt {template.name}: ~{tokens}/{template.budget} tokens")
+
+
+def stats():
+    with _stats_lock:
+        return {name: dict(entry) for name, entry in _stats.items()}
+
+
+DOCTOR = PromptTemplate("doctor", """
+Eres un asistente que APOYA a un MÉDICO TITULADO.
+Devuelve:
+1) Resumen clínico (TENLO EN CUENTA, PERO NO LO MENCIONAS A MENOS DE QUE SE TE PIDA)
+2) 3-5 diagnósticos diferenciales con razonamiento corto.
+3) Próximos pasos sugeridos.
+4) Advertencia: el veredicto es del médico; esto NO sustituye consulta.
+
+Paciente: {patient}
+Síntomas: {symptoms}
+Estudios/URLs: {studies}
+Responde en español en formato claro y con viñetas.
+""", budget=2000, shrink=[("studies", "items"), ("patient", "items"), ("symptoms", "head")])
+
+PATIENT = PromptTemplate("patient", """
+Eres un asistente que habla con un PACIENTE. Tono empático y claro.
+Incluye:
+- Explicación sencilla de lo que podría estar pasando (no diagnóstico).
+- Señales de alarma si aplican.
+- Pasos sugeridos (p.ej. agendar cita).
+- A veces el paciente se siente más cómodo hablando contigo, no lo cortes.
+- PREGUNTA HASTA QUE LLEGUES A UN DIAGNOSTICO, NO ESPECULES. PERO UNA PREGUNTA A LA VEZ, ANALIZA LO QUE TE CONTESTO Y PREGUNTALE OTRA LUEGO DE SU RESPUESTA. SI YA SABES ALGO SIMPLEMENTE RESPONDELE
+- TRATA DE DAR REPSUESTAS BREVES, PERO SIN DEJAR LA SENSACIÓN DE QUE FUE MUY CORTA, ESTO POR QUE TU RESPUESTA SERÁ UTILIZADA PARA GENERAR UN AUDIO Y MANDARSELO AL PACIENTE. RECUERDA, MUY MUY CORTA
+- COMO TU RESPUESTA SE PASARA A AUDIO, NO PONGAS CARACTERIS COMO GUIONES, ASTERICOS, ETC...
+- NO MUESTRES LA INFORMACIÓN DEL PACIENTE A MENOS QUE SE TE PIDA.
+
+Paciente: {patient}
+Síntomas: {symptoms}
+Estudios/URLs: {studies}
+""", budget=2000, shrink=[("studies", "items"), ("patient", "items"), ("symptoms", "head")])
+
+SUMMARY = PromptTemplate("summary", """
+Eres un médico que está redactando notas clínicas.
+Resume lo siguiente en 3 líneas máximo, con tono médico y conciso:
+
+Texto: {text}
+""", budget=1500, shrink=[("text", "head")])
+
+INTERACTION = PromptTemplate("interaction", """
+Eres un asistente médico que habla con un PACIENTE.
+Sé empático y claro, pero profesional. Usa el historial para dar continuidad.
+
+Historial:
+{context}
+
+Paciente: {message}
+""", budget=3000, shrink=[("context", "middle"), ("message", "head")])
+
+CONCLUSION = PromptTemplate("conclusion", """
+Eres un médico escribiendo la CONCLUSIÓN FINAL de una consulta con un paciente.
+Haz un resumen clínico en 8–10 líneas que incluya:
+- Motivo de consulta
+- Síntomas principales
+- Evolución durante la conversación
+- Posibles diagnósticos diferenciales
+- Recomendaciones finales
+- Advertencia de que no sustituye una consulta real
+
+Conversación:
+{conversation}
+""", budget=6000, shrink=[("conversation", "middle")])
+
+VOICE = PromptTemplate("voice", """
+        Eres un asistente médico empático que conversa con un paciente.
+        Paciente: "{user_text}"
+        Responde de forma clara, breve y profesional.
+        - PREGUNTA HASTA QUE LLEGUES A UN DIAGNOSTICO, NO ESPECULES. PERO UNA PREGUNTA A LA VEZ, ANALIZA LO QUE TE CONTESTO Y PREGUNTALE OTRA LUEGO DE SU RESPUESTA. SI YA SABES ALGO SIMPLEMENTE RESPONDELE
+        - TRATA DE DAR REPSUESTAS BREVES, PERO SIN DEJAR LA SENSACIÓN DE QUE FUE MUY CORTA, ESTO POR QUE TU RESPUESTA SERÁ UTILIZADA PARA GENERAR UN AUDIO Y MANDARSELO AL PACIENTE. RECUERDA, MUY MUY CORTA
+        - COMO TU RESPUESTA SE PASARA A AUDIO, NO PONGAS CARACTERES COMO GUIONES, ASTERICOS, ETC...
+        """, budget=1000, shrink=[("user_text", "head")])
+
+VOICE_SUMMARY = PromptTemplate("voice_summary", "Redacta una nota médica de 2 líneas máximo: {ai_text}",
+                               budget=1000, shrink=[("ai_text", "head")])
+
+FILE_ANALYSIS_PROMPT = """
+Analiza el archivo adjunto (imagen, PDF o DOCX).
+Extrae texto (OCR si aplica), estructura, tablas y datos clave.
+En español.
+
+Responde SOLO con un JSON válido (sin explicaciones).
+"""
+FILE_ANALYSIS = PromptTemplate("file_analysis", FILE_ANALYSIS_PROMPT + "{instructions}",
+                               budget=600, shrink=[("instructions", "head")])
+
+# Sin campos: va junto a la imagen en el OCR de la sesión de voz
+IMAGE_INPUT_PROMPT = """
+Eres un asistente médico experto en interpretación de imágenes clínicas.
+El usuario te ha enviado una imagen que puede ser un estudio médico, radiografía, herida, análisis o documento visual relacionado con salud.
+
+Tu tarea:
+1. Interpreta con detalle lo que se observa: estructuras afectadas, tejidos, posibles patologías, signos de infección o daño.
+2. Describe la posible causa o diagnóstico preliminar si es evidente.
+3. Si es una imagen médica (como rayos X, tomografía, resonancia, laboratorio o herida), analiza con precisión anatómica y médica.
+4. Al final, formula una sola pregunta útil o de seguimiento, del tipo:
+  Al dinal explicala y da seguimiento, puedes dar alguna recomendacióm
+
+Nunca digas frases como “No soy médico”, ni respondas de forma ambigua.
+Si la imagen es clara, interpreta aunque el caso sea grave.
+Habla como si fueras un profesional que ayuda a entender el resultado, no que evade responsabilidad.
+
+SE BREVE, PERO EXPLICA TODO, AUNQUE SEAS BREVE TODO EXPLICADO E INTERPRETADO AL 100
+"""
+
+
+# ===== CONSTRUCTORES POR ENDPOINT =====
+def doctor(patient, symptoms, studies):
+    return DOCTOR.build(patient=compact_items(patient), symptoms=compact_items(symptoms),
+                        studies=compact_items(studies))
+
+
+def patient(patient, symptoms, studies):
+    return PATIENT.build(patient=compact_items(patient), symptoms=compact_items(symptoms),
+                         studies=compact_items(studies))
+
+
+def summary(text):
+    return SUMMARY.build(text=text)
+
+
+def interaction(context, message):
+    return INTERACTION.build(context=context, message=message)
+
+
+def conclusion(conversation):
+    return CONCLUSION.build(conversation=conversation)
+
+
+def voice(user_text):
+    return VOICE.build(user_text=user_text)
+
+
+def voice_summary(ai_text):
+    return VOICE_SUMMARY.build(ai_text=ai_text)
+
+
+def file_analysis(instructions):
+    return FILE_ANALYSIS.build(instructions=f"Instrucciones del usuario: {instructions}\n" if instructions else "")
@@ -0,0 +1,110 @@
+"""
+Caché de respuestas de Gemini para prompts repetidos.
+
+Dos niveles, ambos con TTL y tamaño acotado:
+- exacto: hash del prompt normalizado (minúsculas, espacios colapsados).
+- casi duplicado (opcional): hash de los síntomas y datos del paciente
+  normalizados (sin acentos, puntuación ni mayúsculas), de modo que
+  "Dolor de cabeza, fiebre" y "dolor de cabeza fiebre" comparten entrada.
+  Las palabras conservan su orden: "fiebre pero no tos" y "tos pero no
+  fiebre" dicen cosas opuestas y no deben compartir respuesta.
+
+Se activa por endpoint con RESPONSE_CACHE_ENDPOINTS (p.ej. "doctor,patient").
+"""
+import os
+import re
+import threading
+import unicodedata
+
+import caching
+
+RESPONSE_CACHE_ENDPOINTS = {
+    e.strip() for e in os.getenv("RESPONSE_CACHE_ENDPOINTS", "").split(",") if e.strip()
+}
+RESPONSE_CACHE_TTL_SECONDS = int(os.getenv("RESPONSE_CACHE_TTL_SECONDS", "3600"))
+RESPONSE_CACHE_MAX_ITEMS = int(os.getenv("RESPONSE_CACHE_MAX_ITEMS", "512"))
+RESPONSE_CACHE_NEAR_DUPLICATES = os.getenv("RESPONSE_CACHE_NEAR_DUPLICATES", "0").lower() in ("1", "true", "yes")
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def _strip_accents(text):
+    return "".join(c for c in unicodedata.normalize("NFKD", text) if not unicodedata.combining(c))
+
+
+def normalize_prompt(prompt):
+    return re.sub(r"\s+", " ", str(prompt)).strip().lower()
+
+
+def normalize_field(value):
+    """Forma canónica de un campo para el nivel de casi duplicados."""
+    if isinstance(value, dict):
+        return "{" + ",".join(f"{normalize_field(k)}:{normalize_field(v)}" for k, v in sorted(value.items(), key=lambda kv: str(kv[0]))) + "}"
+    if isinstance(value, (list, tuple)):
+        return "[" + ",".join(sorted(normalize_field(v) for v in value)) + "]"
+    return " ".join(re.findall(r"\w+", _strip_accents(str(value or "")).lower()))
+
+
+class ResponseCache:
+
+    def __init__(self, name, ttl=RESPONSE_CACHE_TTL_SECONDS, max_items=RESPONSE_CACHE_MAX_ITEMS,
+                 near_duplicates=RESPONSE_CACHE_NEAR_DUPLICATES):
+        self.name = name
+        self.near_duplicates = near_duplicates
+        self._exact = caching.LRUCache(max_items=max_items, ttl=ttl)
+        self._near = caching.LRUCache(max_items=max_items, ttl=ttl) if near_duplicates else None
+
+    def _near_key(self, fields):
+        return caching.hash_key(self.name, normalize_field(fields))
+
+    def lookup(self, prompt, fields=None):
+        text = self._exact.get(caching.hash_key(self.name, normalize_prompt(prompt)))
+        if text is None and self._near is not None and fields is not None:
+            text = self._near.get(self._near_key(fields))
+        return text
+
+    def store(self, prompt, text, fields=None):
+        self._exact.set(caching.hash_key(self.name, normalize_prompt(prompt)), text)
+        if self._near is not None and fields is not None:
+            self._near.set(self._near_key(fields), text)
+
+    def stats(self):
+        exact = self._exact.stats()
+        near = self._near.stats() if self._near is not None else None
+        # Un acierto casi duplicado siempre viene de un fallo exacto
+        requests = exact["hits"] + exact["misses"]
+        hits = exact["hits"] + (near["hits"] if near else 0)
+        return {
+            "exact": exact,
+            "near_duplicate": near,
+            "hit_rate": round(hits / requests, 3) if requests else None,
+        }
+
+
+def get_cache(endpoint):
+    """Caché del endpoint, o None si no está activado en RESPONSE_CACHE_ENDPOINTS."""
+    if endpoint not in RESPONSE_CACHE_ENDPOINTS:
+        return None
+    with _caches_lock:
+        if endpoint not in _caches:
+            _caches[endpoint] = ResponseCache(endpoint)
+        return _caches[endpoint]
+
+
+def cached(endpoint, prompt, generate, fields=None):
+    """Devuelve la respuesta en caché o llama a `generate(prompt)` y la guarda."""
+    cache = get_cache(endpoint)
+    if cache is None:
+        return generate(prompt)
+    text = cache.lookup(prompt, fields)
+    if text is None:
+        text = generate(prompt)
+        if text:
+            cache.store(prompt, text, fields)
+    return text
+
+
+def stats():
+    with _caches_lock:
+        return {name: cache.stats() for name, cache in _caches.items()}
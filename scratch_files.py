@@ -0,0 +1,121 @@
+"""
+Archivos temporales por petición.
+
+Cada archivo recibe un nombre único (prefijo + uuid) para que peticiones
+concurrentes en el mismo worker no se pisen. Los archivos de uso interno se
+borran al salir del `with`; los que se entregan al cliente (p.ej. el MP3 que
+luego pide el navegador en /tmp/<archivo>) se conservan y un barrido por TTL
+los elimina más tarde.
+
+Solo los MP3 entregados al cliente (is_served) se sirven en /tmp/<archivo>.
+Lo que debe persistir (bases SQLite, subidas de trabajos pendientes) va en
+DATA_DIR, que no se sirve ni se barre.
+"""
+import os
+import re
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+SCRATCH_DIR = os.getenv("SCRATCH_DIR", tempfile.gettempdir())
+SCRATCH_PREFIX = "iamed_"
+SCRATCH_TTL_SECONDS = int(os.getenv("SCRATCH_TTL_SECONDS", "900"))
+SWEEP_INTERVAL_SECONDS = 60
+DATA_DIR = os.getenv("DATA_DIR") or os.path.join(tempfile.gettempdir(), "iamed-data")
+
+# Nombres que genera write_kept_file para los MP3 de TTS y de la sesión de voz
+_SERVED_NAME = re.compile(rf"^{SCRATCH_PREFIX}(?:voice|ai)_[0-9a-f]{{32}}\.mp3$")
+
+_sweep_lock = threading.Lock()
+_last_sweep = 0.0
+
+
+def new_name(suffix="", prefix=""):
+    """Nombre único (sin directorio) para un archivo temporal."""
+    return f"{SCRATCH_PREFIX}{prefix}{uuid.uuid4().hex}{suffix}"
+
+
+def path_for(name):
+    return os.path.join(SCRATCH_DIR, name)
+
+
+def is_served(name):
+    """True si `name` es un MP3 entregado al cliente (lo único que expone /tmp/<archivo>)."""
+    return bool(_SERVED_NAME.match(name))
+
+
+def data_path(*parts):
+    """Ruta bajo DATA_DIR (creando los directorios); fuera del barrido y de /tmp/<archivo>."""
+    path = os.path.join(DATA_DIR, *parts)
+    os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+    return path
+
+
+@contextmanager
+def scratch_file(suffix="", prefix=""):
+    """Ruta única que se elimina al terminar el bloque."""
+    maybe_sweep()
+    path = path_for(new_name(suffix, prefix))
+    try:
+        yield path
+    finally:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print("⚠️ No se pudo borrar archivo temporal:", path, e)
+
+
+def write_kept_file(data, suffix="", prefix=""):
+    """
+    Escribe `data` en un archivo que sobrevive a la petición (hasta el TTL).
+    Devuelve solo el nombre, que es lo que se expone al cliente.
+    """
+    maybe_sweep()
+    name = new_name(suffix, prefix)
+    with open(path_for(name), "wb") as f:
+        f.write(data)
+    return name
+
+
+def sweep(max_age=None, directory=None):
+    """
+    Elimina los archivos temporales propios (de SCRATCH_DIR o de `directory`)
+    más viejos que `max_age` segundos.
+    """
+    max_age = SCRATCH_TTL_SECONDS if max_age is None else max_age
+    cutoff = time.time() - max_age
+    removed = 0
+    try:
+        entries = os.scandir(directory or SCRATCH_DIR)
+    except OSError:
+        return 0
+    with entries:
+        for entry in entries:
+            if not entry.name.startswith(SCRATCH_PREFIX):
+                continue
+            try:
+                if entry.is_file() and entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+                    removed += 1
+            except OSError:
+                pass
+    return removed
+
+
+def maybe_sweep():
+    """Barrido oportunista, como mucho una vez cada SWEEP_INTERVAL_SECONDS."""
+    global _last_sweep
+    now = time.time()
+    if now - _last_sweep < SWEEP_INTERVAL_SECONDS:
+        return
+    if not _sweep_lock.acquire(blocking=False):
+        return
+    try:
+        _last_sweep = now
+        sweep()
+    finally:
+        _sweep_lock.release()
@@ -1,19 +1,51 @@
-import os
-import time
-import xml.etree.ElementTree as ET
-from flask import Flask, request, jsonify, Response, send_file, render_template
-from flask_cors import CORS
-from dotenv import load_dotenv
+import startup
+
+with startup.timed("stdlib"):
+    import io
+    import json
+    import os
+    import threading
+    import time
+    from concurrent.futures import Future
+    from urllib.parse import quote
+
+with startup.timed("flask"):
+    from flask import Flask, request, jsonify, Response, send_file, render_template
+    from flask_cors import CORS
+    from flask import send_from_directory
+    from dotenv import load_dotenv
 
 # === IA y Audio ===
-import google.generativeai as genai
-import whisper
-from gtts import gTTS
-from flask import send_from_directory
+# Los módulos propios no importan whisper/torch, numpy, gtts ni
+# google.generativeai hasta que una ruta los necesita (ver startup.py)
+with startup.timed("app_modules"):
+    import analysis_cache
+    import audio_io
+    import combined_reply
+    import conversation_context
+    import dictation
+    import gemini_client
+    import jobs
+    import metrics
+    import negotiation
+    import pipeline
+    import prompts
+    import response_cache
+    import scratch_files
+    import session_store
+    import sse
+    import tts_stream
+    import uploads
+    import vision_preprocess
+    import voice_activity
+    import whisper_pool
+    import whisper_registry
 
 load_dotenv()
 
 app = Flask(__name__)
+# Tope global; cada ruta con archivos tiene además el suyo (ver uploads.py)
+app.config["MAX_CONTENT_LENGTH"] = uploads.max_content_length()
 CORS(app)
 
 # ===== GEMINI =====
@@ -21,670 +53,878 @@ GEMINI_KEY = os.getenv("GOOGLE_GEMINI_API_KEY")
 if not GEMINI_KEY:
     raise RuntimeError("Falta GOOGLE_GEMINI_API_KEY en .env")
 
-genai.configure(api_key=GEMINI_KEY)
-gemini_model = genai.GenerativeModel("gemini-2.5-flash")
+GEMINI_MODEL_NAME = "gemini-2.5-flash"
+# background = precalentar en un hilo al arrancar, off = solo con /warmup
+WARMUP_MODE = os.getenv("WARMUP_MODE", "background")
+
+
+class LazyGeminiModel:
+    """Importa google.generativeai y crea el modelo en el primer uso."""
+
+    def __init__(self, name):
+        self._name = name
+        self._model = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    genai = startup.lazy_import("google.generativeai")
+                    gemini_client.configure(genai, GEMINI_KEY)
+                    self._model = genai.GenerativeModel(self._name)
+        return self._model
+
+    def sdk(self):
+        """El módulo google.generativeai ya configurado (p.ej. para la File API)."""
+        self._load()
+        return startup.lazy_import("google.generativeai")
 
-# Inicializar modelo Gemini al arranque
-try:
-    print("🧩 Inicializando modelo Gemini...")
-    # Esto ejecuta una pequeña consulta para que el modelo cargue a memoria
-    _ = gemini_model.generate_content("Inicialización del sistema IA-MedAssistant.")
-    print("✅ Modelo Gemini listo para usar.")
-except Exception as e:
-    print("⚠️ Advertencia: no se pudo precargar el modelo Gemini:", e)
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
 
 
-# ===== XML UTILITIES =====
-def parse_xml_request():
-    """Parse XML request body and return dict"""
+# Plazos, reintentos, límite de concurrencia y circuit breaker (ver gemini_client.py)
+gemini_model = gemini_client.GeminiClient(LazyGeminiModel(GEMINI_MODEL_NAME))
+
+
+def generate_text(prompt):
+    """Llamada simple a Gemini que devuelve el texto limpio."""
+    resp = gemini_model.generate_content(prompt)
+    return (resp.text or "").strip()
+
+
+def warmup(include_whisper=whisper_registry.WHISPER_PRELOAD):
+    """
+    Precalienta Gemini (una consulta pequeña) y opcionalmente Whisper.
+    Devuelve el tiempo de cada paso.
+    """
+    timings = {}
     try:
-        xml_data = request.data.decode('utf-8')
-        root = ET.fromstring(xml_data)
-        data = {}
-        for child in root:
-            if child.tag == 'patient':
-                data['patient'] = {}
-                for patient_child in child:
-                    data['patient'][patient_child.tag] = patient_child.text
-            elif child.tag == 'studies':
-                data['studies'] = [study.text for study in child.findall('study')]
-            else:
-                data[child.tag] = child.text
-        return data
-    except Exception:
-        return {}
-
-def create_xml_response(data):
-    """Create XML response from dict"""
-    root = ET.Element('response')
-    for key, value in data.items():
-        elem = ET.SubElement(root, key)
-        elem.text = str(value)
-    xml_str = ET.tostring(root, encoding='unicode')
-    return Response(xml_str, mimetype='application/xml')
-
-def is_mobile_client():
-    """Detect if request is from mobile app"""
-    user_agent = request.headers.get('User-Agent', '').lower()
-    return 'mobile' in user_agent or 'android' in user_agent or 'ios' in user_agent
+        print("🧩 Inicializando modelo Gemini...")
+        start = time.perf_counter()
+        # Esto ejecuta una pequeña consulta para que el modelo cargue a memoria
+        gemini_model.generate_content("Inicialización del sistema IA-MedAssistant.")
+        timings["gemini"] = round(time.perf_counter() - start, 3)
+        print("✅ Modelo Gemini listo para usar.")
+    except Exception as e:
+        timings["gemini"] = f"error: {e}"
+        print("⚠️ Advertencia: no se pudo precargar el modelo Gemini:", e)
+
+    # ===== WHISPER =====
+    # Un único modelo por worker (WHISPER_MODEL, WHISPER_PRELOAD en .env)
+    if include_whisper:
+        start = time.perf_counter()
+        try:
+            whisper_pool.warmup()
+            timings["whisper"] = round(time.perf_counter() - start, 3)
+        except Exception as e:
+            timings["whisper"] = f"error: {e}"
+            print("⚠️ Advertencia: no se pudo precargar Whisper:", e)
+    return timings
+
+
+if WARMUP_MODE == "background":
+    threading.Thread(target=warmup, name="warmup", daemon=True).start()
+
+
+# ===== MÉTRICAS =====
+@app.before_request
+def start_trace():
+    """Traza de la petición: las etapas del Pipeline y las llamadas a Gemini se anotan en ella."""
+    metrics.start_trace(request.url_rule.rule if request.url_rule else "unmatched")
+
+
+@app.after_request
+def finish_trace(response):
+    trace = metrics.current_trace()
+    if trace is not None:
+        metrics.finish_request(trace, request.method, response.status_code)
+        if metrics.SERVER_TIMING:
+            response.headers["Server-Timing"] = trace.server_timing()
+    return response
+
 
 @app.route("/tmp/<path:filename>")
 def serve_tmp_file(filename):
-    """Sirve archivos temporales (como los .mp3 generados por la IA)."""
-    tmp_dir = "/tmp"
-    return send_from_directory(tmp_dir, filename, mimetype="audio/mpeg")
+    """Sirve los .mp3 generados por la IA; nada más de SCRATCH_DIR."""
+    if not scratch_files.is_served(filename):
+        return negotiation.render({"error": "Archivo no encontrado"}, 404)
+    return send_from_directory(scratch_files.SCRATCH_DIR, filename, mimetype="audio/mpeg")
+
+@app.errorhandler(413)
+def upload_too_large(_):
+    """Archivo por encima del tope de la ruta o de MAX_CONTENT_LENGTH."""
+    group = getattr(app.view_functions.get(request.endpoint), "upload_group", None)
+    limit_mb = round((uploads.limit_for(group) if group else app.config["MAX_CONTENT_LENGTH"]) / uploads.MB)
+    return negotiation.render({"error": f"Archivo demasiado grande (máximo {limit_mb} MB)"}, 413)
+
+@app.errorhandler(gemini_client.GeminiUnavailable)
+def gemini_unavailable(e):
+    """Circuito abierto o demasiadas llamadas en curso: el cliente debe reintentar."""
+    response = negotiation.render({"error": str(e)}, 503)
+    response.headers["Retry-After"] = str(gemini_model.breaker.retry_after() or 1)
+    return response
 
 @app.route('/favicon.ico')
 def favicon():
     """Evita 404 por favicon cuando no existe archivo físico."""
     return ("", 204)
 
-# ===== IA: Doctor (XML ONLY) =====
+# ===== IA: Doctor (XML por defecto, JSON con Accept/Content-Type) =====
+def doctor_prompt(patient, symptoms, studies):
+    return prompts.doctor(patient, symptoms, studies)
+
+
 @app.post("/api/ai/doctor")
 def ai_doctor():
-    body = parse_xml_request()
+    body = negotiation.read_body(default=negotiation.XML)
     patient = body.get("patient", {})
     symptoms = body.get("symptoms", "")
     studies  = body.get("studies", [])
 
-    prompt = f"""
-Eres un asistente que APOYA a un MÉDICO TITULADO.
-Devuelve:
-1) Resumen clínico (TENLO EN CUENTA, PERO NO LO MENCIONAS A MENOS DE QUE SE TE PIDA)
-2) 3-5 diagnósticos diferenciales con razonamiento corto.
-3) Próximos pasos sugeridos.
-4) Advertencia: el veredicto es del médico; esto NO sustituye consulta.
-
-Paciente: {patient}
-Síntomas: {symptoms}
-Estudios/URLs: {studies}
-Responde en español en formato claro y con viñetas.
-"""
+    prompt = doctor_prompt(patient, symptoms, studies)
+    fields = {"patient": patient, "symptoms": symptoms, "studies": studies}
     try:
-        resp = gemini_model.generate_content(prompt)
-        text = (resp.text or "").strip()
+        text = response_cache.cached("doctor", prompt, generate_text, fields)
+    except gemini_client.GeminiUnavailable:
+        raise
     except Exception as e:
         text = f"(demo) Error con Gemini: {e}"
 
-    return create_xml_response({"recommendation": text})
+    return negotiation.render({"recommendation": text}, fmt=negotiation.response_format(default=negotiation.XML))
+
+
+# ===== IA: Paciente (XML/JSON según Accept/Content-Type) =====
+def patient_prompt(patient, symptoms, studies):
+    return prompts.patient(patient, symptoms, studies)
 
 
-# ===== IA: Paciente (XML/JSON según cliente) =====
 @app.post("/api/ai/patient")
 def ai_patient():
-    is_mobile = is_mobile_client()
-    if is_mobile:
-        body = request.json or {}
-    else:
-        body = parse_xml_request()
+    """La app móvil manda JSON y recibe JSON; la web manda XML y recibe XML."""
+    fmt = negotiation.response_format(default=negotiation.XML)
+    body = negotiation.read_body(default=negotiation.XML)
 
     patient = body.get("patient", {})
     symptoms = body.get("symptoms", "")
     studies  = body.get("studies", [])
 
-    prompt = f"""
-Eres un asistente que habla con un PACIENTE. Tono empático y claro.
-Incluye:
-- Explicación sencilla de lo que podría estar pasando (no diagnóstico).
-- Señales de alarma si aplican.
-- Pasos sugeridos (p.ej. agendar cita).
-- A veces el paciente se siente más cómodo hablando contigo, no lo cortes.
-- PREGUNTA HASTA QUE LLEGUES A UN DIAGNOSTICO, NO ESPECULES. PERO UNA PREGUNTA A LA VEZ, ANALIZA LO QUE TE CONTESTO Y PREGUNTALE OTRA LUEGO DE SU RESPUESTA. SI YA SABES ALGO SIMPLEMENTE RESPONDELE
-- TRATA DE DAR REPSUESTAS BREVES, PERO SIN DEJAR LA SENSACIÓN DE QUE FUE MUY CORTA, ESTO POR QUE TU RESPUESTA SERÁ UTILIZADA PARA GENERAR UN AUDIO Y MANDARSELO AL PACIENTE. RECUERDA, MUY MUY CORTA
-- COMO TU RESPUESTA SE PASARA A AUDIO, NO PONGAS CARACTERIS COMO GUIONES, ASTERICOS, ETC...
-- NO MUESTRES LA INFORMACIÓN DEL PACIENTE A MENOS QUE SE TE PIDA.
-
-Paciente: {patient}
-Síntomas: {symptoms}
-Estudios/URLs: {studies}
-"""
+    prompt = patient_prompt(patient, symptoms, studies)
+    fields = {"patient": patient, "symptoms": symptoms, "studies": studies}
     try:
-        resp = gemini_model.generate_content(prompt)
-        text = (resp.text or "").strip()
+        text = response_cache.cached("patient", prompt, generate_text, fields)
+    except gemini_client.GeminiUnavailable:
+        raise
     except Exception as e:
         text = f"(demo) Error con Gemini: {e}"
 
-    if is_mobile:
-        return jsonify({"message": text})
-    else:
-        return create_xml_response({"message": text})
+    return negotiation.render({"message": text}, fmt=fmt)
 
 
-# ===== IA: File Analyzer JSON =====
-@app.post("/api/ai/file/analyze_json")
-def ai_file_analyze_json():
-    import json
+@app.post("/api/ai/patient/stream")
+def ai_patient_stream():
+    """Versión SSE de /api/ai/patient (cuerpo JSON o XML)."""
+    body = negotiation.read_body(default=negotiation.XML)
+    prompt = patient_prompt(body.get("patient", {}), body.get("symptoms", ""), body.get("studies", []))
 
-    upload = request.files.get("file")
-    if not upload or upload.filename == "":
-        return jsonify({"error": "Debes enviar un archivo en form-data con la clave 'file'."}), 400
+    def generate():
+        parts = []
+        try:
+            for text in sse.stream_text(gemini_model, prompt):
+                parts.append(text)
+                yield sse.event("token", {"text": text})
+        except Exception as e:
+            yield sse.event("error", {"error": f"(demo) Error con Gemini: {e}"})
+            return
+        yield sse.event("done", {"message": "".join(parts).strip()})
 
-    content_type = upload.mimetype or "application/octet-stream"
-    instructions = request.form.get("instructions", "").strip()
-    file_bytes = upload.read()
+    return sse.sse_response(generate())
+
+
+# ===== IA: Análisis de archivos =====
+def analyze_file(upload, mime_type, prompt, pipe=None, stage="gemini"):
+    """
+    Reduce imágenes y parte PDFs (vision_preprocess), analiza cada parte con
+    Gemini en paralelo y devuelve la lista de textos en orden.
+    """
+    pipe = pipe or pipeline.Pipeline()
+    parts = pipe.run("preprocess", vision_preprocess.prepare_upload, upload, mime_type)
+    genai = gemini_model.sdk()
+
+    def analyze(part):
+        with uploads.gemini_part(part, part.mimetype or mime_type, genai) as file_part:
+            resp = gemini_model.generate_content([file_part, prompt])
+        return (resp.text or "").strip()
 
-    prompt = f"""
-Analiza el archivo adjunto (imagen, PDF o DOCX).
-Extrae texto (OCR si aplica), estructura, tablas y datos clave.
+    if len(parts) == 1:
+        return [pipe.run(stage, analyze, parts[0])]
+    for i, part in enumerate(parts):
+        pipe.submit(f"{stage}_{i}", analyze, part)
+    return [pipe.result(f"{stage}_{i}") for i in range(len(parts))]
 
-Responde SOLO con un JSON válido (sin explicaciones).
-{('Instrucciones del usuario: ' + instructions) if instructions else ''}
-"""
+
+def parse_model_json(text):
     try:
-        parts = [{"mime_type": content_type, "data": file_bytes}, prompt]
-        resp = gemini_model.generate_content(parts)
-        text = (resp.text or "").strip()
+        return json.loads(text)
+    except Exception:
+        return {"raw_model_text": text}
 
-        try:
-            payload = json.loads(text)
-        except Exception:
-            payload = {"raw_model_text": text}
 
-        payload.setdefault("filename", upload.filename)
-        payload.setdefault("mime_type", content_type)
-        return jsonify(payload)
-    except Exception as e:
-        return jsonify({"error": f"Error procesando archivo con Gemini: {e}"}), 500
+# Cambia si cambia el prompt, el modelo o el preprocesamiento: invalida la caché
+FILE_ANALYSIS_VARIANT = "|".join(str(v) for v in (
+    prompts.FILE_ANALYSIS_PROMPT, GEMINI_MODEL_NAME, vision_preprocess.IMAGE_MAX_SIDE,
+    vision_preprocess.IMAGE_JPEG_QUALITY, vision_preprocess.PDF_PAGES_PER_PART,
+    vision_preprocess.PDF_MAX_PARTS, vision_preprocess.PDF_SPLIT_MIN_PAGES,
+))
 
 
-# ===== IA: File Analyzer XML =====
-@app.post("/api/ai/file/analyze_xml")
-def ai_file_analyze_xml():
-    import json
+def analyze_file_cached(upload, content_type, instructions):
+    """
+    Resultado estructurado (dict) del análisis, compartido por las versiones
+    JSON y XML. Devuelve (datos, hit_de_caché).
+    """
+    prompt = prompts.file_analysis(instructions)
+
+    def analyze():
+        texts = analyze_file(upload, content_type, prompt)
+        return vision_preprocess.merge_results([parse_model_json(t) for t in texts])
+
+    key = analysis_cache.cache_key(upload, content_type, instructions, FILE_ANALYSIS_VARIANT)
+    data, hit = analysis_cache.cached(key, analyze)
+    data = dict(data)
+    data.setdefault("filename", upload.filename)
+    data.setdefault("mime_type", content_type)
+    return data, hit
+
+
+def analyze_file_job(saved, content_type, instructions):
+    with uploads.reopened(saved) as upload:
+        data, _ = analyze_file_cached(upload, content_type, instructions)
+    return data
+
 
+# ===== TRABAJOS ASÍNCRONOS =====
+def wants_async():
+    """El cliente pide procesar en segundo plano (?async=1 o campo de form)."""
+    return str(request.values.get("async", "")).lower() in ("1", "true", "yes")
+
+
+def enqueue_job(kind, fn, saved, *args, callback_url=None):
+    """
+    Encola fn(saved, *args) sin depender de la petición (también lo usa
+    asgi.py). `saved` es el archivo de uploads.save_for_later(); se borra si
+    no se encola. Devuelve (payload, status): 202, 400 o 503.
+    """
+    if not jobs.valid_callback_url(callback_url):
+        uploads.discard(saved)
+        return {"error": "callback_url debe ser una URL http(s) pública"}, 400
+    try:
+        job_id = jobs.queue.submit(kind, fn, saved, *args, callback_url=callback_url)
+    except jobs.JobsBusy as e:
+        uploads.discard(saved)
+        return {"error": str(e)}, 503
+    return {"job_id": job_id, "status": "queued", "status_url": f"/api/jobs/{job_id}"}, 202
+
+
+def submit_job(kind, fn, saved, *args, fmt=None):
+    """Encola el trabajo y responde 202 con su id (o 400/503)."""
+    callback_url = request.values.get("callback_url", "").strip() or None
+    payload, status = enqueue_job(kind, fn, saved, *args, callback_url=callback_url)
+    return negotiation.render(payload, status, fmt)
+
+
+@app.get("/api/jobs/<job_id>")
+def job_status(job_id):
+    job = jobs.queue.get(job_id)
+    if job is None:
+        return negotiation.render({"error": "Trabajo no encontrado o expirado"}, 404)
+    return negotiation.render(job, 202 if job["status"] in ("queued", "running") else 200)
+
+
+# ===== IA: File Analyzer (JSON / XML) =====
+@app.post("/api/ai/file/analyze_json")
+@app.post("/api/ai/file/analyze_xml", defaults={"fmt": negotiation.XML})
+@uploads.limited("document")
+def ai_file_analyze(fmt=None):
+    fmt = negotiation.response_format(fmt)
     upload = request.files.get("file")
     if not upload or upload.filename == "":
-        return create_xml_response({"error": "Debes enviar un archivo en form-data con la clave 'file'."})
+        return negotiation.render({"error": "Debes enviar un archivo en form-data con la clave 'file'."}, 400, fmt)
 
     content_type = upload.mimetype or "application/octet-stream"
     instructions = request.form.get("instructions", "").strip()
-    file_bytes = upload.read()
-
-    prompt = f"""
-Analiza el archivo adjunto (imagen, PDF o DOCX).
-Extrae texto (OCR), estructura, tablas y datos clave.
-En español
-{('Instrucciones del usuario: ' + instructions) if instructions else ''}
-"""
+
+    if wants_async():
+        saved = uploads.save_for_later(upload)
+        return submit_job("file-analysis", analyze_file_job, saved, content_type, instructions, fmt=fmt)
+
     try:
-        parts = [{"mime_type": content_type, "data": file_bytes}, prompt]
-        resp = gemini_model.generate_content(parts)
-        text = (resp.text or "").strip()
-        try:
-            data = json.loads(text)
-        except Exception:
-            data = {"raw_model_text": text}
-        data.setdefault("filename", upload.filename)
-        data.setdefault("mime_type", content_type)
-
-        root = ET.Element("response")
-        def build_xml(parent, obj, item_tag="item"):
-            if isinstance(obj, dict):
-                for k, v in obj.items():
-                    child = ET.SubElement(parent, str(k))
-                    build_xml(child, v, item_tag=item_tag)
-            elif isinstance(obj, list):
-                for it in obj:
-                    child = ET.SubElement(parent, item_tag)
-                    build_xml(child, it, item_tag=item_tag)
-            else:
-                parent.text = "" if obj is None else str(obj)
-        build_xml(root, data)
-        xml_str = ET.tostring(root, encoding="unicode")
-        return Response(xml_str, mimetype="application/xml")
+        data, hit = analyze_file_cached(upload, content_type, instructions)
+        return negotiation.render(data, fmt=fmt, headers={"X-Cache": "hit" if hit else "miss"}, stream=True)
+    except gemini_client.GeminiUnavailable:
+        raise
     except Exception as e:
-        return create_xml_response({"error": f"Error procesando archivo con Gemini: {e}"})
+        return negotiation.render({"error": f"Error procesando archivo con Gemini: {e}"}, 500, fmt)
 
 
 # ===== IA: Texto a Voz =====
 @app.post("/api/ai/text-to-speech")
-def text_to_speech():
-    text = request.json.get("text", "").strip()
-    if not text:
-        return jsonify({"error": "Falta el campo 'text'"}), 400
+@app.post("/api/ai/text-to-speech-xml", defaults={"fmt": negotiation.XML})
+def text_to_speech(fmt=None):
+    """
+    Devuelve el MP3 directamente, salvo con el alias -xml o un cuerpo XML:
+    entonces se guarda y se devuelve el nombre del archivo en XML. El Accept
+    no cuenta: clientes como axios mandan "application/json, ..." por defecto
+    y esperan el audio.
+    """
+    body_format = negotiation.request_format()
+    fmt = fmt or (negotiation.XML if body_format == negotiation.XML else None)
 
-    tts = gTTS(text=text, lang="es", tld="com.mx")
-    out_path = "/tmp/output.mp3"
-    tts.save(out_path)
-    return send_file(out_path, mimetype="audio/mpeg", as_attachment=False)
+    text = (negotiation.read_body().get("text") or "").strip()
+    if not text:
+        return negotiation.render({"error": "Falta el campo 'text'"}, 400, fmt or body_format)
 
-@app.post("/api/ai/text-to-speech-xml")
-def text_to_speech_xml():
     try:
-        xml_data = request.data.decode("utf-8")
-        root = ET.fromstring(xml_data)
-        text_elem = root.find("text")
-        if text_elem is None or not text_elem.text.strip():
-            return create_xml_response({"error": "Falta el campo <text> en el XML"})
-
-        text = text_elem.text.strip()
-        tts = gTTS(text=text, lang="es", tld="com.mx")
-        out_path = "/tmp/output_voice.mp3"
-        tts.save(out_path)
-
-        # En este caso devolvemos un XML que indica éxito, más el archivo MP3
-        response = create_xml_response({"status": "ok", "message": "Audio generado exitosamente", "file": "output_voice.mp3"})
-        return response
+        with metrics.span("tts"):
+            mp3 = audio_io.synthesize_mp3(text)
     except Exception as e:
-        return create_xml_response({"error": str(e)})
+        return negotiation.render({"error": str(e)}, 500, fmt or body_format)
+    if fmt is None:
+        return send_file(io.BytesIO(mp3), mimetype="audio/mpeg", as_attachment=False)
+
+    out_name = scratch_files.write_kept_file(mp3, suffix=".mp3", prefix="voice_")
+    return negotiation.render({"status": "ok", "message": "Audio generado exitosamente", "file": out_name}, fmt=fmt)
+
+@app.post("/api/ai/text-to-speech/stream")
+def text_to_speech_stream():
+    """
+    Igual que /api/ai/text-to-speech, pero sintetiza por frases en paralelo
+    y envía el MP3 en una respuesta chunked a medida que cada frase está lista.
+    """
+    text = (request.json or {}).get("text", "").strip()
+    if not text:
+        return jsonify({"error": "Falta el campo 'text'"}), 400
+    return Response(tts_stream.stream_speech([text]), mimetype="audio/mpeg")
 
 # ===== IA: Voz a Texto =====
+WHISPER_BUSY_MESSAGE = "Servicio de transcripción saturado, intenta de nuevo en unos segundos"
+
+
+@app.errorhandler(whisper_pool.WhisperBusy)
+def whisper_busy(_):
+    """Cola de Whisper llena (WHISPER_QUEUE_MAX): el cliente debe reintentar."""
+    return negotiation.render({"error": WHISPER_BUSY_MESSAGE}, 503)
+
+
+def transcribe_upload(upload, pipe=None, **options):
+    """
+    Decodifica el audio subido, recorta silencios (VAD) y lo transcribe.
+    Devuelve (texto, info_vad); si no hay voz, el texto es "" y Whisper no se llama.
+    """
+    pipe = pipe or pipeline.Pipeline()
+    audio = pipe.run("decode", audio_io.decode_upload, upload)
+    prepared = pipe.run("vad", voice_activity.prepare, audio)
+    if prepared.is_empty:
+        return "", prepared.info()
+    options.setdefault("language", "es")
+    texts = pipe.run("whisper", whisper_pool.transcribe_many, prepared.chunks, **options)
+    return " ".join(t.strip() for t in texts).strip(), prepared.info()
+
+
+def with_vad(response, vad):
+    response.headers["X-Audio-Seconds-Saved"] = str(vad["saved_seconds"])
+    return response
+
+
 @app.post("/api/ai/speech-to-text")
-def speech_to_text():
+@app.post("/api/ai/speech-to-text-xml", defaults={"fmt": negotiation.XML})
+@uploads.limited("audio")
+def speech_to_text(fmt=None):
+    fmt = negotiation.response_format(fmt)
     upload = request.files.get("file")
     if not upload:
-        return jsonify({"error": "Falta el archivo de audio ('file')"}), 400
+        return negotiation.render({"error": "Falta el archivo de audio ('file')"}, 400, fmt)
 
-    file_path = "/tmp/audio_input.wav"
-    upload.save(file_path)
+    try:
+        text, vad = transcribe_upload(upload)
+    except whisper_pool.WhisperBusy:
+        raise
+    except Exception as e:
+        return negotiation.render({"error": str(e)}, 500, fmt)
+    return with_vad(negotiation.render({"text": text}, fmt=fmt), vad)
 
-    model = whisper.load_model("base")
-    result = model.transcribe(file_path, language="es")
 
-    text = result["text"].strip()
-    return jsonify({"text": text})
+# ---------- Dictado en vivo ----------
+@app.post("/api/ai/speech-to-text/stream")
+def speech_to_text_stream_start():
+    """Abre un dictado; el audio se sube después por segmentos."""
+    data = request.get_json(silent=True) or {}
+    session = dictation.start(data.get("language", "es"))
+    return jsonify({"dictation_id": session.id})
 
-@app.post("/api/ai/speech-to-text-xml")
-def speech_to_text_xml():
-    try:
-        upload = request.files.get("file")
-        if not upload:
-            return create_xml_response({"error": "Falta el archivo de audio ('file')"})
-        
-        file_path = "/tmp/audio_input_xml.wav"
-        upload.save(file_path)
 
-        model = whisper.load_model("base")
-        result = model.transcribe(file_path, language="es")
-        text = result["text"].strip()
+@app.post("/api/ai/speech-to-text/stream/<dictation_id>")
+@uploads.limited("audio")
+def speech_to_text_stream_segment(dictation_id):
+    """
+    Sube un segmento (`file`, con `seq` opcional) y devuelve su texto y la
+    transcripción acumulada. Con `final=1` (con o sin archivo) cierra el dictado.
+    """
+    final = request.form.get("final", "0").lower() in ("1", "true", "yes")
+    seq = request.form.get("seq", type=int)
+    upload = request.files.get("file")
+    if not upload and not final:
+        return jsonify({"error": "Falta el archivo de audio ('file')"}), 400
 
-        return create_xml_response({"text": text})
+    session = dictation.get(dictation_id)
+    if session is None:
+        return jsonify({"error": "Dictado no encontrado o expirado"}), 404
+    try:
+        with metrics.span("decode"):
+            samples = audio_io.decode_upload(upload) if upload else None
+        if final:
+            partial = dictation.finish(dictation_id, samples, seq=seq)
+        else:
+            partial = session.add(samples, seq=seq)
+    except dictation.DictationError as e:
+        return jsonify({"error": str(e)}), 409
+    except whisper_pool.WhisperBusy:
+        return jsonify({"error": WHISPER_BUSY_MESSAGE}), 503
     except Exception as e:
-        return create_xml_response({"error": str(e)})
-    
+        return jsonify({"error": str(e)}), 500
+    if partial is None:
+        return jsonify({"error": "Dictado no encontrado o expirado"}), 404
+    return jsonify(partial)
+
 
 # ====== MEMORIA Y RESÚMENES (PACIENTE) ======
 
-conversations = {}  # memoria temporal en RAM {session_id: [{"role": "...", "content": "..."}]}
+# Historial por session_id: en RAM acotada o SQLite compartido (SESSION_STORE en .env)
+conversations = session_store.create_store()
+# Últimos turnos literales + resumen acumulado de los anteriores
+context_manager = conversation_context.ConversationContext(conversations, generate_text)
+
+def summary_prompt(text):
+    return prompts.summary(text)
+
+
+# Lo mismo que pide summary_prompt, para el modo de una sola llamada
+SUMMARY_INSTRUCTION = "resumen de tu respuesta en 3 líneas máximo, con tono médico y conciso"
+
 
 def summarize_text(text):
     """Genera un mini resumen clínico de una respuesta."""
     try:
-        prompt = f"""
-Eres un médico que está redactando notas clínicas. 
-Resume lo siguiente en 3 líneas máximo, con tono médico y conciso:
-
-Texto: {text}
-"""
-        resp = gemini_model.generate_content(prompt)
+        resp = gemini_model.generate_content(summary_prompt(text))
         summary = (resp.text or "").strip()
         return summary
     except Exception as e:
         return f"(Error al resumir: {e})"
 
 
-# ---------- JSON ----------
-@app.post("/api/ai/interaction")
-def ai_interaction_json():
+def reply_with_summary(prompt):
     """
-    Maneja interacción con memoria (versión JSON)
-    - Guarda historial
-    - Devuelve respuesta + mini resumen
+    (respuesta, resumen): con COMBINED_REPLY=1 en una sola llamada; si está
+    apagado o el JSON no es válido, respuesta y luego resumen.
     """
-    data = request.json or {}
-    session_id = data.get("session_id", "default")
-    message = data.get("message", "")
-    history = data.get("history", [])
+    if combined_reply.COMBINED_REPLY:
+        result = combined_reply.generate(gemini_model, prompt, SUMMARY_INSTRUCTION)
+        if result:
+            return result["response"], result["summary"]
+    answer = generate_text(prompt)
+    return answer, summarize_text(answer)
 
-    if not message:
-        return jsonify({"error": "Falta 'message'"}), 400
 
-    conversations.setdefault(session_id, [])
-    conversations[session_id].append({"role": "user", "content": message})
+def interaction_prompt(context, message):
+    """Prompt de la interacción a partir del historial ya formateado."""
+    return prompts.interaction(context, message)
 
-    # Construye contexto con historial previo
-    context = "\n".join([f"{m['role']}: {m['content']}" for m in history])
-    full_prompt = f"""
-Eres un asistente médico que habla con un PACIENTE. 
-Sé empático y claro, pero profesional. Usa el historial para dar continuidad.
 
-Historial:
-{context}
+def build_interaction_prompt(session_id, history, message):
+    """
+    Usa el historial que manda el cliente o, si no manda ninguno, el contexto
+    guardado de la sesión (resumen acumulado + últimos turnos). Llamar después
+    de guardar el mensaje del usuario.
+    """
+    if history:
+        context = "\n".join(f"{m.get('role', '')}: {m.get('content', '')}" for m in history if isinstance(m, dict))
+    else:
+        context = context_manager.build(session_id, exclude_last=1)
+    return interaction_prompt(context, message)
 
-Paciente: {message}
-"""
 
-    try:
-        resp = gemini_model.generate_content(full_prompt)
-        answer = (resp.text or "").strip()
-        conversations[session_id].append({"role": "assistant", "content": answer})
+def read_interaction():
+    """(session_id, message, history) del cuerpo JSON o XML."""
+    data = negotiation.read_body()
+    history = data.get("history") or []
+    return (
+        data.get("session_id") or "default",
+        (data.get("message") or "").strip(),
+        history if isinstance(history, list) else [],
+    )
 
-        summary = summarize_text(answer)
 
-        return jsonify({
+@app.post("/api/ai/interaction")
+@app.post("/api/ai/interaction-xml", defaults={"fmt": negotiation.XML})
+def ai_interaction(fmt=None):
+    """
+    Interacción con memoria (JSON o XML):
+    - Guarda historial
+    - Devuelve respuesta + mini resumen
+    """
+    fmt = negotiation.response_format(fmt)
+    session_id, message, history = read_interaction()
+    if not message:
+        return negotiation.render({"error": "Falta 'message'"}, 400, fmt)
+
+    conversations.append(session_id, "user", message)
+
+    try:
+        answer, summary = reply_with_summary(build_interaction_prompt(session_id, history, message))
+        conversations.append(session_id, "assistant", answer)
+        context_manager.maybe_fold(session_id)
+
+        return negotiation.render({
             "session_id": session_id,
             "response": answer,
             "summary": summary
-        })
+        }, fmt=fmt)
+    except gemini_client.GeminiUnavailable:
+        raise
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return negotiation.render({"error": str(e)}, 500, fmt)
 
 
-# ---------- XML ----------
-@app.post("/api/ai/interaction-xml")
-def ai_interaction_xml():
+# ---------- SSE ----------
+@app.post("/api/ai/interaction/stream")
+def ai_interaction_stream():
     """
-    Versión XML del endpoint con memoria
+    Igual que /api/ai/interaction pero envía la respuesta por SSE:
+    eventos `token` mientras Gemini genera, luego `audio` (archivo MP3),
+    `summary` y `done`.
     """
-    try:
-        xml_data = request.data.decode("utf-8")
-        root = ET.fromstring(xml_data)
-
-        session_elem = root.find("session_id")
-        message_elem = root.find("message")
+    session_id, message, history = read_interaction()
+    if not message:
+        return negotiation.render({"error": "Falta 'message'"}, 400)
 
-        session_id = session_elem.text if session_elem is not None else "default"
-        message = message_elem.text.strip() if message_elem is not None else ""
+    conversations.append(session_id, "user", message)
+    full_prompt = build_interaction_prompt(session_id, history, message)
 
-        if not message:
-            return create_xml_response({"error": "Falta <message> en XML"})
+    def generate():
+        parts = []
+        try:
+            for text in sse.stream_text(gemini_model, full_prompt):
+                parts.append(text)
+                yield sse.event("token", {"text": text})
+        except Exception as e:
+            yield sse.event("error", {"error": str(e)})
+            return
+
+        answer = "".join(parts).strip()
+        conversations.append(session_id, "assistant", answer)
+        context_manager.maybe_fold(session_id)
+        # La voz se sintetiza mientras se genera el resumen
+        pipe = pipeline.Pipeline()
+        pipe.submit("tts", synthesize_to_file, answer, "ai_", timeout=TTS_TIMEOUT_SECONDS)
+        summary = summarize_text(answer)
 
-        conversations.setdefault(session_id, [])
-        conversations[session_id].append({"role": "user", "content": message})
+        audio_name = pipe.result("tts", default=None)
+        if audio_name:
+            yield sse.event("audio", {"audio_file": audio_name})
+        yield sse.event("summary", {"summary": summary})
+        yield sse.event("done", {"session_id": session_id, "response": answer})
 
-        history = conversations[session_id]
-        context = "\n".join([f"{m['role']}: {m['content']}" for m in history[:-1]])
+    return sse.sse_response(generate())
 
-        full_prompt = f"""
-Eres un asistente médico que habla con un PACIENTE. Sé empático y claro.
-Historial previo:
-{context}
 
-Paciente: {message}
-"""
+# ====== CONCLUSIÓN FINAL (PACIENTE) ======
+def conclusion_prompt(full_text):
+    return prompts.conclusion(full_text)
 
-        resp = gemini_model.generate_content(full_prompt)
-        answer = (resp.text or "").strip()
-        conversations[session_id].append({"role": "assistant", "content": answer})
 
-        summary = summarize_text(answer)
+@app.post("/api/ai/conclusion")
+@app.post("/api/ai/conclusion-xml", defaults={"fmt": negotiation.XML})
+def ai_conclusion(fmt=None):
+    """
+    Crea un resumen final de toda la conversación del paciente (JSON o XML)
+    """
+    fmt = negotiation.response_format(fmt)
+    session_id = negotiation.read_body().get("session_id") or "default"
+    if not conversations.count(session_id):
+        return negotiation.render({"error": "No hay historial para esta sesión"}, 400, fmt)
 
-        return create_xml_response({
+    # Resumen acumulado + turnos aún no resumidos, en vez de toda la transcripción
+    full_text = context_manager.full_summary(session_id)
+    try:
+        conclusion = generate_text(conclusion_prompt(full_text))
+        return negotiation.render({
             "session_id": session_id,
-            "response": answer,
-            "summary": summary
-        })
+            "conclusion": conclusion
+        }, fmt=fmt)
+    except gemini_client.GeminiUnavailable:
+        raise
     except Exception as e:
-        return create_xml_response({"error": str(e)})
+        return negotiation.render({"error": str(e)}, 500, fmt)
 
 
-# ====== CONCLUSIÓN FINAL (PACIENTE) ======
+# ====== SESIÓN DE VOZ ======
+# El resumen y la síntesis de voz solo dependen de la respuesta de la IA,
+# así que corren en paralelo en el pool de `pipeline`.
+SUMMARY_TIMEOUT_SECONDS = float(os.getenv("SUMMARY_TIMEOUT_SECONDS", "10"))
+TTS_TIMEOUT_SECONDS = float(os.getenv("TTS_TIMEOUT_SECONDS", "15"))
 
-# ---------- JSON ----------
-@app.post("/api/ai/conclusion")
-def ai_conclusion_json():
-    """
-    Crea un resumen final de toda la conversación del paciente (versión JSON)
-    """
-    data = request.json or {}
-    session_id = data.get("session_id", "default")
-    history = conversations.get(session_id, [])
 
-    if not history:
-        return jsonify({"error": "No hay historial para esta sesión"}), 400
+def synthesize_to_file(text, prefix):
+    """Genera el MP3 y lo deja disponible en /tmp/<nombre> hasta el TTL."""
+    return scratch_files.write_kept_file(audio_io.synthesize_mp3(text), suffix=".mp3", prefix=prefix)
 
-    full_text = "\n".join([f"{m['role']}: {m['content']}" for m in history])
 
-    prompt = f"""
-Eres un médico escribiendo la CONCLUSIÓN FINAL de una consulta con un paciente.
-Haz un resumen clínico en 8–10 líneas que incluya:
-- Motivo de consulta
-- Síntomas principales
-- Evolución durante la conversación
-- Posibles diagnósticos diferenciales
-- Recomendaciones finales
-- Advertencia de que no sustituye una consulta real
+def wants_deferred_summary():
+    """El cliente pide no esperar el resumen (?defer_summary=1 o campo de form)."""
+    return str(request.values.get("defer_summary", "")).lower() in ("1", "true", "yes")
+
+
+def voice_prompt(user_text):
+    return prompts.voice(user_text)
+
+
+VOICE_SUMMARY_INSTRUCTION = "nota médica de 2 líneas máximo sobre tu respuesta"
+
+
+def voice_summary_prompt(ai_text):
+    return prompts.voice_summary(ai_text)
 
-Conversación:
-{full_text}
-"""
-    try:
-        resp = gemini_model.generate_content(prompt)
-        conclusion = (resp.text or "").strip()
-        return jsonify({
-            "session_id": session_id,
-            "conclusion": conclusion
-        })
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
 
+def with_timings(response, pipe):
+    response.headers["X-Pipeline-Timings"] = json.dumps(pipe.timings())
+    return response
 
-# ---------- XML ----------
-@app.post("/api/ai/conclusion-xml")
-def ai_conclusion_xml():
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".gif", ".bmp", ".webp", ".pdf")
+
+IMAGE_INPUT_PROMPT = prompts.IMAGE_INPUT_PROMPT
+
+
+def is_image_upload(upload):
+    filename = (upload.filename or "").lower()
+    mime_type = upload.mimetype or ""
+    return filename.endswith(IMAGE_EXTENSIONS) or mime_type.startswith("image/") or mime_type == "application/pdf"
+
+
+def voice_input_text(upload, pipe):
+    """
+    Texto del paciente: transcripción si es audio, interpretación de Gemini
+    si es una imagen o PDF. Devuelve (texto, info_vad o None).
     """
-    Crea un resumen final en XML de la sesión del paciente.
+    if is_image_upload(upload):
+        texts = analyze_file(upload, upload.mimetype or "", IMAGE_INPUT_PROMPT, pipe, stage="gemini_ocr")
+        return "\n\n".join(texts), None
+    return transcribe_upload(upload, pipe)
+
+
+def run_voice_session(upload, pipe, defer_summary=False):
     """
+    Pasos 1-6 de la sesión de voz, sin depender de la petición (también los
+    usa la cola de trabajos). Devuelve (payload, info_vad); payload es None
+    si el audio no tenía voz.
+    """
+    # 1 y 2. Audio: decodificar, recortar silencios y transcribir (Whisper);
+    #        imagen: interpretarla con Gemini
+    user_text, vad = voice_input_text(upload, pipe)
+    if not user_text:
+        return None, vad
+
+    # 3. Enviar texto a IA (modelo paciente); con COMBINED_REPLY=1 trae ya el resumen
+    prompt = voice_prompt(user_text)
+    combined = None
+    if combined_reply.COMBINED_REPLY:
+        combined = pipe.run("gemini_reply", combined_reply.generate, gemini_model, prompt, VOICE_SUMMARY_INSTRUCTION)
+    if combined:
+        ai_text = combined["response"]
+        summary = Future()
+        summary.set_result(combined["summary"])
+    else:
+        ai_text = pipe.run("gemini_reply", generate_text, prompt)
+        # 4. Resumen clínico breve, en paralelo con la voz
+        summary = pipe.submit("summary", generate_text, voice_summary_prompt(ai_text), timeout=SUMMARY_TIMEOUT_SECONDS)
+
+    # 5. Texto → voz
+    pipe.submit("tts", synthesize_to_file, ai_text, "ai_", timeout=TTS_TIMEOUT_SECONDS)
+
+    # El audio es opcional: sin él la respuesta sigue siendo útil
     try:
-        xml_data = request.data.decode("utf-8")
-        root = ET.fromstring(xml_data)
-        session_elem = root.find("session_id")
-        session_id = session_elem.text if session_elem is not None else "default"
-
-        history = conversations.get(session_id, [])
-        if not history:
-            return create_xml_response({"error": "No hay historial para esta sesión"})
-
-        full_text = "\n".join([f"{m['role']}: {m['content']}" for m in history])
-
-        prompt = f"""
-Eres un médico haciendo el CIERRE DE CONSULTA con un paciente.
-Redacta un resumen final de 8–10 líneas con tono médico profesional.
-
-Incluye:
-- Motivo de consulta
-- Síntomas relevantes
-- Evolución
-- Diagnósticos diferenciales
-- Recomendaciones y próximos pasos
-
-Conversación completa:
-{full_text}
-"""
-        resp = gemini_model.generate_content(prompt)
-        conclusion = (resp.text or "").strip()
-        return create_xml_response({
-            "session_id": session_id,
-            "conclusion": conclusion
-        })
+        audio_name = pipe.result("tts")
     except Exception as e:
-        return create_xml_response({"error": str(e)})
+        print("⚠️ No se pudo generar el audio:", e)
+        audio_name = None
+
+    # 6. Devolver resultado
+    payload = {
+        "status": "ok",
+        "input_text": user_text,
+        "ai_response": ai_text,
+        "audio_file": audio_name
+    }
+    if defer_summary:
+        payload["summary_id"] = pipeline.defer(summary)
+    elif combined:
+        payload["summary"] = combined["summary"]
+    else:
+        payload["summary"] = pipe.result("summary", default="(sin resumen disponible)")
+    return payload, vad
+
+
+def run_voice_session_job(saved):
+    with uploads.reopened(saved) as upload:
+        pipe = pipeline.Pipeline()
+        payload, vad = run_voice_session(upload, pipe)
+    if payload is None:
+        raise ValueError("No se pudo transcribir audio")
+    payload["timings"] = pipe.timings()
+    payload["vad"] = vad
+    return payload
 
 
 @app.post("/api/ai/voice-session")
-def ai_voice_session_json():
+@app.post("/api/ai/voice-session-xml", defaults={"fmt": negotiation.XML})
+@uploads.limited("document")
+def ai_voice_session(fmt=None):
     """
-    Flujo completo (JSON):
-    1️⃣ Recibe audio de voz (usuario)
-    2️⃣ Transcribe con Whisper
+    Flujo completo (JSON o XML):
+    1️⃣ Recibe audio de voz o una imagen/PDF
+    2️⃣ Transcribe con Whisper (audio) o interpreta con Gemini (imagen)
     3️⃣ Envía texto al modelo de paciente (Gemini)
-    4️⃣ Genera resumen clínico
-    5️⃣ Convierte respuesta a voz (gTTS)
-    6️⃣ Devuelve texto y audio en JSON
+    4️⃣ Genera resumen clínico      ┐ en paralelo
+    5️⃣ Convierte respuesta a voz   ┘ (gTTS)
+    6️⃣ Devuelve texto y audio
+
+    Con defer_summary=1 no se espera el resumen: se devuelve `summary_id`
+    y se recoge en /api/ai/voice-session/summary/<summary_id>.
     """
+    fmt = negotiation.response_format(fmt)
     try:
         upload = request.files.get("file")
         if not upload:
-            return jsonify({"error": "Falta el archivo de audio ('file')"}), 400
-
-        # 1. Guardar audio temporal
-        input_path = "/tmp/input_voice.wav"
-        upload.save(input_path)
-
-        # 2. Transcripción (Whisper)
-        model = whisper.load_model("base")
-        result = model.transcribe(input_path, language="es")
-        user_text = result["text"].strip()
-        if not user_text:
-            return jsonify({"error": "No se pudo transcribir audio"}), 400
-
-        # 3. Enviar texto a IA (modelo paciente)
-        prompt = f"""
-        Eres un asistente médico empático que conversa con un paciente.
-        Paciente: "{user_text}"
-        Responde de forma clara, breve y profesional.
-        - PREGUNTA HASTA QUE LLEGUES A UN DIAGNOSTICO, NO ESPECULES. PERO UNA PREGUNTA A LA VEZ, ANALIZA LO QUE TE CONTESTO Y PREGUNTALE OTRA LUEGO DE SU RESPUESTA. SI YA SABES ALGO SIMPLEMENTE RESPONDELE
-        - TRATA DE DAR REPSUESTAS BREVES, PERO SIN DEJAR LA SENSACIÓN DE QUE FUE MUY CORTA, ESTO POR QUE TU RESPUESTA SERÁ UTILIZADA PARA GENERAR UN AUDIO Y MANDARSELO AL PACIENTE. RECUERDA, MUY MUY CORTA
-        - COMO TU RESPUESTA SE PASARA A AUDIO, NO PONGAS CARACTERES COMO GUIONES, ASTERICOS, ETC...
-        """
-        resp = gemini_model.generate_content(prompt)
-        ai_text = (resp.text or "").strip()
-
-        # 4. Resumen clínico breve
-        try:
-            summary_prompt = f"Redacta una nota médica de 2 líneas máximo: {ai_text}"
-            summary_resp = gemini_model.generate_content(summary_prompt)
-            summary = (summary_resp.text or "").strip()
-        except Exception:
-            summary = "(sin resumen disponible)"
-
-        # 5. Texto → voz
-        tts = gTTS(text=ai_text, lang="es", tld="com.mx")
-        output_path = "/tmp/output_ai.mp3"
-        tts.save(output_path)
-
-        # 6. Devolver resultado
-        return jsonify({
-            "status": "ok",
-            "input_text": user_text,
-            "ai_response": ai_text,
-            "summary": summary,
-            "audio_file": "output_ai.mp3"
-        })
-
+            return negotiation.render({"error": "Falta el archivo ('file')"}, 400, fmt)
+
+        if wants_async():
+            saved = uploads.save_for_later(upload)
+            return submit_job("voice-session", run_voice_session_job, saved, fmt=fmt)
+
+        pipe = pipeline.Pipeline()
+        payload, vad = run_voice_session(upload, pipe, defer_summary=wants_deferred_summary())
+        if payload is None:
+            return negotiation.render({"error": "No se pudo transcribir audio"}, 400, fmt)
+        response = with_timings(negotiation.render(payload, fmt=fmt), pipe)
+        return with_vad(response, vad) if vad else response
+
+    except whisper_pool.WhisperBusy:
+        return negotiation.render({"error": WHISPER_BUSY_MESSAGE}, 503, fmt)
+    except gemini_client.GeminiUnavailable:
+        raise
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return negotiation.render({"error": str(e)}, 500, fmt)
 
 
-@app.post("/api/ai/voice-session-xml")
-def ai_voice_session_xml():
+# ---------- SSE ----------
+@app.post("/api/ai/voice-session/stream")
+@uploads.limited("audio")
+def ai_voice_session_stream():
     """
-    Flujo completo (XML):
-    1️⃣ Recibe audio o imagen
-    2️⃣ Si es audio → transcribe con Whisper
-    3️⃣ Si es imagen → analiza con Gemini (OCR + interpretación)
-    4️⃣ Envía el texto resultante a Gemini para generar respuesta empática y breve
-    5️⃣ Resume clínicamente
-    6️⃣ Convierte la respuesta a voz
-    7️⃣ Devuelve todo en XML limpio
+    Sesión de voz por SSE: `transcript` con el texto del usuario, `token`
+    mientras Gemini responde, luego `audio` (archivo MP3), `summary` y `done`.
     """
+    upload = request.files.get("file")
+    if not upload:
+        return jsonify({"error": "Falta el archivo de audio ('file')"}), 400
+
+    # La transcripción va antes del stream: el archivo subido solo vive
+    # durante la petición y un audio vacío debe responder 400.
+    pipe = pipeline.Pipeline()
     try:
-        upload = request.files.get("file")
-        if not upload:
-            return create_xml_response({"error": "Falta el archivo ('file')"})
-
-        filename = upload.filename.lower()
-        mime_type = upload.mimetype or ""
-        is_audio = any(ext in filename for ext in [".wav", ".mp3", ".webm", ".m4a"])
-        is_image = any(ext in filename for ext in [".png", ".jpg", ".jpeg", ".gif", ".bmp", ".pdf"])
-
-        user_text = ""
-
-        # === AUDIO ===
-        if is_audio or "audio" in mime_type:
-            input_path = "/tmp/input_voice_xml.wav"
-            upload.save(input_path)
-
-            model = whisper.load_model("base")
-            result = model.transcribe(input_path, language="es")
-            user_text = result["text"].strip()
-            if not user_text:
-                return create_xml_response({"error": "No se pudo transcribir audio"})
-
-        # === IMAGEN / DOCUMENTO ===
-        elif is_image:
-            file_bytes = upload.read()
-            prompt_ocr = """
-Eres un asistente médico experto en interpretación de imágenes clínicas.
-El usuario te ha enviado una imagen que puede ser un estudio médico, radiografía, herida, análisis o documento visual relacionado con salud.
-
-Tu tarea:
-1. Interpreta con detalle lo que se observa: estructuras afectadas, tejidos, posibles patologías, signos de infección o daño.
-2. Describe la posible causa o diagnóstico preliminar si es evidente.
-3. Si es una imagen médica (como rayos X, tomografía, resonancia, laboratorio o herida), analiza con precisión anatómica y médica.
-4. Al final, formula una sola pregunta útil o de seguimiento, del tipo:
-  Al dinal explicala y da seguimiento, puedes dar alguna recomendacióm
-
-Nunca digas frases como “No soy médico”, ni respondas de forma ambigua.
-Si la imagen es clara, interpreta aunque el caso sea grave.
-Habla como si fueras un profesional que ayuda a entender el resultado, no que evade responsabilidad.
-
-SE BREVE, PERO EXPLICA TODO, AUNQUE SEAS BREVE TODO EXPLICADO E INTERPRETADO AL 100
-"""
-            try:
-                parts = [{"mime_type": mime_type, "data": file_bytes}, prompt_ocr]
-                resp_ocr = gemini_model.generate_content(parts)
-                user_text = (resp_ocr.text or "").strip()
-            except Exception as e:
-                return create_xml_response({"error": f"Error al analizar la imagen: {e}"})
-        else:
-            return create_xml_response({"error": "Tipo de archivo no soportado. Envía audio o imagen."})
-
-        # === RESPUESTA IA MÉDICA BREVE ===
-        prompt = f"""
-Eres una asistente médica virtual amable y empática. 
-Tu objetivo es ayudar directamente al paciente de forma clara y breve.
-
-Reglas:
-- Responde cortamente, pues tu respuesta se va a grabar y no queremos dejar esperando al usuario, sin guiones, sin listas ni formato.
-- Cada intervención tuya debe ser importante aunque sea corta.
-- Evita sonar como doctora formal o dar diagnósticos clínicos largos.
-- No pongas advertencias ni aclaraciones tipo “no soy médico”.
-- Primero intenta ayudar y orientar
-- Haz preguntas de su situación hasta encontrar un resultado y darle una conclusión, si desde el primer input que te da el usuario encuentras una conclusión, esta bién
-- Si crees que puede ser algo serio, sugiere ir al médico en una sola frase, al final. SOLO SI ES GRAVE.
-- Sé humana, cálida y directa, no robótica.
-
-Paciente dice (texto o imagen interpretada): "{user_text}"
-Tu respuesta:
-"""
-
-        resp = gemini_model.generate_content(prompt)
-        ai_text = (resp.text or "").strip()
-
-        # === RESUMEN MÉDICO ===
-        try:
-            summary_prompt = f"En pocas lineas dame algo como una nota médica, esto ayudará a ver el resumen de la llamada, no des solo un tipo summary, si no algo importante de la interacción, por ejemplo lo que pienses que pueda ser la situación, SE MUY MUY BREVE Y SOLO RESPONDE CONCISO, NADA DE INTRODUCCIÓNES TIPO SE MUY MUY BREVE Y SOLO RESPONDE CONCISO, NADA DE INTRODUCCIÓNES TIPO CLARO QUE SI, AQUI ESTA TU NOTA, SE BREVE PERO IMPORTANTE, ESTAS NOTAS LAS ESTARA VIENDO EK PACIENTE EN TIEMPO REAL, ES COMO UN APOYO PARA EL, NO TE REFIERAS A EL COMO PACIENTE, SOLO DA LA NOTA: {ai_text}"
-            summary_resp = gemini_model.generate_content(summary_prompt)
-            summary = (summary_resp.text or "").strip()
-        except Exception:
-            summary = "(sin resumen disponible)"
-
-        # === TEXTO → VOZ (opcional, solo si se desea audio) ===
-        output_path = "/tmp/output_ai_xml.mp3"
+        user_text, vad = transcribe_upload(upload, pipe)
+    except whisper_pool.WhisperBusy:
+        return jsonify({"error": WHISPER_BUSY_MESSAGE}), 503
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+    if not user_text:
+        return jsonify({"error": "No se pudo transcribir audio"}), 400
+
+    def generate():
+        yield sse.event("transcript", {"input_text": user_text, "vad": vad})
+        parts = []
         try:
-            tts = gTTS(text=ai_text, lang="es", tld="com.mx")
-            tts.save(output_path)
+            for text in sse.stream_text(gemini_model, voice_prompt(user_text)):
+                parts.append(text)
+                yield sse.event("token", {"text": text})
         except Exception as e:
-            print("⚠️ No se pudo generar el audio:", e)
-            output_path = None
-
-        # === RESPUESTA XML ===
-        response_data = {
+            yield sse.event("error", {"error": str(e)})
+            return
+
+        ai_text = "".join(parts).strip()
+        pipe.submit("summary", generate_text, voice_summary_prompt(ai_text), timeout=SUMMARY_TIMEOUT_SECONDS)
+        pipe.submit("tts", synthesize_to_file, ai_text, "ai_", timeout=TTS_TIMEOUT_SECONDS)
+
+        audio_name = pipe.result("tts", default=None)
+        if audio_name:
+            yield sse.event("audio", {"audio_file": audio_name})
+        yield sse.event("summary", {"summary": pipe.result("summary", default="(sin resumen disponible)")})
+        yield sse.event("done", {
             "status": "ok",
             "input_text": user_text,
             "ai_response": ai_text,
-            "summary": summary,
-        }
-        if output_path:
-            response_data["audio_file"] = "output_ai_xml.mp3"
+            "timings": pipe.timings(),
+        })
+
+    return sse.sse_response(generate())
 
-        return create_xml_response(response_data)
 
+# ---------- Audio incremental ----------
+@app.post("/api/ai/voice-session/audio-stream")
+@uploads.limited("audio")
+def ai_voice_session_audio_stream():
+    """
+    Sesión de voz que responde directamente con audio: la respuesta de Gemini
+    se va cortando en frases y cada frase se sintetiza y envía en cuanto está
+    lista. El texto transcrito viaja en la cabecera X-Input-Text (URL-encoded).
+    """
+    upload = request.files.get("file")
+    if not upload:
+        return jsonify({"error": "Falta el archivo de audio ('file')"}), 400
+
+    try:
+        user_text, vad = transcribe_upload(upload)
+    except whisper_pool.WhisperBusy:
+        return jsonify({"error": WHISPER_BUSY_MESSAGE}), 503
     except Exception as e:
-        return create_xml_response({"error": str(e)})
+        return jsonify({"error": str(e)}), 500
+    if not user_text:
+        return jsonify({"error": "No se pudo transcribir audio"}), 400
+
+    def generate():
+        try:
+            yield from tts_stream.stream_speech(sse.stream_text(gemini_model, voice_prompt(user_text)))
+        except Exception as e:
+            print("⚠️ Error en audio incremental:", e)
+
+    return with_vad(Response(generate(), mimetype="audio/mpeg", headers={"X-Input-Text": quote(user_text)}), vad)
 
 
+# ---------- Resumen diferido ----------
+@app.get("/api/ai/voice-session/summary/<summary_id>")
+@app.get("/api/ai/voice-session-xml/summary/<summary_id>", defaults={"fmt": negotiation.XML})
+def ai_voice_session_summary(summary_id, fmt=None):
+    """Recoge el resumen de una sesión de voz pedida con defer_summary=1."""
+    fmt = negotiation.response_format(fmt)
+    state, value = pipeline.fetch_deferred(summary_id)
+    if state == "pending":
+        return negotiation.render({"status": "pending"}, 202, fmt)
+    if state == "missing":
+        return negotiation.render({"error": "Resumen no encontrado o expirado"}, 404, fmt)
+    if state == "error":
+        return negotiation.render({"status": "ok", "summary": "(sin resumen disponible)"}, fmt=fmt)
+    return negotiation.render({"status": "ok", "summary": value}, fmt=fmt)
 
 
 # ===== RUTAS PRINCIPALES =====
@@ -697,7 +937,40 @@ def index():
 @app.route("/health")
 def health_check():
     """Health check para Vercel"""
-    return jsonify({"status": "ok", "message": "Consulta Médica Virtual API funcionando"})
+    return jsonify({
+        "status": "ok",
+        "message": "Consulta Médica Virtual API funcionando",
+        "gemini": gemini_model.stats(),
+        "combined_reply": combined_reply.stats(),
+        "prompts": prompts.stats(),
+        "whisper": whisper_registry.stats(),
+        "whisper_pool": whisper_pool.stats(),
+        "vad": voice_activity.stats(),
+        "dictation": dictation.stats(),
+        "uploads": uploads.stats(),
+        "file_analysis_cache": analysis_cache.stats(),
+        "jobs": jobs.queue.stats(),
+        "tts_cache": audio_io.tts_cache_stats(),
+        "sessions": conversations.stats(),
+        "response_cache": response_cache.stats(),
+    })
+
+@app.route("/metrics")
+def metrics_endpoint():
+    """Latencias por ruta y etapa (p50/p95/p99) y tokens de Gemini, formato Prometheus."""
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+@app.route("/warmup", methods=["GET", "POST"])
+def warmup_endpoint():
+    """Precalienta Gemini (y Whisper con ?whisper=1) de forma explícita."""
+    include_whisper = request.args.get("whisper", "").lower() in ("1", "true", "yes")
+    timings = warmup(include_whisper=include_whisper)
+    return jsonify({"status": "ok", "timings": timings, "startup": startup.report()})
+
+@app.route("/startup-report")
+def startup_report():
+    """Costo de importación por módulo y tiempo hasta que la app quedó lista."""
+    return jsonify(startup.report())
 
 @app.route("/avatar-test")
 def avatar_test():
@@ -716,6 +989,8 @@ def test_gemini():
             }), 400
         
         # Probar conexión con Gemini
+        genai = startup.lazy_import("google.generativeai")
+        genai.configure(api_key=api_key)
         model = genai.GenerativeModel('gemini-2.5-flash')
         response = model.generate_content("Di hola")
         
@@ -734,6 +1009,8 @@ def test_gemini():
             'api_key_configurada': bool(os.getenv('GOOGLE_GEMINI_API_KEY'))
         }), 500
 
+startup.mark_ready()
+
 # ===== MAIN =====
 if __name__ == "__main__":
     port = int(os.getenv("PORT", 5000))  # Cambiado de 8080 a 5000
@@ -0,0 +1,272 @@
+"""
+Almacenamiento del historial de conversación por session_id.
+
+Dos backends con la misma interfaz:
+- MemorySessionStore: en RAM, con TTL por sesión, máximo de sesiones
+  (expulsa la menos usada) y máximo de mensajes por sesión.
+- SQLiteSessionStore: en un archivo SQLite, para que varios workers de
+  gunicorn compartan el historial y sobreviva a reinicios. Por defecto en
+  scratch_files.DATA_DIR, que no se sirve ni se barre.
+
+SESSION_STORE=memory|sqlite elige el backend (ver create_store).
+
+Cada sesión guarda además un resumen acumulado de los mensajes antiguos
+(ver conversation_context) y cuántos mensajes cubre ese resumen. El recorte
+a SESSION_MAX_HISTORY solo quita mensajes ya resumidos: si el resumen va
+atrasado (o falla) se conservan los pendientes, hasta un tope duro de
+SESSION_HARD_MAX_HISTORY para que una sesión no crezca sin límite.
+"""
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+
+import scratch_files
+
+SESSION_STORE = os.getenv("SESSION_STORE", "memory")
+# Vacío = DATA_DIR/sessions.sqlite3
+SESSION_DB_PATH = os.getenv("SESSION_DB_PATH", "")
+SESSION_TTL_SECONDS = int(os.getenv("SESSION_TTL_SECONDS", "3600"))
+SESSION_MAX_SESSIONS = int(os.getenv("SESSION_MAX_SESSIONS", "1000"))
+SESSION_MAX_HISTORY = int(os.getenv("SESSION_MAX_HISTORY", "50"))
+SESSION_HARD_MAX_HISTORY = int(os.getenv("SESSION_HARD_MAX_HISTORY", "500"))
+
+
+class SessionStore(ABC):
+    """
+    Interfaz común. Los mensajes son dicts {"role": ..., "content": ...}.
+    Un backend que no implemente todos los métodos falla al crearse.
+    """
+
+    @abstractmethod
+    def append(self, session_id, role, content):
+        pass
+
+    @abstractmethod
+    def history(self, session_id):
+        """Lista de mensajes de la sesión (vacía si no existe o expiró)."""
+
+    @abstractmethod
+    def count(self, session_id):
+        """Total de mensajes añadidos a la sesión, incluidos los ya recortados."""
+
+    @abstractmethod
+    def get_summary(self, session_id):
+        """(resumen, mensajes_cubiertos) de la sesión; ("", 0) si no hay."""
+
+    @abstractmethod
+    def set_summary(self, session_id, summary, folded):
+        """Guarda el resumen solo si cubre más mensajes que el actual."""
+
+    @abstractmethod
+    def clear(self, session_id):
+        pass
+
+    def stats(self):
+        return {}
+
+    def _keep(self, total, folded):
+        """Mensajes a conservar: nunca se recortan los aún no resumidos (salvo por el tope duro)."""
+        return min(max(self.max_history, total - folded), max(self.max_history, self.hard_max_history))
+
+
+class MemorySessionStore(SessionStore):
+
+    def __init__(self, ttl=SESSION_TTL_SECONDS, max_sessions=SESSION_MAX_SESSIONS,
+                 max_history=SESSION_MAX_HISTORY, hard_max_history=SESSION_HARD_MAX_HISTORY):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.max_history = max_history
+        self.hard_max_history = hard_max_history
+        # {session_id: {"messages", "last_used", "total", "summary", "folded"}}
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def _expire(self, now):
+        """Llamar con el lock tomado. Las sesiones más viejas están al principio."""
+        while self._sessions:
+            session_id, session = next(iter(self._sessions.items()))
+            if now - session["last_used"] <= self.ttl:
+                break
+            del self._sessions[session_id]
+
+    def _get(self, session_id):
+        """Llamar con el lock tomado."""
+        self._expire(time.time())
+        return self._sessions.get(session_id)
+
+    def append(self, session_id, role, content):
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            session = self._sessions.pop(session_id, None) or {
+                "messages": [], "total": 0, "summary": "", "folded": 0,
+            }
+            session["messages"].append({"role": role, "content": content})
+            session["total"] += 1
+            session["last_used"] = now
+            keep = self._keep(session["total"], session["folded"])
+            if len(session["messages"]) > keep:
+                del session["messages"][:-keep]
+            self._sessions[session_id] = session
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+                self.evictions += 1
+
+    def history(self, session_id):
+        with self._lock:
+            session = self._get(session_id)
+            return list(session["messages"]) if session else []
+
+    def count(self, session_id):
+        with self._lock:
+            session = self._get(session_id)
+            return session["total"] if session else 0
+
+    def get_summary(self, session_id):
+        with self._lock:
+            session = self._get(session_id)
+            return (session["summary"], session["folded"]) if session else ("", 0)
+
+    def set_summary(self, session_id, summary, folded):
+        with self._lock:
+            session = self._get(session_id)
+            if session and folded > session["folded"]:
+                session["summary"] = summary
+                session["folded"] = folded
+
+    def clear(self, session_id):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "backend": "memory",
+                "sessions": len(self._sessions),
+                "messages": sum(len(s["messages"]) for s in self._sessions.values()),
+                "evictions": self.evictions,
+            }
+
+
+class SQLiteSessionStore(SessionStore):
+
+    def __init__(self, path=SESSION_DB_PATH, ttl=SESSION_TTL_SECONDS,
+                 max_sessions=SESSION_MAX_SESSIONS, max_history=SESSION_MAX_HISTORY,
+                 hard_max_history=SESSION_HARD_MAX_HISTORY):
+        self.path = path or scratch_files.data_path("sessions.sqlite3")
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.max_history = max_history
+        self.hard_max_history = hard_max_history
+        self._local = threading.local()
+        with self._conn() as conn:
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS messages (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    session_id TEXT NOT NULL,
+                    role TEXT NOT NULL,
+                    content TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS idx_messages_session ON messages(session_id, id);
+                CREATE TABLE IF NOT EXISTS sessions (
+                    session_id TEXT PRIMARY KEY,
+                    last_used REAL NOT NULL,
+                    total INTEGER NOT NULL DEFAULT 0,
+                    summary TEXT NOT NULL DEFAULT '',
+                    folded INTEGER NOT NULL DEFAULT 0
+                );
+                CREATE INDEX IF NOT EXISTS idx_sessions_last_used ON sessions(last_used);
+            """)
+            # Bases creadas antes de que existiera el resumen acumulado
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(sessions)")}
+            for column, ddl in (("total", "INTEGER NOT NULL DEFAULT 0"),
+                                ("summary", "TEXT NOT NULL DEFAULT ''"),
+                                ("folded", "INTEGER NOT NULL DEFAULT 0")):
+                if column not in columns:
+                    conn.execute(f"ALTER TABLE sessions ADD COLUMN {column} {ddl}")
+
+    def _conn(self):
+        """Una conexión por hilo; WAL permite lectores concurrentes entre procesos."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _delete_sessions(self, conn, where, params):
+        conn.execute(f"DELETE FROM messages WHERE session_id IN (SELECT session_id FROM sessions WHERE {where})", params)
+        conn.execute(f"DELETE FROM sessions WHERE {where}", params)
+
+    def append(self, session_id, role, content):
+        now = time.time()
+        with self._conn() as conn:
+            self._delete_sessions(conn, "last_used < ?", (now - self.ttl,))
+            conn.execute("INSERT INTO messages (session_id, role, content) VALUES (?, ?, ?)",
+                         (session_id, role, content))
+            conn.execute("INSERT INTO sessions (session_id, last_used, total) VALUES (?, ?, 1) "
+                         "ON CONFLICT(session_id) DO UPDATE SET last_used = excluded.last_used, "
+                         "total = total + 1",
+                         (session_id, now))
+            total, folded = conn.execute("SELECT total, folded FROM sessions WHERE session_id = ?",
+                                         (session_id,)).fetchone()
+            conn.execute("""
+                DELETE FROM messages WHERE session_id = ? AND id NOT IN (
+                    SELECT id FROM messages WHERE session_id = ? ORDER BY id DESC LIMIT ?
+                )""", (session_id, session_id, self._keep(total, folded)))
+            self._delete_sessions(conn, """session_id IN (
+                SELECT session_id FROM sessions ORDER BY last_used DESC LIMIT -1 OFFSET ?
+            )""", (self.max_sessions,))
+
+    def history(self, session_id):
+        conn = self._conn()
+        row = conn.execute("SELECT last_used FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+        if row is None or time.time() - row[0] > self.ttl:
+            return []
+        rows = conn.execute("SELECT role, content FROM messages WHERE session_id = ? ORDER BY id",
+                            (session_id,)).fetchall()
+        return [{"role": role, "content": content} for role, content in rows]
+
+    def _session_row(self, session_id, columns):
+        row = self._conn().execute(f"SELECT last_used, {columns} FROM sessions WHERE session_id = ?",
+                                   (session_id,)).fetchone()
+        if row is None or time.time() - row[0] > self.ttl:
+            return None
+        return row[1:]
+
+    def count(self, session_id):
+        row = self._session_row(session_id, "total")
+        return row[0] if row else 0
+
+    def get_summary(self, session_id):
+        row = self._session_row(session_id, "summary, folded")
+        return (row[0], row[1]) if row else ("", 0)
+
+    def set_summary(self, session_id, summary, folded):
+        with self._conn() as conn:
+            conn.execute("UPDATE sessions SET summary = ?, folded = ? WHERE session_id = ? AND folded < ?",
+                         (summary, folded, session_id, folded))
+
+    def clear(self, session_id):
+        with self._conn() as conn:
+            self._delete_sessions(conn, "session_id = ?", (session_id,))
+
+    def stats(self):
+        conn = self._conn()
+        return {
+            "backend": "sqlite",
+            "path": self.path,
+            "sessions": conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0],
+            "messages": conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0],
+        }
+
+
+def create_store(kind=SESSION_STORE):
+    if kind == "sqlite":
+        return SQLiteSessionStore()
+    return MemorySessionStore()
@@ -0,0 +1,46 @@
+"""
+Utilidades para Server-Sent Events.
+
+Los endpoints /stream envían la respuesta de Gemini token a token para que el
+avatar pueda empezar a hablar antes de tener el texto completo. Eventos:
+
+    event: token    data: {"text": "..."}
+    event: summary  data: {"summary": "..."}
+    event: done     data: {...}
+    event: error    data: {"error": "..."}
+"""
+import json
+
+from flask import Response, stream_with_context
+
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "X-Accel-Buffering": "no",  # evita que proxies (nginx) acumulen el stream
+}
+
+
+def event(name, data):
+    """Serializa un evento SSE."""
+    payload = json.dumps(data, ensure_ascii=False)
+    return f"event: {name}\ndata: {payload}\n\n"
+
+
+def stream_text(model, prompt):
+    """Itera los fragmentos de texto de `generate_content(stream=True)`."""
+    for chunk in model.generate_content(prompt, stream=True):
+        try:
+            text = chunk.text
+        except ValueError:
+            # Fragmento sin partes de texto (p.ej. solo metadatos de seguridad)
+            continue
+        if text:
+            yield text
+
+
+def sse_response(generator):
+    """Envuelve un generador de eventos en una respuesta text/event-stream."""
+    return Response(
+        stream_with_context(generator),
+        mimetype="text/event-stream",
+        headers=SSE_HEADERS,
+    )
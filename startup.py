@@ -0,0 +1,65 @@
+"""
+Importaciones perezosas y reporte de tiempos de arranque.
+
+Las dependencias pesadas (torch vía whisper, numpy, gtts,
+google.generativeai) se importan en la primera ruta que las necesita, no al
+cargar el módulo, para que un cold start en Vercel que solo sirve "/" o
+"/health" no pague por ellas. Cada importación queda registrada con su costo.
+"""
+import importlib
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+_process_start = time.time()
+_costs = {}    # {nombre: {"seconds": ..., "at": segundos_desde_arranque}}
+_ready_at = None
+_lock = threading.Lock()
+
+
+def _record(name, seconds):
+    with _lock:
+        _costs.setdefault(name, {
+            "seconds": round(seconds, 4),
+            "at": round(time.time() - _process_start, 3),
+        })
+
+
+@contextmanager
+def timed(name):
+    """Mide un bloque de importaciones (o cualquier inicialización)."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _record(name, time.perf_counter() - start)
+
+
+def lazy_import(name):
+    """importlib.import_module con registro del costo de la primera carga.
+
+    Siempre pasa por import_module: si otro hilo está importando el módulo,
+    espera a que termine en vez de devolver un módulo a medio inicializar.
+    """
+    loaded = name in sys.modules
+    start = time.perf_counter()
+    module = importlib.import_module(name)
+    if not loaded:
+        _record(name, time.perf_counter() - start)
+    return module
+
+
+def mark_ready():
+    global _ready_at
+    _ready_at = time.time() - _process_start
+
+
+def report():
+    with _lock:
+        costs = dict(sorted(_costs.items(), key=lambda kv: kv[1]["seconds"], reverse=True))
+    return {
+        "app_ready_seconds": round(_ready_at, 3) if _ready_at is not None else None,
+        "uptime_seconds": round(time.time() - _process_start, 1),
+        "imports": costs,
+    }
@@ -2,7 +2,9 @@
 const CONFIG = {
     API_BASE_URL: window.location.origin,
     SESSION_ID: 'session_' + Date.now() + '_' + Math.random().toString(36).substr(2, 9),
-    VOICE_RECOGNITION_SUPPORTED: 'webkitSpeechRecognition' in window || 'SpeechRecognition' in window
+    VOICE_RECOGNITION_SUPPORTED: 'webkitSpeechRecognition' in window || 'SpeechRecognition' in window,
+    // ?timing en la URL: mostrar en consola el Server-Timing de cada llamada a la API
+    LOG_SERVER_TIMING: new URLSearchParams(window.location.search).has('timing')
 };
 
 // ===== ESTADO DE LA APLICACIÓN =====
@@ -22,6 +24,7 @@ document.addEventListener('DOMContentLoaded', function() {
     setupEventListeners();
     updateCurrentTime();
     initializeVoiceRecognition();
+    observeServerTiming();
     
     // Actualizar hora cada minuto
     setInterval(updateCurrentTime, 60000);
@@ -250,35 +253,29 @@ async function sendMessage() {
     }
     
     try {
-        // Enviar consulta al backend
-        const response = await fetch(`${CONFIG.API_BASE_URL}/api/ai/voice-session`, {
-            method: 'POST',
-            headers: {
-                'Content-Type': 'application/json',
+        // Enviar consulta al backend por SSE: el texto aparece mientras se genera
+        let botContent = null;
+        let aiResponse = '';
+        
+        await streamSSE('/api/ai/interaction/stream', {
+            message: message,
+            session_id: CONFIG.SESSION_ID,
+            history: appState.conversationHistory
+        }, {
+            token: (data) => {
+                aiResponse += data.text;
+                if (!botContent) {
+                    botContent = addMessageToChat('', 'bot');
+                }
+                botContent.innerHTML = `<strong>Asistente Médico:</strong> ${aiResponse}`;
             },
-            body: JSON.stringify({
-                message: message,
-                session_id: CONFIG.SESSION_ID
-            })
+            summary: (data) => updateMedicalReport(data.summary),
+            audio: (data) => playAudioResponse(data.audio_file),
+            error: (data) => {
+                throw new Error(data.error);
+            }
         });
         
-        if (!response.ok) {
-            throw new Error(`Error ${response.status}: ${response.statusText}`);
-        }
-        
-        const data = await response.json();
-        
-        // Agregar respuesta del bot al chat
-        addMessageToChat(data.ai_response, 'bot');
-        
-        // Actualizar reporte médico
-        updateMedicalReport(data.summary);
-        
-        // Reproducir audio si está disponible
-        if (data.audio_file) {
-            playAudioResponse(data.audio_file);
-        }
-        
         // Actualizar historial de conversación
         appState.conversationHistory.push({
             role: 'user',
@@ -286,7 +283,7 @@ async function sendMessage() {
         });
         appState.conversationHistory.push({
             role: 'assistant',
-            content: data.ai_response
+            content: aiResponse
         });
         
     } catch (error) {
@@ -335,6 +332,77 @@ function addMessageToChat(message, sender) {
     
     // Animación de entrada
     messageDiv.classList.add('fade-in');
+    
+    return messageContent;
+}
+
+// ===== SERVER-TIMING =====
+// El servidor manda Server-Timing con SERVER_TIMING=1; las devtools ya lo
+// muestran en la pestaña Red (Timing) y aquí se resume en la consola.
+function observeServerTiming() {
+    if (!CONFIG.LOG_SERVER_TIMING || !('PerformanceObserver' in window)) return;
+    
+    const observer = new PerformanceObserver((list) => {
+        for (const entry of list.getEntries()) {
+            if (!entry.serverTiming || entry.serverTiming.length === 0) continue;
+            const path = new URL(entry.name).pathname;
+            if (!path.startsWith('/api/')) continue;
+            
+            const stages = {};
+            for (const timing of entry.serverTiming) {
+                stages[timing.name] = Math.round(timing.duration);
+            }
+            console.groupCollapsed(`⏱️ ${path} ${Math.round(entry.duration)} ms`);
+            console.table(stages);
+            console.groupEnd();
+        }
+    });
+    observer.observe({ type: 'resource', buffered: true });
+}
+
+// ===== STREAMING (SERVER-SENT EVENTS) =====
+async function streamSSE(path, body, handlers) {
+    const response = await fetch(`${CONFIG.API_BASE_URL}${path}`, {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json',
+            'Accept': 'text/event-stream'
+        },
+        body: JSON.stringify(body)
+    });
+    
+    if (!response.ok) {
+        throw new Error(`Error ${response.status}: ${response.statusText}`);
+    }
+    
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+        
+        // Los eventos SSE se separan con una línea en blanco
+        let boundary;
+        while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+            const rawEvent = buffer.slice(0, boundary);
+            buffer = buffer.slice(boundary + 2);
+            
+            let eventName = 'message';
+            let data = '';
+            for (const line of rawEvent.split('\n')) {
+                if (line.startsWith('event: ')) eventName = line.slice(7);
+                else if (line.startsWith('data: ')) data += line.slice(6);
+            }
+            
+            const handler = handlers[eventName];
+            if (handler && data) {
+                handler(JSON.parse(data));
+            }
+        }
+    }
 }
 
 // ===== ACTUALIZACIÓN DEL REPORTE MÉDICO =====
@@ -491,6 +559,7 @@ window.MedicalApp = {
     CONFIG,
     appState,
     sendMessage,
+    streamSSE,
     addMessageToChat,
     updateMedicalReport,
     showNotification
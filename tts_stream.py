@@ -0,0 +1,93 @@
+"""
+Síntesis de voz incremental.
+
+El texto (completo o llegando token a token desde Gemini) se corta en frases;
+cada frase se sintetiza en un pool de hilos y los MP3 se entregan en orden en
+cuanto están listos. Los frames MP3 se pueden concatenar tal cual, así que el
+navegador empieza a reproducir tras la primera frase.
+"""
+import os
+import re
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import audio_io
+
+TTS_WORKERS = int(os.getenv("TTS_WORKERS", "4"))
+TTS_CHUNK_TIMEOUT_SECONDS = float(os.getenv("TTS_CHUNK_TIMEOUT_SECONDS", "15"))
+# Frases más cortas se juntan con la siguiente para no pedir audios de 1 palabra
+MIN_CHUNK_CHARS = 40
+
+_SENTENCE_END = re.compile(r"(?<=[.!?…:;])\s+|\n+")
+
+_executor = ThreadPoolExecutor(max_workers=TTS_WORKERS, thread_name_prefix="tts")
+
+
+class SentenceChunker:
+    """Acumula texto y devuelve frases completas a medida que aparecen."""
+
+    def __init__(self, min_chars=MIN_CHUNK_CHARS):
+        self.min_chars = min_chars
+        self._buffer = ""
+
+    def feed(self, text):
+        self._buffer += text
+        pieces = _SENTENCE_END.split(self._buffer)
+        # El último trozo puede ser una frase a medias: se queda en el buffer
+        self._buffer = pieces.pop()
+        chunks = []
+        current = ""
+        for piece in pieces:
+            current = f"{current} {piece}".strip() if current else piece.strip()
+            if len(current) >= self.min_chars:
+                chunks.append(current)
+                current = ""
+        if current:
+            self._buffer = f"{current} {self._buffer}"
+        return chunks
+
+    def flush(self):
+        rest, self._buffer = self._buffer.strip(), ""
+        return rest
+
+
+def split_sentences(text, min_chars=MIN_CHUNK_CHARS):
+    chunker = SentenceChunker(min_chars)
+    chunks = chunker.feed(text)
+    rest = chunker.flush()
+    return chunks + [rest] if rest else chunks
+
+
+def stream_speech(text_pieces, lang="es", tld="com.mx"):
+    """
+    Itera bytes MP3 en orden a partir de un iterable de fragmentos de texto.
+    Las frases que fallan se omiten para no cortar el audio completo.
+    """
+    chunker = SentenceChunker()
+    pending = deque()
+
+    def submit(sentence):
+        pending.append(_executor.submit(audio_io.synthesize_mp3, sentence, lang, tld))
+
+    def take():
+        try:
+            return pending.popleft().result(timeout=TTS_CHUNK_TIMEOUT_SECONDS)
+        except Exception as e:
+            print("⚠️ No se pudo sintetizar un fragmento:", e)
+            return b""
+
+    for piece in text_pieces:
+        for sentence in chunker.feed(piece):
+            submit(sentence)
+        while pending and pending[0].done():
+            data = take()
+            if data:
+                yield data
+
+    rest = chunker.flush()
+    if rest:
+        submit(rest)
+    while pending:
+        data = take()
+        if data:
+            yield data
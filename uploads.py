@@ -0,0 +1,157 @@
+"""
+Límites de tamaño y manejo de archivos subidos.
+
+- Cada ruta que recibe archivos declara su grupo con @uploads.limited(...) y
+  se rechaza con 413 por Content-Length antes de parsear el multipart. El
+  mayor de los topes se usa como MAX_CONTENT_LENGTH de Flask, que además
+  corta los cuerpos sin Content-Length (chunked).
+- Werkzeug ya vuelca a un archivo temporal las partes multipart de más de
+  500 KB; lo que hay que evitar es volver a meterlas en RAM con
+  upload.read(). gemini_part() manda inline solo los archivos pequeños y los
+  grandes los copia por bloques a disco y los sube con la File API de Gemini.
+"""
+import os
+import shutil
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from flask import abort, request
+from werkzeug.datastructures import FileStorage
+
+import scratch_files
+
+MB = 1024 * 1024
+# Topes por grupo de rutas (MB)
+UPLOAD_LIMITS = {
+    "audio": float(os.getenv("UPLOAD_MAX_MB_AUDIO", "25")) * MB,
+    "document": float(os.getenv("UPLOAD_MAX_MB_DOCUMENT", "50")) * MB,
+}
+# Por encima de esto el archivo va por la File API en vez de inline
+GEMINI_INLINE_MAX_BYTES = float(os.getenv("GEMINI_INLINE_MAX_MB", "4")) * MB
+GEMINI_FILE_POLL_SECONDS = 1.0
+GEMINI_FILE_TIMEOUT_SECONDS = int(os.getenv("GEMINI_FILE_TIMEOUT_SECONDS", "60"))
+COPY_CHUNK_BYTES = 1 * MB
+# Margen para los encabezados del multipart y los campos de texto
+MULTIPART_OVERHEAD_BYTES = 1 * MB
+# Subidas de trabajos que nunca llegaron a ejecutarse (p.ej. el proceso murió)
+PENDING_UPLOAD_TTL_SECONDS = int(os.getenv("PENDING_UPLOAD_TTL_SECONDS", "86400"))
+PENDING_DIR = "pending"
+
+
+def max_content_length():
+    """Valor para app.config["MAX_CONTENT_LENGTH"]."""
+    return int(max(UPLOAD_LIMITS.values()) + MULTIPART_OVERHEAD_BYTES)
+
+
+def limit_for(group):
+    return int(UPLOAD_LIMITS[group] + MULTIPART_OVERHEAD_BYTES)
+
+
+def limited(group):
+    """Rechaza con 413 las peticiones cuyo Content-Length supera el tope del grupo."""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.content_length and request.content_length > limit_for(group):
+                abort(413)
+            return view(*args, **kwargs)
+        wrapper.upload_group = group
+        return wrapper
+    return decorator
+
+
+def file_size(upload):
+    """Tamaño de un FileStorage sin leerlo (su stream es BytesIO o un temporal en disco)."""
+    stream = upload.stream
+    position = stream.tell()
+    stream.seek(0, os.SEEK_END)
+    size = stream.tell()
+    stream.seek(position)
+    return size
+
+
+def _wait_until_active(genai, remote):
+    deadline = time.monotonic() + GEMINI_FILE_TIMEOUT_SECONDS
+    while getattr(remote.state, "name", "ACTIVE") == "PROCESSING":
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"Gemini no terminó de procesar {remote.name}")
+        time.sleep(GEMINI_FILE_POLL_SECONDS)
+        remote = genai.get_file(remote.name)
+    if getattr(remote.state, "name", "ACTIVE") == "FAILED":
+        raise RuntimeError(f"Gemini no pudo procesar {remote.name}")
+    return remote
+
+
+@contextmanager
+def gemini_part(upload, mime_type, genai):
+    """
+    Parte para generate_content con el contenido de `upload`: bytes inline si
+    es pequeño, o un archivo subido a la File API (que se borra al salir).
+    `genai` es el módulo google.generativeai ya configurado.
+    """
+    if file_size(upload) <= GEMINI_INLINE_MAX_BYTES:
+        yield {"mime_type": mime_type, "data": upload.read()}
+        return
+
+    suffix = os.path.splitext(upload.filename or "")[1]
+    with scratch_files.scratch_file(suffix=suffix, prefix="upload_") as path:
+        upload.stream.seek(0)
+        with open(path, "wb") as f:
+            shutil.copyfileobj(upload.stream, f, COPY_CHUNK_BYTES)
+        remote = genai.upload_file(path=path, mime_type=mime_type, display_name=upload.filename)
+    try:
+        yield _wait_until_active(genai, remote)
+    finally:
+        try:
+            genai.delete_file(remote.name)
+        except Exception as e:
+            print("⚠️ No se pudo borrar el archivo en Gemini:", remote.name, e)
+
+
+def save_for_later(upload):
+    """
+    Copia el archivo subido a disco (por bloques) para usarlo cuando la
+    petición ya terminó, p.ej. en un trabajo de la cola. Devuelve una tupla
+    para reopened().
+
+    Va en DATA_DIR y no en SCRATCH_DIR: el barrido por TTL de los archivos
+    temporales no debe borrarlo mientras el trabajo sigue en cola. Aquí solo
+    se limpian las subidas huérfanas de más de PENDING_UPLOAD_TTL_SECONDS.
+    """
+    suffix = os.path.splitext(upload.filename or "")[1]
+    path = scratch_files.data_path(PENDING_DIR, scratch_files.new_name(suffix, prefix="job_"))
+    scratch_files.sweep(PENDING_UPLOAD_TTL_SECONDS, os.path.dirname(path))
+    upload.stream.seek(0)
+    with open(path, "wb") as f:
+        shutil.copyfileobj(upload.stream, f, COPY_CHUNK_BYTES)
+    return path, upload.filename, upload.mimetype
+
+
+def discard(saved):
+    """Borra un archivo de save_for_later() cuyo trabajo no se llegó a encolar."""
+    try:
+        os.remove(saved[0])
+    except OSError:
+        pass
+
+
+@contextmanager
+def reopened(saved):
+    """FileStorage sobre un archivo de save_for_later(); lo borra al salir."""
+    path, filename, mimetype = saved
+    try:
+        with open(path, "rb") as f:
+            yield FileStorage(f, filename=filename, content_type=mimetype)
+    finally:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def stats():
+    return {
+        "limits_mb": {group: round(limit / MB, 1) for group, limit in UPLOAD_LIMITS.items()},
+        "gemini_inline_max_mb": round(GEMINI_INLINE_MAX_BYTES / MB, 1),
+    }
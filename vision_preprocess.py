@@ -0,0 +1,156 @@
+"""
+Preprocesamiento de imágenes y PDFs antes de mandarlos a Gemini.
+
+- Las fotos se decodifican reducidas (draft de JPEG), se rotan según EXIF,
+  se escalan a IMAGE_MAX_SIDE y se vuelven a codificar sin metadatos (EXIF,
+  GPS). Un 12 MP de teléfono pasa de varios MB a unos cientos de KB, con la
+  misma información útil para el modelo.
+- Los PDFs de al menos PDF_SPLIT_MIN_PAGES páginas se parten en grupos de
+  páginas que se analizan en paralelo; merge_results() junta las respuestas.
+  Un informe corto va entero: partirlo cuesta más llamadas y una mezcla de
+  JSON heurística. Cada parte se escribe en un archivo temporal anónimo de
+  SCRATCH_DIR (se borra al cerrarse), no en memoria.
+
+Requiere Pillow (ya en requirements.txt); partir PDFs requiere pypdf y, si
+no está instalado, el PDF se manda entero como antes.
+"""
+import io
+import os
+import tempfile
+
+from werkzeug.datastructures import FileStorage
+
+import scratch_files
+import startup
+
+IMAGE_MAX_SIDE = int(os.getenv("IMAGE_MAX_SIDE", "1600"))
+IMAGE_JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", "85"))
+PDF_PAGES_PER_PART = int(os.getenv("PDF_PAGES_PER_PART", "6"))
+PDF_SPLIT_MIN_PAGES = int(os.getenv("PDF_SPLIT_MIN_PAGES", "12"))
+PDF_MAX_PARTS = int(os.getenv("PDF_MAX_PARTS", "8"))
+
+IMAGE_TYPES = {
+    ".jpg": "image/jpeg", ".jpeg": "image/jpeg", ".png": "image/png",
+    ".webp": "image/webp", ".bmp": "image/bmp",
+}
+
+
+def _kind(filename, mime_type):
+    ext = os.path.splitext((filename or "").lower())[1]
+    if mime_type == "application/pdf" or ext == ".pdf":
+        return "pdf"
+    if mime_type in IMAGE_TYPES.values() or ext in IMAGE_TYPES:
+        return "image"
+    return None
+
+
+def _part(stream, filename, mime_type):
+    return FileStorage(stream, filename=filename, content_type=mime_type)
+
+
+def prepare_image(stream):
+    """
+    Devuelve (bytes, mime_type) de la imagen reducida y sin metadatos. Las
+    imágenes con transparencia o PNG (capturas, documentos) se quedan en PNG
+    para no meter artefactos de JPEG en el texto; el resto va a JPEG.
+    """
+    Image = startup.lazy_import("PIL.Image")
+    ImageOps = startup.lazy_import("PIL.ImageOps")
+
+    img = Image.open(stream)
+    source_format = img.format
+    # En JPEG decodifica directamente a una escala menor (mucho más rápido)
+    img.draft("RGB", (IMAGE_MAX_SIDE, IMAGE_MAX_SIDE))
+    img = ImageOps.exif_transpose(img)
+    img.thumbnail((IMAGE_MAX_SIDE, IMAGE_MAX_SIDE))
+
+    out = io.BytesIO()
+    if source_format == "PNG" or img.mode in ("RGBA", "LA", "P"):
+        img.save(out, format="PNG", optimize=True)
+        return out.getvalue(), "image/png"
+    img.convert("RGB").save(out, format="JPEG", quality=IMAGE_JPEG_QUALITY, optimize=True)
+    return out.getvalue(), "image/jpeg"
+
+
+def split_pdf(stream):
+    """
+    Parte el PDF en grupos de páginas; devuelve [(archivo, "1-6"), ...] o
+    None si no hace falta partirlo (o pypdf no está disponible). Cada parte
+    es un archivo temporal ya posicionado al principio.
+    """
+    try:
+        pypdf = startup.lazy_import("pypdf")
+    except ImportError:
+        return None
+
+    reader = pypdf.PdfReader(stream)
+    total = len(reader.pages)
+    if total < PDF_SPLIT_MIN_PAGES:
+        return None
+    per_part = max(PDF_PAGES_PER_PART, -(-total // PDF_MAX_PARTS))
+
+    parts = []
+    for start in range(0, total, per_part):
+        end = min(start + per_part, total)
+        writer = pypdf.PdfWriter()
+        for i in range(start, end):
+            writer.add_page(reader.pages[i])
+        out = tempfile.TemporaryFile(dir=scratch_files.SCRATCH_DIR)
+        writer.write(out)
+        out.seek(0)
+        parts.append((out, f"{start + 1}-{end}"))
+    return parts
+
+
+def prepare_upload(upload, mime_type):
+    """
+    Lista de partes (FileStorage) listas para uploads.gemini_part(): la imagen
+    reducida, los trozos del PDF o el archivo original si no aplica nada.
+    Ante cualquier error se usa el original.
+    """
+    kind = _kind(upload.filename, mime_type)
+    base = os.path.splitext(upload.filename or "archivo")[0]
+    try:
+        if kind == "image":
+            data, new_mime = prepare_image(upload.stream)
+            ext = ".png" if new_mime == "image/png" else ".jpg"
+            return [_part(io.BytesIO(data), base + ext, new_mime)]
+        if kind == "pdf":
+            pages = split_pdf(upload.stream)
+            if pages:
+                return [_part(stream, f"{base}_p{rng}.pdf", "application/pdf") for stream, rng in pages]
+    except Exception as e:
+        print("⚠️ No se pudo preprocesar el archivo, se envía original:", e)
+    upload.stream.seek(0)
+    return [upload]
+
+
+def _merge_value(a, b):
+    if a in (None, "", [], {}):
+        return b
+    if b in (None, "", [], {}) or a == b:
+        return a
+    if isinstance(a, dict) and isinstance(b, dict):
+        merged = dict(a)
+        for key, value in b.items():
+            merged[key] = _merge_value(merged.get(key), value)
+        return merged
+    if isinstance(a, list):
+        return a + (b if isinstance(b, list) else [b])
+    if isinstance(a, str) and isinstance(b, str):
+        return f"{a}\n\n{b}"
+    return [a] + (b if isinstance(b, list) else [b])
+
+
+def merge_results(results):
+    """
+    Junta los análisis (dicts) de las partes de un documento: las listas se
+    concatenan, los textos se unen y los objetos se combinan clave a clave.
+    """
+    if len(results) == 1:
+        return results[0]
+    merged = {}
+    for result in results:
+        merged = _merge_value(merged, result)
+    merged["document_parts"] = len(results)
+    return merged
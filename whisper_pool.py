@@ -0,0 +1,245 @@
+"""
+Pool de procesos dedicado a Whisper.
+
+La transcripción es CPU intensiva y, dentro del hilo de la petición, acapara
+el GIL del worker. Con WHISPER_POOL_WORKERS > 0 cada clip se encola y uno de
+N procesos hijos (cada uno con su propio modelo) lo transcribe:
+
+- Los clips de hasta 30 s con las mismas opciones se agrupan en micro-lotes
+  (espera máxima WHISPER_BATCH_WAIT_MS) y se decodifican juntos, ya que
+  Whisper rellena cada uno a la misma ventana de 30 s de todos modos.
+- La cola tiene un tope (WHISPER_QUEUE_MAX); si está llena, transcribe()
+  lanza WhisperBusy y la ruta responde 503.
+- Se guardan latencias por clip (espera en cola y total) para /health.
+
+Con WHISPER_POOL_WORKERS=0 (por defecto) se transcribe en el propio hilo
+usando whisper_registry, como antes.
+"""
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+
+import whisper_registry
+
+WHISPER_POOL_WORKERS = int(os.getenv("WHISPER_POOL_WORKERS", "0"))
+WHISPER_QUEUE_MAX = int(os.getenv("WHISPER_QUEUE_MAX", "32"))
+WHISPER_BATCH_SIZE = int(os.getenv("WHISPER_BATCH_SIZE", "4"))
+WHISPER_BATCH_WAIT_MS = int(os.getenv("WHISPER_BATCH_WAIT_MS", "50"))
+WHISPER_THREADS_PER_WORKER = int(os.getenv("WHISPER_THREADS_PER_WORKER", "1"))
+
+SAMPLE_RATE = 16000
+WINDOW_SAMPLES = 30 * SAMPLE_RATE
+# Opciones que se pueden resolver con un decode por lotes
+_BATCHABLE_OPTIONS = {"language"}
+
+
+class WhisperBusy(Exception):
+    """La cola de transcripción está llena."""
+
+
+# ===== PROCESO HIJO =====
+def _init_worker(size, threads):
+    import torch
+    torch.set_num_threads(threads)
+    whisper_registry.get_model(size)
+
+
+def _transcribe_batch(size, jobs):
+    """
+    Se ejecuta en el proceso hijo. `jobs` es una lista de (audio, opciones);
+    devuelve una lista de dicts con al menos "text" (o "error").
+    """
+    import whisper
+
+    model = whisper_registry.get_model(size)
+    results = [None] * len(jobs)
+
+    batchable = [
+        i for i, (audio, options) in enumerate(jobs)
+        if not isinstance(audio, str) and len(audio) <= WINDOW_SAMPLES and set(options) <= _BATCHABLE_OPTIONS
+    ]
+    # Un decode por lotes comparte las opciones (p.ej. idioma) del primero
+    if batchable:
+        first_options = jobs[batchable[0]][1]
+        batchable = [i for i in batchable if jobs[i][1] == first_options]
+    if len(batchable) > 1:
+        try:
+            import torch
+            n_mels = model.dims.n_mels
+            mels = torch.stack([
+                whisper.log_mel_spectrogram(whisper.pad_or_trim(jobs[i][0]), n_mels=n_mels)
+                for i in batchable
+            ]).to(model.device)
+            decoded = whisper.decode(model, mels, whisper.DecodingOptions(
+                language=jobs[batchable[0]][1].get("language"), fp16=False,
+            ))
+            for i, result in zip(batchable, decoded):
+                results[i] = {"text": result.text, "batched": True}
+        except Exception as e:
+            print("⚠️ Falló el decode por lotes, se transcribe uno a uno:", e)
+
+    for i, (audio, options) in enumerate(jobs):
+        if results[i] is None:
+            try:
+                out = whisper_registry.transcribe(audio, size, **options)
+                results[i] = {"text": out["text"], "segments": out.get("segments", []), "batched": False}
+            except Exception as e:
+                results[i] = {"error": str(e)}
+    return results
+
+
+# ===== PROCESO PRINCIPAL =====
+class WhisperPool:
+
+    def __init__(self, workers=WHISPER_POOL_WORKERS, size=None):
+        self.workers = workers
+        self.size = size or whisper_registry.WHISPER_MODEL_SIZE
+        self._queue = queue.Queue(maxsize=WHISPER_QUEUE_MAX)
+        self._slots = threading.Semaphore(workers)
+        self._executor = None
+        self._dispatcher = None
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._latencies = deque(maxlen=500)   # (espera_en_cola, total)
+        self.completed = 0
+        self.rejected = 0
+        self.batched = 0
+
+    def start(self):
+        self._ensure_started()
+        # Un trabajo por proceso para forzar que el initializer cargue el modelo
+        for _ in range(self.workers):
+            self._executor.submit(time.sleep, 0)
+
+    def _ensure_started(self):
+        if self._dispatcher is not None:
+            return
+        with self._start_lock:
+            if self._dispatcher is None:
+                # spawn: hacer fork de un proceso con torch/hilos cargados puede bloquearse
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_init_worker,
+                    initargs=(self.size, WHISPER_THREADS_PER_WORKER),
+                )
+                self._dispatcher = threading.Thread(target=self._dispatch, name="whisper-dispatch", daemon=True)
+                self._dispatcher.start()
+
+    def submit(self, audio, **options):
+        """Encola un clip; devuelve un Future con el resultado de transcribe()."""
+        self._ensure_started()
+        future = Future()
+        try:
+            self._queue.put_nowait((audio, options, future, time.perf_counter()))
+        except queue.Full:
+            with self._stats_lock:
+                self.rejected += 1
+            raise WhisperBusy("Cola de transcripción llena")
+        return future
+
+    def _next_batch(self):
+        items = [self._queue.get()]
+        deadline = time.perf_counter() + WHISPER_BATCH_WAIT_MS / 1000
+        while len(items) < WHISPER_BATCH_SIZE:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                items.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return items
+
+    def _dispatch(self):
+        while True:
+            self._slots.acquire()
+            items = self._next_batch()
+            started = time.perf_counter()
+            jobs = [(audio, options) for audio, options, _, _ in items]
+            try:
+                batch_future = self._executor.submit(_transcribe_batch, self.size, jobs)
+            except Exception as e:
+                self._slots.release()
+                for _, _, future, _ in items:
+                    future.set_exception(e)
+                continue
+            batch_future.add_done_callback(lambda f, items=items, started=started: self._finish(f, items, started))
+
+    def _finish(self, batch_future, items, started):
+        self._slots.release()
+        now = time.perf_counter()
+        try:
+            results = batch_future.result()
+        except Exception as e:
+            results = [{"error": str(e)}] * len(items)
+
+        with self._stats_lock:
+            for (_, _, _, enqueued), result in zip(items, results):
+                self._latencies.append((started - enqueued, now - enqueued))
+                self.completed += 1
+                self.batched += 1 if result.get("batched") else 0
+
+        for (_, _, future, _), result in zip(items, results):
+            if "error" in result:
+                future.set_exception(RuntimeError(result["error"]))
+            else:
+                future.set_result(result)
+
+    def stats(self):
+        with self._stats_lock:
+            latencies = list(self._latencies)
+            data = {
+                "workers": self.workers,
+                "queue_depth": self._queue.qsize(),
+                "queue_max": WHISPER_QUEUE_MAX,
+                "completed": self.completed,
+                "batched": self.batched,
+                "rejected": self.rejected,
+            }
+        if latencies:
+            for i, name in enumerate(("queue_wait", "total")):
+                values = sorted(l[i] for l in latencies)
+                data[f"{name}_p50"] = round(values[len(values) // 2], 3)
+                data[f"{name}_p95"] = round(values[min(len(values) - 1, int(len(values) * 0.95))], 3)
+        return data
+
+
+_pool = WhisperPool() if WHISPER_POOL_WORKERS > 0 else None
+
+
+def transcribe(audio, **options):
+    """
+    Igual que whisper_registry.transcribe, pero pasando por el pool si está
+    activo. Puede lanzar WhisperBusy.
+    """
+    if _pool is None:
+        return whisper_registry.transcribe(audio, **options)
+    return _pool.submit(audio, **options).result()
+
+
+def transcribe_many(chunks, **options):
+    """
+    Transcribe varios trozos de un mismo audio y devuelve sus textos en orden.
+    Con el pool activo se encolan todos a la vez para que se procesen en paralelo.
+    """
+    if _pool is None or len(chunks) == 1:
+        return [transcribe(chunk, **options)["text"] for chunk in chunks]
+    futures = [_pool.submit(chunk, **options) for chunk in chunks]
+    return [future.result()["text"] for future in futures]
+
+
+def warmup():
+    """Arranca los procesos del pool (que cargan su modelo) o el modelo local."""
+    if _pool is None:
+        whisper_registry.get_model()
+    else:
+        _pool.start()
+
+
+def stats():
+    return _pool.stats() if _pool is not None else {"workers": 0}
@@ -0,0 +1,85 @@
+"""
+Registro de modelos Whisper compartido por todo el proceso.
+
+Cada worker carga los pesos una sola vez (de forma perezosa o al arranque,
+según WHISPER_PRELOAD) y todos los endpoints de voz reutilizan la misma
+instancia. La transcripción se serializa por modelo porque Whisper instala
+hooks de kv-cache sobre el propio módulo durante la decodificación.
+"""
+import os
+import threading
+import time
+
+import startup
+
+WHISPER_MODEL_SIZE = os.getenv("WHISPER_MODEL", "base")
+WHISPER_PRELOAD = os.getenv("WHISPER_PRELOAD", "0").lower() in ("1", "true", "yes")
+
+_models = {}        # {size: modelo}
+_model_locks = {}   # {size: threading.Lock} para serializar transcribe()
+_load_stats = {}    # {size: {"load_seconds": ..., "param_bytes": ...}}
+_registry_lock = threading.Lock()
+
+
+def _rss_bytes():
+    """Memoria residente actual del proceso (bytes), o None si no se puede leer."""
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE")
+    except Exception:
+        pass
+    try:
+        import resource
+        # ru_maxrss es el pico (KB en Linux), sirve como aproximación
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    except Exception:
+        return None
+
+
+def get_model(size=None):
+    """Devuelve el modelo Whisper `size`, cargándolo la primera vez."""
+    size = size or WHISPER_MODEL_SIZE
+    model = _models.get(size)
+    if model is not None:
+        return model
+
+    with _registry_lock:
+        model = _models.get(size)
+        if model is None:
+            print(f"🎙️ Cargando modelo Whisper '{size}'...")
+            rss_before = _rss_bytes()
+            start = time.perf_counter()
+            whisper = startup.lazy_import("whisper")
+            model = whisper.load_model(size)
+            elapsed = time.perf_counter() - start
+            rss_after = _rss_bytes()
+
+            _load_stats[size] = {
+                "load_seconds": round(elapsed, 3),
+                "param_bytes": sum(p.numel() * p.element_size() for p in model.parameters()),
+                "rss_delta_bytes": (rss_after - rss_before) if rss_before and rss_after else None,
+                "loaded_at": time.time(),
+            }
+            _model_locks[size] = threading.Lock()
+            _models[size] = model
+            print(f"✅ Whisper '{size}' listo en {elapsed:.2f}s")
+    return model
+
+
+def transcribe(audio, size=None, **kwargs):
+    """Transcribe `audio` (ruta o arreglo NumPy) con el modelo compartido."""
+    size = size or WHISPER_MODEL_SIZE
+    model = get_model(size)
+    with _model_locks[size]:
+        return model.transcribe(audio, **kwargs)
+
+
+def stats():
+    """Estado del registro para /health."""
+    return {
+        "default_model": WHISPER_MODEL_SIZE,
+        "preload": WHISPER_PRELOAD,
+        "loaded": {size: dict(info) for size, info in _load_stats.items()},
+        "rss_bytes": _rss_bytes(),
+    }
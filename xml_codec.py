@@ -0,0 +1,263 @@
+"""
+Lectura y escritura de XML para todas las rutas *-xml.
+
+- parse(): lee por bloques (lxml si está instalado y XML_BACKEND lo
+  permite, si no xml.etree). Los documentos de más de XML_TREE_MAX_BYTES se
+  alimentan a un parser incremental que arma el dict desde los eventos
+  start/data/end, sin construir el árbol; los pequeños se parsean de una vez,
+  que en CPython es más rápido. Acepta bytes o un stream (p.ej.
+  request.stream), con tope de tamaño (XML_MAX_BYTES) y de profundidad
+  (XML_MAX_DEPTH); rechaza DOCTYPE/ENTITY.
+- iter_serialize(): genera el XML por trozos de ~XML_CHUNK_BYTES sin
+  construir un árbol, para devolverlo como respuesta en streaming; dumps()
+  es la versión en una sola cadena para respuestas pequeñas.
+
+Conversión dict <-> XML:
+  <a>texto</a>                        -> {"a": "texto"}
+  <a><b>1</b><c>2</c></a>             -> {"a": {"b": "1", "c": "2"}}
+  <a><i>1</i><i>2</i></a>             -> {"a": ["1", "2"]}
+Un contenedor con un solo hijo se lee como lista si su etiqueta está en
+LIST_CONTAINERS (p.ej. <studies><study>..</study></studies>).
+"""
+import os
+import re
+from xml.sax.saxutils import escape
+
+import startup
+
+XML_BACKEND = os.getenv("XML_BACKEND", "auto")   # auto | lxml | stdlib
+XML_MAX_BYTES = int(os.getenv("XML_MAX_BYTES", str(1024 * 1024)))
+XML_MAX_DEPTH = int(os.getenv("XML_MAX_DEPTH", "32"))
+XML_CHUNK_BYTES = 64 * 1024
+READ_CHUNK_BYTES = 64 * 1024
+# Hasta este tamaño se parsea a árbol y se convierte; por encima, por eventos
+XML_TREE_MAX_BYTES = 64 * 1024
+LIST_CONTAINERS = {"studies", "history", "items"}
+
+_FORBIDDEN = (b"<!DOCTYPE", b"<!ENTITY")
+_INVALID_NAME_CHARS = re.compile(r"[^\w.-]", re.UNICODE)
+
+
+class XMLError(ValueError):
+    """XML inválido, demasiado grande o demasiado profundo."""
+
+
+# ===== LECTURA =====
+class _LimitedReader:
+    """Envuelve bytes o un stream: corta en max_bytes y rechaza DTDs."""
+
+    def __init__(self, source, max_bytes):
+        self._read = source.read if hasattr(source, "read") else _bytes_reader(source)
+        self._max_bytes = max_bytes
+        self._total = 0
+        self._tail = b""
+
+    def read(self, size=READ_CHUNK_BYTES):
+        chunk = self._read(size if size and size > 0 else READ_CHUNK_BYTES)
+        self._total += len(chunk)
+        if self._total > self._max_bytes:
+            raise XMLError(f"XML de más de {self._max_bytes} bytes")
+        window = self._tail + chunk
+        if any(marker in window for marker in _FORBIDDEN):
+            raise XMLError("DOCTYPE/ENTITY no permitidos")
+        self._tail = chunk[-16:]
+        return chunk
+
+
+def _bytes_reader(data):
+    view = memoryview(data if isinstance(data, bytes) else str(data).encode("utf-8"))
+    position = 0
+
+    def read(size):
+        nonlocal position
+        chunk = bytes(view[position:position + size])
+        position += len(chunk)
+        return chunk
+    return read
+
+
+_backend = None
+
+
+def _get_backend():
+    """(módulo, kwargs del XMLParser) del backend elegido, resuelto una sola vez."""
+    global _backend
+    if _backend is None:
+        if XML_BACKEND in ("auto", "lxml"):
+            try:
+                _backend = (startup.lazy_import("lxml.etree"), {
+                    "resolve_entities": False, "no_network": True, "load_dtd": False, "huge_tree": False,
+                })
+            except ImportError:
+                if XML_BACKEND == "lxml":
+                    raise
+        if _backend is None:
+            _backend = (startup.lazy_import("xml.etree.ElementTree"), {})
+    return _backend
+
+
+def _read_upto(reader, size):
+    """Lee hasta `size` bytes (o hasta el final, si llega antes)."""
+    chunks = []
+    total = 0
+    while total < size:
+        chunk = reader.read(size - total)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        total += len(chunk)
+    return b"".join(chunks)
+
+
+def _local_name(tag):
+    return tag.rsplit("}", 1)[-1] if "}" in tag else tag
+
+
+def _close(tag, children, text):
+    """Valor de un elemento ya cerrado a partir de sus hijos [(tag, valor)]."""
+    if not children:
+        if tag in LIST_CONTAINERS and not (text or "").strip():
+            return []
+        return text
+    tags = {t for t, _ in children}
+    if len(tags) == 1 and (len(children) > 1 or tag in LIST_CONTAINERS or tags == {"item"}):
+        return [value for _, value in children]
+    data = {}
+    for child_tag, value in children:
+        if child_tag in data:
+            previous = data[child_tag]
+            data[child_tag] = previous + [value] if isinstance(previous, list) else [previous, value]
+        else:
+            data[child_tag] = value
+    return data
+
+
+def _convert(elem, depth, max_depth):
+    """Dict a partir de un árbol ya parseado (camino rápido para documentos pequeños)."""
+    if depth > max_depth:
+        raise XMLError(f"XML con más de {max_depth} niveles")
+    children = []
+    for child in elem:
+        tag = child.tag
+        # lxml incluye comentarios e instrucciones de proceso como hijos
+        if not isinstance(tag, str):
+            continue
+        tag = _local_name(tag)
+        if len(child) or tag in LIST_CONTAINERS or depth >= max_depth:
+            children.append((tag, _convert(child, depth + 1, max_depth)))
+        else:
+            children.append((tag, child.text or None))
+    return _close(_local_name(elem.tag), children, None if children else elem.text or None)
+
+
+class _DictBuilder:
+    """
+    Target del parser: arma el dict a medida que llegan los eventos, sin
+    construir el árbol de elementos.
+    """
+
+    def __init__(self, max_depth):
+        self.max_depth = max_depth
+        self.stack = []   # [(tag, [(tag_hijo, valor)])]
+        self.text = []
+        self.result = None
+
+    def start(self, tag, attrib, *_):
+        if len(self.stack) >= self.max_depth:
+            raise XMLError(f"XML con más de {self.max_depth} niveles")
+        self.stack.append((_local_name(tag), []))
+        self.text = []
+
+    def data(self, data):
+        self.text.append(data)
+
+    def end(self, _tag):
+        tag, children = self.stack.pop()
+        text = "".join(self.text) if not children else None
+        self.text = []
+        value = _close(tag, children, text or None)
+        if self.stack:
+            self.stack[-1][1].append((tag, value))
+        else:
+            self.result = value
+
+    def close(self):
+        return self.result
+
+
+def parse(source, max_bytes=XML_MAX_BYTES, max_depth=XML_MAX_DEPTH):
+    """
+    Convierte el XML (bytes, str o stream) en dict con los hijos del elemento
+    raíz. Lanza XMLError si es inválido o excede los límites.
+    """
+    reader = _LimitedReader(source, max_bytes)
+    try:
+        backend, options = _get_backend()
+        head = _read_upto(reader, XML_TREE_MAX_BYTES)
+        if len(head) < XML_TREE_MAX_BYTES:
+            # Documento pequeño: el árbol en C + conversión es más rápido que los eventos
+            root = backend.fromstring(head, backend.XMLParser(**options))
+            result = _convert(root, 1, max_depth)
+        else:
+            parser = backend.XMLParser(target=_DictBuilder(max_depth), **options)
+            parser.feed(head)
+            for chunk in iter(reader.read, b""):
+                parser.feed(chunk)
+            result = parser.close()
+    except XMLError:
+        raise
+    except Exception as e:
+        # lxml envuelve las excepciones del target; se recupera la original
+        if isinstance(e.__context__, XMLError):
+            raise e.__context__
+        raise XMLError(f"XML inválido: {e}") from e
+    if isinstance(result, dict):
+        return result
+    if isinstance(result, list):
+        return {"items": result}
+    return {}
+
+
+# ===== ESCRITURA =====
+def tag_name(key):
+    """Nombre de etiqueta válido a partir de una clave arbitraria (p.ej. de Gemini)."""
+    name = _INVALID_NAME_CHARS.sub("_", str(key).strip()) or "_"
+    if not (name[0].isalpha() or name[0] == "_") or name.lower().startswith("xml"):
+        name = "_" + name
+    return name
+
+
+def _pieces(tag, value, item_tag):
+    if isinstance(value, dict):
+        yield f"<{tag}>"
+        for key, child in value.items():
+            yield from _pieces(tag_name(key), child, item_tag)
+        yield f"</{tag}>"
+    elif isinstance(value, (list, tuple)):
+        yield f"<{tag}>"
+        for child in value:
+            yield from _pieces(item_tag, child, item_tag)
+        yield f"</{tag}>"
+    elif value is None or value == "":
+        yield f"<{tag} />"
+    else:
+        yield f"<{tag}>{escape(str(value))}</{tag}>"
+
+
+def iter_serialize(data, root="response", item_tag="item", chunk_bytes=XML_CHUNK_BYTES):
+    """Genera el XML de `data` en trozos de ~chunk_bytes caracteres."""
+    buffer = []
+    size = 0
+    for piece in _pieces(root, data, item_tag):
+        buffer.append(piece)
+        size += len(piece)
+        if size >= chunk_bytes:
+            yield "".join(buffer)
+            buffer = []
+            size = 0
+    if buffer:
+        yield "".join(buffer)
+
+
+def dumps(data, root="response", item_tag="item"):
+    return "".join(_pieces(root, data, item_tag))